@@ -0,0 +1,93 @@
+"""
+Response cache for the read-only catalog endpoints.
+
+A cached response is keyed on the host, the view, the normalized query parameters and
+the current IndexVersion stamps of the data it is built from (its tags). A write
+bumps a stamp, which moves every dependent key at once: invalidation needs no
+key scans, stale entries simply expire. The key also serves as the ETag, so a
+client revalidating with If-None-Match gets a 304 without the cache being read.
+
+Any Django cache backend works, no external service is needed: the locmem
+default cache, or a file based one named by the CATALOG_CACHE setting, e.g.
+
+    CACHES = {
+        'default': {...},
+        'catalog': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': '/var/tmp/sc_api_catalog_cache',
+        },
+    }
+    CATALOG_CACHE = 'catalog'
+"""
+import hashlib
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.http import urlencode
+from rest_framework.response import Response
+
+from .models import IndexVersion
+
+
+def get_catalog_cache():
+    return caches[getattr(settings, 'CATALOG_CACHE', 'default')]
+
+
+def normalize_query_params(query_params):
+    """Sorted query string without empty values and surrounding whitespace"""
+    items = []
+    for key, values in query_params.lists():
+        for value in values:
+            value = value.strip()
+            if value:
+                items.append((key, value))
+    return urlencode(sorted(items))
+
+
+class CachedResponseMixin:
+    """
+    Cache list/retrieve responses of a read-only viewset.
+    Permissions are checked before the handler runs, so cached responses are
+    only ever served to requests that would have been allowed anyway.
+    """
+    # IndexVersion stamps the response is built from
+    cache_tags = (IndexVersion.REFERENCE,)
+    cache_timeout = 60 * 60
+
+    def get_cache_key(self, request, versions):
+        # The paginated responses hold absolute next/previous links and the catalog
+        # absolute logo URLs: a response built for one host is not served to another
+        key = ':'.join((
+            request.scheme,
+            request.get_host(),
+            self.__class__.__name__,
+            self.action,
+            urlencode(sorted(self.kwargs.items())),
+            normalize_query_params(request.query_params),
+            '.'.join(str(version) for version in versions),
+        ))
+        return 'catalog-response:' + hashlib.md5(key.encode()).hexdigest()
+
+    def cached_response(self, handler, request, *args, **kwargs):
+        versions = IndexVersion.current(*self.cache_tags)
+        key = self.get_cache_key(request, versions)
+        etag = f'"{key.rsplit(":", 1)[-1]}"'
+
+        if etag in request.META.get('HTTP_IF_NONE_MATCH', ''):
+            return Response(status=304, headers={'ETag': etag})
+
+        cache = get_catalog_cache()
+        data = cache.get(key)
+        if data is None:
+            response = handler(request, *args, **kwargs)
+            if response.status_code != 200:
+                return response
+            data = response.data
+            cache.set(key, data, self.cache_timeout)
+        return Response(data, headers={'ETag': etag})
+
+    def list(self, request, *args, **kwargs):
+        return self.cached_response(super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.cached_response(super().retrieve, request, *args, **kwargs)
@@ -0,0 +1,124 @@
+"""
+In-process facet index for the public catalog filters.
+
+For every filter value (genre, country, region, city, language) the index keeps
+the set of enabled radios carrying it as an integer bitset (bit N set = radio
+with id N). Filtering is a bitwise AND of the selected values, and a filter value
+is available for the current selection when its bitset intersects it, so the
+filter block of a catalog page costs no SQL at all.
+
+The index is rebuilt from a handful of flat queries whenever the radios or the
+reference data version stamp changes (see IndexVersion and catalog/signals.py).
+The filter values are named by the reference registry.
+"""
+import threading
+
+from .models import Radio, IndexVersion
+from .registry import get_registry
+
+
+# Response key (and registry key) -> (query parameter, radio field)
+FACETS = (
+    ('genres', 'genre', 'genres'),
+    ('countries', 'country', 'country'),
+    ('regions', 'region', 'region'),
+    ('cities', 'city', 'city'),
+    ('languages', 'language', 'languages'),
+)
+
+
+def to_bitset(ids):
+    """Pack radio ids into an integer bitset"""
+    ids = list(ids)
+    if not ids:
+        return 0
+    buffer = bytearray(max(ids) // 8 + 1)
+    for radio_id in ids:
+        buffer[radio_id >> 3] |= 1 << (radio_id & 7)
+    return int.from_bytes(buffer, 'little')
+
+
+class FacetIndex:
+
+    def __init__(self, version):
+        self.version = version
+        self.all = 0
+        # facet -> {value id: bitset of radios}
+        self.postings = {}
+        self.registry = None
+
+    def build(self):
+        radios = list(
+            Radio.objects.filter(enabled=True).values_list('id', 'country_id', 'region_id', 'city_id')
+        )
+        self.all = to_bitset(radio_id for radio_id, *_ in radios)
+
+        members = {
+            'countries': [(country_id, radio_id) for radio_id, country_id, _, _ in radios],
+            'regions': [(region_id, radio_id) for radio_id, _, region_id, _ in radios if region_id],
+            'cities': [(city_id, radio_id) for radio_id, _, _, city_id in radios if city_id],
+            'genres': Radio.genres.through.objects.filter(
+                radio__enabled=True
+            ).values_list('genre_id', 'radio_id'),
+            'languages': Radio.languages.through.objects.filter(
+                radio__enabled=True
+            ).values_list('language_id', 'radio_id'),
+        }
+
+        for key, _, _ in FACETS:
+            grouped = {}
+            for value_id, radio_id in members[key]:
+                grouped.setdefault(value_id, []).append(radio_id)
+            self.postings[key] = {value_id: to_bitset(ids) for value_id, ids in grouped.items()}
+
+        self.registry = get_registry()
+        return self
+
+    def match(self, key, value):
+        """Bitset of the radios having the value (name or name_eng, case insensitive)"""
+        postings = self.postings[key]
+        bits = 0
+        for value_id in self.registry.ids(key, value):
+            bits |= postings.get(value_id, 0)
+        return bits
+
+    def select(self, params):
+        """Bitset of the radios matching all the filters given in the query params"""
+        bits = self.all
+        for key, param, _ in FACETS:
+            value = params.get(param, '').strip()
+            if value:
+                bits &= self.match(key, value)
+        return bits
+
+    def available(self, bits, lang=''):
+        """Names of the filter values present among the selected radios"""
+        name_index = 0 if lang == 'ru' else 1
+        filters = {}
+        for key, _, _ in FACETS:
+            values = set()
+            for value_id, value_bits in self.postings[key].items():
+                row = self.registry.get(key, value_id)
+                if value_bits & bits and row is not None:
+                    name = (row.name, row.name_eng)[name_index]
+                    if name:
+                        values.add(name)
+            filters[key] = sorted(values)
+        return filters
+
+
+_index = None
+_lock = threading.Lock()
+
+
+def get_facet_index():
+    """Return the facet index, rebuilding it if the catalog changed since it was built"""
+    global _index
+    version = IndexVersion.current(IndexVersion.RADIOS, IndexVersion.REFERENCE)
+    index = _index
+    if index is not None and index.version == version:
+        return index
+    with _lock:
+        if _index is None or _index.version != version:
+            _index = FacetIndex(version).build()
+        return _index
@@ -0,0 +1,152 @@
+"""
+In-process spatial index for the "stations near me" lookup.
+
+Radios have no coordinates of their own, they are located by their city. The
+index is a KD-tree over the cities that have enabled radios, with every city
+as a point on the unit sphere: the straight (chord) distance between two such
+points grows with the great-circle distance, so the tree needs no special case
+for the poles or the antimeridian. A lookup visits a few tree nodes instead of
+computing the distance to every city.
+
+Like the facet index it is rebuilt when the radios or the reference data
+version stamp changes.
+"""
+import heapq
+import math
+import threading
+
+from .models import Radio, City, IndexVersion
+
+
+EARTH_RADIUS_KM = 6371.0088
+
+
+def to_point(latitude, longitude):
+    lat = math.radians(latitude)
+    lon = math.radians(longitude)
+    return (math.cos(lat) * math.cos(lon), math.cos(lat) * math.sin(lon), math.sin(lat))
+
+
+def chord_to_km(chord):
+    return 2 * EARTH_RADIUS_KM * math.asin(min(chord / 2, 1.0))
+
+
+def km_to_chord(km):
+    return 2 * math.sin(min(km / EARTH_RADIUS_KM, math.pi) / 2)
+
+
+class KDTree:
+    """
+    A static 3-d tree over (point, payload) pairs, stored as nested tuples
+    (point, payload, axis, left, right)
+    """
+
+    def __init__(self, items):
+        self.root = self.build(list(items), 0)
+
+    def build(self, items, depth):
+        if not items:
+            return None
+        axis = depth % 3
+        items.sort(key=lambda item: item[0][axis])
+        median = len(items) // 2
+        point, payload = items[median]
+        return (
+            point, payload, axis,
+            self.build(items[:median], depth + 1),
+            self.build(items[median + 1:], depth + 1),
+        )
+
+    def nearest(self, target, k, max_distance=math.inf):
+        """The k payloads closest to the target within max_distance, as sorted (distance, payload)"""
+        # Max-heap of the best k so far, as (-squared distance, counter, payload)
+        best = []
+        max_squared = max_distance ** 2
+        counter = 0
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if node is None:
+                continue
+            point, payload, axis, left, right = node
+            squared = sum((a - b) ** 2 for a, b in zip(point, target))
+            worst = -best[0][0] if len(best) == k else max_squared
+            if squared <= worst:
+                counter += 1
+                item = (-squared, counter, payload)
+                if len(best) < k:
+                    heapq.heappush(best, item)
+                else:
+                    heapq.heapreplace(best, item)
+                worst = -best[0][0] if len(best) == k else max_squared
+
+            diff = target[axis] - point[axis]
+            near, far = (left, right) if diff < 0 else (right, left)
+            # The far side is only worth a visit if the splitting plane is close enough
+            if diff ** 2 <= worst:
+                stack.append(far)
+            stack.append(near)
+        return sorted((math.sqrt(-squared), payload) for squared, _, payload in best)
+
+
+class GeoIndex:
+
+    def __init__(self, version):
+        self.version = version
+        self.tree = None
+        # city id -> [ids of its enabled radios]
+        self.radios = {}
+
+    def build(self):
+        for radio_id, city_id in Radio.objects.filter(
+            enabled=True, city__isnull=False
+        ).values_list('id', 'city_id'):
+            self.radios.setdefault(city_id, []).append(radio_id)
+
+        cities = City.objects.filter(
+            id__in=list(self.radios), latitude__isnull=False, longitude__isnull=False
+        ).values_list('id', 'latitude', 'longitude')
+        self.tree = KDTree((to_point(latitude, longitude), city_id) for city_id, latitude, longitude in cities)
+        return self
+
+    def nearby(self, latitude, longitude, radius=None, limit=None, accept=None):
+        """
+        Radios of the cities closest to the point as (distance in km, radio id), by distance.
+        radius (km) and/or limit bound the result, accept(radio id) filters the radios.
+        All radios of the last city are returned, for the caller to rank them.
+        """
+        target = to_point(latitude, longitude)
+        max_chord = km_to_chord(radius) if radius is not None else math.inf
+        # Every city has at least a radio: the limit nearest cities hold the limit nearest radios
+        cities = max(limit, 1) if limit is not None else len(self.radios)
+        while True:
+            found = self.tree.nearest(target, cities, max_chord)
+            results = []
+            for chord, city_id in found:
+                if limit is not None and len(results) >= limit:
+                    break
+                distance = chord_to_km(chord)
+                results.extend(
+                    (distance, radio_id) for radio_id in self.radios[city_id] if accept is None or accept(radio_id)
+                )
+            # The filter may have dropped radios: look further
+            if limit is None or len(results) >= limit or len(found) < cities:
+                return results
+            cities *= 2
+
+
+_index = None
+_lock = threading.Lock()
+
+
+def get_geo_index():
+    """Return the geo index, rebuilding it if the catalog changed since it was built"""
+    global _index
+    version = IndexVersion.current(IndexVersion.RADIOS, IndexVersion.REFERENCE)
+    index = _index
+    if index is not None and index.version == version:
+        return index
+    with _lock:
+        if _index is None or _index.version != version:
+            _index = GeoIndex(version).build()
+        return _index
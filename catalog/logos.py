@@ -0,0 +1,82 @@
+"""
+Radio logo renditions.
+
+The render_logos command turns every new logo into RENDITION_SIZES squares in
+each of RENDITION_FORMATS. A rendition is stored under the hash of the source
+image, so a logo shared by several radios is rendered and stored once, and a
+rendition URL never changes content: it can be cached forever.
+
+Once rendered, Radio.logo itself is pointed at the LOGO_SIZE rendition: the
+clients reading `logo` rather than the srcset never download the full size upload.
+
+Radio.logo_renditions holds {'source': logo name, 'webp': {'64': name, ...},
+'png': {...}}. Radio.save() empties it when the logo changes.
+"""
+import hashlib
+from io import BytesIO
+
+from PIL import Image
+
+
+RENDITION_SIZES = (64, 128, 256, 512)
+# Format -> (PIL format, file extension, save options)
+RENDITION_FORMATS = {
+    'webp': ('WEBP', 'webp', {'quality': 80, 'method': 6}),
+    'png': ('PNG', 'png', {'optimize': True}),
+}
+RENDITION_DIR = 'catalog_logos/renditions'
+
+# Rendition served as the logo itself, PNG like most uploads and with their transparency
+LOGO_SIZE = 512
+LOGO_FORMAT = 'png'
+
+
+def source_digest(content):
+    return hashlib.sha256(content).hexdigest()[:32]
+
+
+def rendition_name(digest, size, fmt):
+    # Fan out in subdirectories, a single directory would hold every logo
+    return f"{RENDITION_DIR}/{digest[:2]}/{digest}-{size}.{RENDITION_FORMATS[fmt][1]}"
+
+
+def is_rendition(name):
+    return name.startswith(f"{RENDITION_DIR}/")
+
+
+def rendition_sizes(width):
+    """The sizes up to the source width, logos are never upscaled past the smallest one"""
+    return [size for size in RENDITION_SIZES if size <= width] or [RENDITION_SIZES[0]]
+
+
+def render_logo(content):
+    """
+    Runs in the process pool: decode the logo once and encode every rendition.
+    Returns {(format, size): bytes}
+    """
+    with Image.open(BytesIO(content)) as img:
+        img.load()
+        has_alpha = img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info)
+        img = img.convert('RGBA' if has_alpha else 'RGB')
+
+    out = {}
+    # From the largest down: each step is a small, cheap reduction of the previous one
+    current = img
+    for size in sorted(rendition_sizes(img.width), reverse=True):
+        current = current.resize((size, size), Image.LANCZOS)
+        for fmt, (pil_format, _, options) in RENDITION_FORMATS.items():
+            buffer = BytesIO()
+            current.save(buffer, format=pil_format, **options)
+            out[(fmt, size)] = buffer.getvalue()
+    return out
+
+
+def srcset(renditions, fmt, build_url):
+    """HTML srcset of a rendition format, None until the logo has been rendered"""
+    names = renditions.get(fmt) if renditions else None
+    if not names:
+        return None
+    return ', '.join(
+        f"{build_url(name)} {size}w"
+        for size, name in sorted(names.items(), key=lambda item: int(item[0]))
+    )
@@ -0,0 +1,128 @@
+import time
+
+import numpy as np
+from scipy import sparse
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from catalog.models import Radio, SimilarRadio
+
+
+# Weight of each kind of feature in the radio vectors: the genres make most of the similarity
+GENRE_WEIGHT = 1.0
+LANGUAGE_WEIGHT = 0.6
+COUNTRY_WEIGHT = 0.4
+
+# Among equally similar radios the better rated come first
+RATING_TIEBREAK = 1e-4
+
+
+class Command(BaseCommand):
+    help = (
+        'Build the "similar stations" of every enabled radio: top-k cosine neighbors over '
+        'sparse genre/language/country vectors, stored in the SimilarRadio table'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--k',
+            type=int,
+            default=20,
+            help='Number of similar radios kept per radio (default: 20)'
+        )
+        parser.add_argument(
+            '--block-size',
+            type=int,
+            default=256,
+            help='Number of radios whose similarities are computed at once, bounds the memory (default: 256)'
+        )
+        parser.add_argument(
+            '--min-score',
+            type=float,
+            default=0.2,
+            help='Minimum cosine similarity of a similar radio (default: 0.2)'
+        )
+
+    def build_matrix(self):
+        """
+        Returns (radio ids, weighted ratings, CSR matrix with one L2-normalized row per radio)
+        """
+        radios = list(Radio.objects.filter(enabled=True).order_by('id').values_list('id', 'country_id', 'weighted_rating'))
+        ids = np.array([radio_id for radio_id, _, _ in radios], dtype=np.int64)
+        ratings = np.array([rating for _, _, rating in radios], dtype=np.float32)
+        position = {radio_id: i for i, radio_id in enumerate(ids.tolist())}
+
+        rows, columns, weights = [], [], []
+        offset = 0
+
+        def add(pairs, weight):
+            """(radio id, value id) pairs as one block of columns"""
+            nonlocal offset
+            value_columns = {}
+            for radio_id, value_id in pairs:
+                row = position.get(radio_id)
+                if row is None:
+                    continue
+                rows.append(row)
+                columns.append(offset + value_columns.setdefault(value_id, len(value_columns)))
+                weights.append(weight)
+            offset += len(value_columns)
+
+        add(Radio.genres.through.objects.filter(radio__enabled=True).values_list('radio_id', 'genre_id'), GENRE_WEIGHT)
+        add(Radio.languages.through.objects.filter(radio__enabled=True).values_list('radio_id', 'language_id'), LANGUAGE_WEIGHT)
+        add(((radio_id, country_id) for radio_id, country_id, _ in radios), COUNTRY_WEIGHT)
+
+        matrix = sparse.csr_matrix(
+            (np.array(weights, dtype=np.float32), (rows, columns)),
+            shape=(len(ids), max(offset, 1)),
+        )
+        # Duplicate through rows would add up, a feature is there or not
+        matrix.data = np.minimum(matrix.data, np.float32(max(GENRE_WEIGHT, LANGUAGE_WEIGHT, COUNTRY_WEIGHT)))
+        norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+        norms[norms == 0] = 1
+        return ids, ratings, sparse.diags(1 / norms).dot(matrix).tocsr()
+
+    def neighbors(self, ids, ratings, matrix, k, block_size, min_score):
+        """Yield SimilarRadio rows, block_size radios at a time"""
+        k = min(k, len(ids) - 1)
+        if k <= 0:
+            return
+        transposed = matrix.T.tocsc()
+        tiebreak = ratings * RATING_TIEBREAK
+        for start in range(0, len(ids), block_size):
+            stop = min(start + block_size, len(ids))
+            scores = (matrix[start:stop] @ transposed).toarray()
+            # Never similar to itself
+            scores[np.arange(stop - start), np.arange(start, stop)] = -1
+            ranked = scores + tiebreak
+            top = np.argpartition(-ranked, k - 1, axis=1)[:, :k]
+            order = np.argsort(-np.take_along_axis(ranked, top, axis=1), axis=1)
+            top = np.take_along_axis(top, order, axis=1)
+            top_scores = np.take_along_axis(scores, top, axis=1)
+
+            for row in range(stop - start):
+                rank = 0
+                for column, score in zip(top[row].tolist(), top_scores[row].tolist()):
+                    if score < min_score:
+                        break
+                    yield SimilarRadio(
+                        radio_id=int(ids[start + row]), similar_id=int(ids[column]), rank=rank, score=round(score, 4)
+                    )
+                    rank += 1
+
+    def handle(self, *args, **options):
+        start_time = time.time()
+        ids, ratings, matrix = self.build_matrix()
+        self.stdout.write(f"{len(ids)} radios, {matrix.shape[1]} features")
+
+        rows = list(self.neighbors(
+            ids, ratings, matrix, options['k'], max(options['block_size'], 1), options['min_score']
+        ))
+        # The table is replaced at once, the catalog never serves a half built one
+        with transaction.atomic():
+            SimilarRadio.objects.all().delete()
+            SimilarRadio.objects.bulk_create(rows, batch_size=5000)
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Stored {len(rows)} similar radios for {len(ids)} radios in {time.time() - start_time:.2f} seconds"
+        ))
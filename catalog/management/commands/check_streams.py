@@ -1,21 +1,34 @@
 import asyncio
 import aiohttp
 import time
+from datetime import timedelta
 from django.core.management.base import BaseCommand
-from django.db.models import Count
-from catalog.models import Radio, Stream
+from django.db.models import Prefetch
+from catalog.models import Radio, Stream, StreamHealth, StreamProbe, IndexVersion, VerificationStatus
+from catalog.probes import HEADERS, normalize_url, get_fresh_probes, save_probes
 from asgiref.sync import sync_to_async
+from django.utils import timezone
+
+
+# Maximum number of ids in one UPDATE ... WHERE id IN (...)
+UPDATE_CHUNK_SIZE = 1000
+
+HEALTH_FIELDS = ['last_checked', 'last_ok', 'consecutive_failures', 'ttfb', 'content_type', 'error', 'next_check']
 
 
 class Command(BaseCommand):
-    help = 'Check all radio streams and update enabled status'
+    help = (
+        'Check the radio streams that are due and update enabled status. '
+        'Healthy streams are re-checked every --healthy-interval hours, failing ones with an '
+        'exponential backoff; a stream is disabled after --disable-after consecutive failures'
+    )
 
     def add_arguments(self, parser):
         parser.add_argument(
             '--batch-size',
             type=int,
             default=20,
-            help='Number of stream URLs to check concurrently (default: 20)'
+            help='Number of stream URLs to check concurrently, across all radios (default: 20)'
         )
         parser.add_argument(
             '--timeout',
@@ -23,115 +36,351 @@ class Command(BaseCommand):
             default=15,
             help='Timeout in seconds for each stream check (default: 15)'
         )
+        parser.add_argument(
+            '--per-host',
+            type=int,
+            default=4,
+            help='Maximum number of concurrent connections to the same host (default: 4)'
+        )
+        parser.add_argument(
+            '--read-bytes',
+            type=int,
+            default=1024,
+            help='Number of bytes read from a valid stream before closing it (default: 1024)'
+        )
+        parser.add_argument(
+            '--flush-size',
+            type=int,
+            default=500,
+            help='Number of checked streams buffered before they are written (default: 500)'
+        )
+        parser.add_argument(
+            '--flush-interval',
+            type=int,
+            default=30,
+            help='Maximum number of seconds a checked stream stays buffered (default: 30)'
+        )
+        parser.add_argument(
+            '--healthy-interval',
+            type=float,
+            default=12,
+            help='Hours before a healthy stream is checked again (default: 12)'
+        )
+        parser.add_argument(
+            '--retry-interval',
+            type=float,
+            default=10,
+            help='Minutes before a failed stream is checked again, doubled on every failure (default: 10)'
+        )
+        parser.add_argument(
+            '--disable-after',
+            type=int,
+            default=3,
+            help='Number of consecutive failures before a stream is disabled (default: 3)'
+        )
+        parser.add_argument(
+            '--all',
+            action='store_true',
+            help='Check every stream, due or not'
+        )
+
+    def create_session(self, batch_size, per_host, timeout):
+        """
+        One session for the whole run: the connector caps the connections per host
+        (many stations share a streaming server) and caches DNS between the checks.
+        """
+        connector = aiohttp.TCPConnector(
+            limit=batch_size,
+            limit_per_host=per_host,
+            ttl_dns_cache=300,
+        )
+        return aiohttp.ClientSession(
+            connector=connector,
+            headers=HEADERS,
+            timeout=aiohttp.ClientTimeout(total=timeout),
+        )
 
-    async def check_stream_url(self, stream, timeout):
+    async def check_stream_url(self, session, stream, read_bytes):
         """
-        Asynchronously check if a stream URL is valid and returns audio content
-        Sets Stream.enabled True/False based on result
+        Asynchronously check if a stream URL is valid and returns audio content.
+        Returns (ok, time to first byte in ms, content type, error)
         """
         url = stream.stream_url
-        result = False
+        ttfb = None
+        content_type = ''
+        error = ''
         if not (url.startswith('http://') or url.startswith('https://')):
             self.stdout.write(self.style.WARNING(f"Invalid URL format: {url}"))
-            result = False
+            error = "url_invalid"
         else:
-            headers = {
-                'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/108.0.0.0 Safari/537.36',
-                'Icy-MetaData': '1'
-            }
+            started = time.monotonic()
             try:
-                async with aiohttp.ClientSession() as session:
-                    async with session.get(url, headers=headers, timeout=timeout) as response:
-                        if not response.ok:
-                            self.stdout.write(self.style.WARNING(f"HTTP error {response.status}: {url}"))
-                            result = False
-                        else:
-                            content_type = response.headers.get('Content-Type', '').lower()
-                            if 'audio' not in content_type:
-                                self.stdout.write(self.style.WARNING(f"Not audio content: {url} (Content-Type: {content_type})"))
-                                result = False
-                            else:
-                                self.stdout.write(self.style.SUCCESS(f"Valid audio stream: {url}"))
-                                result = True
+                async with session.get(url) as response:
+                    content_type = response.headers.get('Content-Type', '').lower()
+                    if not response.ok:
+                        self.stdout.write(self.style.WARNING(f"HTTP error {response.status}: {url}"))
+                        error = f"HTTP {response.status}"
+                    elif 'audio' not in content_type:
+                        self.stdout.write(self.style.WARNING(f"Not audio content: {url} (Content-Type: {content_type})"))
+                        error = "content_type_not_audio"
+                    else:
+                        # The first bytes prove that audio is flowing, the rest of the stream is never read
+                        await response.content.read(read_bytes)
+                        ttfb = int((time.monotonic() - started) * 1000)
+                        self.stdout.write(self.style.SUCCESS(f"Valid audio stream: {url}"))
+                    # A live stream never ends: drop the connection instead of returning it to the pool
+                    response.close()
             except (aiohttp.ClientError, asyncio.TimeoutError) as e:
                 self.stdout.write(self.style.WARNING(f"Connection error: {url} ({str(e)})"))
-                result = False
-        # Update Stream.enabled in DB
-        await self.update_stream_status(stream.id, result)
-        return result
-
-    async def process_batch(self, streams_batch, timeout):
-        """Process a batch of streams concurrently"""
-        tasks = [self.check_stream_url(stream, timeout) for stream in streams_batch]
-        results = await asyncio.gather(*tasks)
-        return dict(zip([stream.id for stream in streams_batch], results))
+                error = f"connection_error: {e}" if str(e) else "connection_error"
+        return not error, ttfb, content_type[:100], error[:255]
+
+    async def worker(self, queue, session, read_bytes, results, known):
+        """
+        Take streams off the shared queue until it is drained.
+        A stream probed recently elsewhere (known) is not probed again
+        """
+        while True:
+            try:
+                stream = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            probe = known.get(stream.id)
+            if probe is None:
+                try:
+                    probe = await self.check_stream_url(session, stream, read_bytes)
+                except Exception as e:
+                    self.stdout.write(self.style.ERROR(f"Failed to check {stream.stream_url}: {e}"))
+                    probe = (False, None, '', f"check_failed: {e}"[:255])
+                self.pending_probes.append(StreamProbe(
+                    url=normalize_url(stream.stream_url), ok=probe[0], content_type=probe[2],
+                    error=probe[3], checked_at=timezone.now()
+                ))
+            else:
+                self.probes_reused += 1
+            results[stream.id] = await self.record_result(stream, probe)
+
+    async def check_streams(self, streams, batch_size, per_host, timeout, read_bytes, known):
+        """
+        Check the streams of all radios through one queue, batch_size at a time.
+        known is {stream id: probe} of the streams that need no network check.
+        Returns {stream id: new enabled status}
+        """
+        results = {}
+        if not streams:
+            return results
+
+        queue = asyncio.Queue()
+        for stream in streams:
+            queue.put_nowait(stream)
+
+        async with self.create_session(batch_size, per_host, timeout) as session:
+            workers = [
+                self.worker(queue, session, read_bytes, results, known)
+                for _ in range(min(batch_size, len(streams)))
+            ]
+            await asyncio.gather(*workers)
+        return results
+
+    def get_health(self, stream):
+        try:
+            return stream.health
+        except StreamHealth.DoesNotExist:
+            return None
+
+    def is_due(self, stream, now):
+        health = self.get_health(stream)
+        return health is None or health.next_check is None or health.next_check <= now
+
+    def update_health(self, stream, probe):
+        """
+        Record the probe in the stream health and schedule the next check.
+        Returns the new Stream.enabled: a success enables the stream at once, it takes
+        disable_after failures in a row to disable it.
+        """
+        ok, ttfb, content_type, error = probe
+        now = timezone.now()
+        health = self.get_health(stream)
+        if health is None:
+            health = StreamHealth(stream=stream)
+            self.pending_new_health.append(health)
+        else:
+            self.pending_health.append(health)
+
+        health.last_checked = now
+        health.content_type = content_type
+        health.error = error
+        if ok:
+            health.last_ok = now
+            health.consecutive_failures = 0
+            health.ttfb = ttfb
+            health.next_check = now + self.healthy_interval
+            return True
+
+        health.consecutive_failures += 1
+        health.ttfb = None
+        backoff = self.retry_interval * 2 ** (health.consecutive_failures - 1)
+        health.next_check = now + min(backoff, self.healthy_interval)
+        if health.consecutive_failures >= self.disable_after:
+            return False
+        return stream.enabled
+
+    def bulk_update_status(self, queryset, changes, **extra):
+        """Write {enabled: [ids]} with one UPDATE per status (and per chunk of ids)"""
+        for enabled, ids in changes.items():
+            for i in range(0, len(ids), UPDATE_CHUNK_SIZE):
+                queryset.filter(id__in=ids[i:i + UPDATE_CHUNK_SIZE]).update(enabled=enabled, **extra)
+
+    async def record_result(self, stream, probe):
+        """
+        Buffer the stream health and status (if it changed), flush the buffers when
+        they are full or old enough. Returns the new stream status
+        """
+        enabled = self.update_health(stream, probe)
+        if enabled != stream.enabled:
+            self.pending_streams[enabled].append(stream.id)
+        self.pending_count += 1
+        if (self.pending_count >= self.flush_size or
+                time.monotonic() - self.last_flush >= self.flush_interval):
+            await self.flush()
+        return enabled
+
+    async def flush(self):
+        # Swap the buffers before awaiting: the other workers keep filling fresh ones
+        changes, self.pending_streams = self.pending_streams, {True: [], False: []}
+        new_health, self.pending_new_health = self.pending_new_health, []
+        health, self.pending_health = self.pending_health, []
+        probes, self.pending_probes = self.pending_probes, []
+        self.pending_count = 0
+        self.last_flush = time.monotonic()
+        await self.write_results(changes, new_health, health, probes)
+        self.streams_updated += len(changes[True]) + len(changes[False])
+
     @sync_to_async
-    def update_stream_status(self, stream_id, enabled):
-        """Update stream enabled status"""
-        from catalog.models import Stream
-        Stream.objects.filter(id=stream_id).update(enabled=enabled)
+    def write_results(self, changes, new_health, health, probes):
+        """Update streams enabled status and health, share the probes with the serializers"""
+        # `modified` tells the incremental exports which streams moved
+        self.bulk_update_status(Stream.objects, changes, modified=timezone.now())
+        StreamHealth.objects.bulk_create(new_health, batch_size=UPDATE_CHUNK_SIZE)
+        StreamHealth.objects.bulk_update(health, HEALTH_FIELDS, batch_size=UPDATE_CHUNK_SIZE)
+        save_probes(probes)
+
+    @sync_to_async
+    def get_known_probes(self, streams):
+        """
+        {stream id: probe} of the streams validated since their last check:
+        a radio owner just saved them, there is no need to probe them again
+        """
+        probes = get_fresh_probes(stream.stream_url for stream in streams)
+        known = {}
+        for stream in streams:
+            probe = probes.get(normalize_url(stream.stream_url))
+            if probe is None:
+                continue
+            health = self.get_health(stream)
+            # The checker's own probes are never newer than the last check
+            if health is None or health.last_checked is None or probe.checked_at > health.last_checked:
+                known[stream.id] = (probe.ok, None, probe.content_type, probe.error)
+        return known
 
     @sync_to_async
     def get_all_radios_with_streams(self):
-        """Get all radios with their streams"""
-        return list(Radio.objects.all().prefetch_related('streams'))
+        """
+        Get the verified radios with their streams and their health. The pending and
+        failed ones are left to the verify_radios command, it decides when they go live
+        """
+        return list(Radio.objects.filter(verification_status=VerificationStatus.VERIFIED).prefetch_related(
+            Prefetch('streams', queryset=Stream.objects.select_related('health'))
+        ))
+
+    @sync_to_async
+    def update_radio_statuses(self, changes):
+        """Update radios enabled status, a radio submitted again during the check is not touched"""
+        self.bulk_update_status(
+            Radio.objects.filter(verification_status=VerificationStatus.VERIFIED), changes, modified=timezone.now()
+        )
 
     @sync_to_async
-    def update_radio_status(self, radio_id, enabled):
-        """Update radio enabled status"""
-        Radio.objects.filter(id=radio_id).update(enabled=enabled)
+    def bump_index_version(self):
+        """Queryset updates send no signals, let the web workers refresh their catalog indexes"""
+        IndexVersion.bump(IndexVersion.RADIOS)
 
-    async def handle_async(self, batch_size, timeout):
+    async def handle_async(self, batch_size, timeout, per_host, read_bytes, check_all):
         start_time = time.time()
+        self.pending_streams = {True: [], False: []}
+        self.pending_new_health = []
+        self.pending_health = []
+        self.pending_probes = []
+        self.pending_count = 0
+        self.last_flush = time.monotonic()
+        self.streams_updated = 0
+        self.probes_reused = 0
         radios = await self.get_all_radios_with_streams()
         total_radios = len(radios)
-        
-        self.stdout.write(self.style.SUCCESS(f"Checking {total_radios} radios..."))
-        
-        # Process each radio
-        radios_updated = 0
-        
+        now = timezone.now()
+        all_streams = [stream for radio in radios for stream in radio.streams.all()]
+        streams = [stream for stream in all_streams if check_all or self.is_due(stream, now)]
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Checking {len(streams)} due streams out of {len(all_streams)} of {total_radios} radios..."
+        ))
+
+        known = {} if check_all else await self.get_known_probes(streams)
+        stream_results = await self.check_streams(streams, batch_size, per_host, timeout, read_bytes, known)
+        await self.flush()
+
+        radio_changes = {True: [], False: []}
+
         for radio in radios:
             streams = list(radio.streams.all())
-            
+
             if not streams:
-                self.stdout.write(self.style.WARNING(f"Radio '{radio.name}' has no streams. Setting enabled=False"))
-                await self.update_radio_status(radio.id, False)
-                radios_updated += 1
+                if radio.enabled:
+                    self.stdout.write(self.style.WARNING(f"Radio '{radio.name}' has no streams. Setting enabled=False"))
+                    radio_changes[False].append(radio.id)
                 continue
-                
-            # Process streams in batches
-            stream_results = {}
-            for i in range(0, len(streams), batch_size):
-                batch = streams[i:i + batch_size]
-                batch_results = await self.process_batch(batch, timeout)
-                stream_results.update(batch_results)
-            
-            # Check if any stream is valid
-            has_valid_stream = any(stream_results.values())
-            
+
+            if not any(stream.id in stream_results for stream in streams):
+                # None of its streams was due, nothing can have changed
+                continue
+
+            # Check if any stream is valid, the streams not due keep their status
+            has_valid_stream = any(stream_results.get(stream.id, stream.enabled) for stream in streams)
+
             # Update radio status if necessary
             if has_valid_stream != radio.enabled:
-                await self.update_radio_status(radio.id, has_valid_stream)
+                radio_changes[has_valid_stream].append(radio.id)
                 status_text = "enabled" if has_valid_stream else "disabled"
                 self.stdout.write(
                     self.style.SUCCESS(f"Updated radio '{radio.name}' status: {status_text}")
                 )
-                radios_updated += 1
-        
+
+        await self.update_radio_statuses(radio_changes)
+        radios_updated = len(radio_changes[True]) + len(radio_changes[False])
+
+        if radios_updated or self.streams_updated:
+            await self.bump_index_version()
+
         duration = time.time() - start_time
         self.stdout.write(
             self.style.SUCCESS(
                 f"Completed in {duration:.2f} seconds. "
-                f"Updated {radios_updated} out of {total_radios} radios."
+                f"Updated {radios_updated} out of {total_radios} radios, "
+                f"{self.streams_updated} out of {len(stream_results)} checked streams "
+                f"({self.probes_reused} recent probes reused)."
             )
         )
 
     def handle(self, *args, **options):
         batch_size = options['batch_size']
         timeout = options['timeout']
-        
+        self.flush_size = options['flush_size']
+        self.flush_interval = options['flush_interval']
+        self.healthy_interval = timedelta(hours=options['healthy_interval'])
+        self.retry_interval = timedelta(minutes=options['retry_interval'])
+        self.disable_after = max(options['disable_after'], 1)
+
         self.stdout.write(self.style.SUCCESS(f"Starting stream check with batch size: {batch_size}"))
-        
+
         # Run the async handler
-        asyncio.run(self.handle_async(batch_size, timeout))
\ No newline at end of file
+        asyncio.run(self.handle_async(batch_size, timeout, options['per_host'], options['read_bytes'], options['all']))
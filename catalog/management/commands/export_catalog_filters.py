@@ -1,95 +1,95 @@
+import hashlib
 import json
 import os
+import tempfile
 
 from django.core.management.base import BaseCommand
 
 from catalog.models import Radio
+from catalog.registry import get_registry
 from users.models import Language as UserLanguage
 
 
+# Owner language -> file suffix
+BUCKETS = {
+    UserLanguage.ENG: 'eng',
+    UserLanguage.RU: 'ru',
+}
+
+
 class Command(BaseCommand):
     help = 'Export catalog filter options (genres, countries, regions, cities, languages) into JSON files per owner language (eng/ru)'
 
-    def handle(self, *args, **options):
-        # Prepare containers for english and russian
-        out = {
-            'eng': {
-                'genres': set(),
-                'countries': set(),
-                'regions': set(),
-                'cities': set(),
-                'languages': set(),
-            },
-            'ru': {
-                'genres': set(),
-                'countries': set(),
-                'regions': set(),
-                'cities': set(),
-                'languages': set(),
-            }
-        }
-
-        radios = Radio.objects.select_related('country', 'region', 'city', 'user').prefetch_related('genres', 'languages')
+    def distinct_names(self, queryset, owner_language_field, relation, key):
+        """
+        Distinct (owner language, id) pairs of a relation, grouped in the database,
+        named from the reference registry and sorted into the owner language buckets.
+        The english files use the english name when there is one.
+        """
+        registry = get_registry()
+        out = {suffix: set() for suffix in BUCKETS.values()}
+        rows = queryset.filter(
+            **{f'{owner_language_field}__in': list(BUCKETS), f'{relation}__isnull': False}
+        ).values_list(owner_language_field, f'{relation}_id').distinct()
 
-        for radio in radios:
-            user = getattr(radio, 'user', None)
-            if not user:
+        for owner_language, value_id in rows:
+            suffix = BUCKETS[owner_language]
+            row = registry.get(key, value_id)
+            if row is None:
                 continue
+            name = row.name_eng if suffix == 'eng' and row.name_eng else row.name
+            if name:
+                out[suffix].add(name)
+        return out
 
-            # Determine target language bucket based on owner preference
-            if getattr(user, 'language', None) == UserLanguage.ENG:
-                bucket = 'eng'
-            elif getattr(user, 'language', None) == UserLanguage.RU:
-                bucket = 'ru'
-            else:
-                # skip other preferences
-                continue
+    def write_if_changed(self, path, data):
+        """
+        Write the file atomically, unless its content is unchanged: an untouched
+        file keeps its mtime and the downstream caches stay valid.
+        Returns True if the file was written.
+        """
+        content = json.dumps(data, ensure_ascii=False, indent=2).encode('utf-8')
+        try:
+            with open(path, 'rb') as fh:
+                if hashlib.sha256(fh.read()).digest() == hashlib.sha256(content).digest():
+                    return False
+        except FileNotFoundError:
+            pass
 
-            # Genres
-            for g in radio.genres.all():
-                name = g.name_eng if bucket == 'eng' and g.name_eng else g.name
-                if name:
-                    out[bucket]['genres'].add(name)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.catalog_filters.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as fh:
+                fh.write(content)
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        return True
 
-            # Country
-            c = radio.country
-            if c:
-                name = c.name_eng if bucket == 'eng' and c.name_eng else c.name
-                if name:
-                    out[bucket]['countries'].add(name)
-
-            # Region
-            r = radio.region
-            if r:
-                name = r.name_eng if bucket == 'eng' and r.name_eng else r.name
-                if name:
-                    out[bucket]['regions'].add(name)
-
-            # City
-            ci = radio.city
-            if ci:
-                name = ci.name_eng if bucket == 'eng' and ci.name_eng else ci.name
-                if name:
-                    out[bucket]['cities'].add(name)
-
-            # Languages (radio.languages is a M2M to catalog Language model)
-            for lang in radio.languages.all():
-                name = lang.name_eng if bucket == 'eng' and lang.name_eng else lang.name
-                if name:
-                    out[bucket]['languages'].add(name)
+    def handle(self, *args, **options):
+        radios = Radio.objects.all()
+        links = {
+            'genres': (Radio.genres.through.objects.all(), 'radio__user__language', 'genre'),
+            'countries': (radios, 'user__language', 'country'),
+            'regions': (radios, 'user__language', 'region'),
+            'cities': (radios, 'user__language', 'city'),
+            'languages': (Radio.languages.through.objects.all(), 'radio__user__language', 'language'),
+        }
 
         # Ensure output directory is current working directory
         cwd = os.getcwd()
 
-        for bucket_key, buckets in out.items():
-            suffix = 'eng' if bucket_key == 'eng' else 'ru'
-            for filter_name, values in buckets.items():
+        for filter_name, (queryset, owner_language_field, relation) in links.items():
+            buckets = self.distinct_names(queryset, owner_language_field, relation, filter_name)
+            for suffix, values in buckets.items():
                 filename = f"{filter_name}_{suffix}.json"
                 path = os.path.join(cwd, filename)
                 data = sorted(values)
                 try:
-                    with open(path, 'w', encoding='utf-8') as fh:
-                        json.dump(data, fh, ensure_ascii=False, indent=2)
-                    self.stdout.write(self.style.SUCCESS(f"Wrote {path} ({len(data)} items)"))
+                    if self.write_if_changed(path, data):
+                        self.stdout.write(self.style.SUCCESS(f"Wrote {path} ({len(data)} items)"))
+                    else:
+                        self.stdout.write(f"Unchanged {path} ({len(data)} items)")
                 except Exception as e:
                     self.stderr.write(self.style.ERROR(f"Failed to write {path}: {e}"))
@@ -1,83 +1,163 @@
 import json
+import os
+import tempfile
 
-from django.core.management.base import BaseCommand
-from catalog.models import Radio
+from django.core.management.base import BaseCommand, CommandError
 from django.core.serializers.json import DjangoJSONEncoder
-from django.db.models import F, ExpressionWrapper, FloatField, Case, When, Value
+from django.db.models import Prefetch, Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime, parse_date
+
+from catalog.models import Radio, Stream, Vote
+from catalog.registry import get_registry
+
 
 class Command(BaseCommand):
-    help = 'Export all Radio models with related Stream, Country, Region, City, Genre to a JSON file.'
+    help = (
+        'Export all Radio models with related Stream, Country, Region, City, Genre to a JSON file. '
+        'Radios are streamed in chunks and the file is replaced atomically; '
+        'with --since only the radios modified after the timestamp (their streams and votes included) are exported, disabled ones included '
+        'so that the consumer can drop them.'
+    )
 
-    def handle(self, *args, **options):
-        radios = Radio.objects.select_related(
-            'country', 'region', 'city', 'user'
-        ).prefetch_related(
-            'genres', 'languages', 'streams'
-        ).filter(enabled=True)
-        radios = radios.annotate(
-            rating=Case(
-                When(total_votes=0, then=Value(0, output_field=FloatField())),
-                When(total_score=0, then=Value(0, output_field=FloatField())),
-                default=ExpressionWrapper(
-                    F('total_score') * 1.0 / F('total_votes'),
-                    output_field=FloatField()
-                ),
-                output_field=FloatField()
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--output',
+            default='exported_radios.json',
+            help='Output file (default: exported_radios.json)'
+        )
+        parser.add_argument(
+            '--format',
+            choices=['json', 'ndjson'],
+            default='json',
+            help='A JSON array, or one JSON document per line (default: json)'
+        )
+        parser.add_argument(
+            '--since',
+            help='Only export the radios modified, or whose streams or votes changed, after this ISO date/timestamp'
+        )
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=500,
+            help='Number of radios fetched per query (default: 500)'
+        )
+
+    def parse_since(self, value):
+        since = parse_datetime(value)
+        if since is None:
+            day = parse_date(value)
+            if day is None:
+                raise CommandError(f"Invalid --since value: {value}")
+            since = timezone.datetime(day.year, day.month, day.day)
+        if timezone.is_aware(timezone.now()) and timezone.is_naive(since):
+            since = timezone.make_aware(since)
+        return since
+
+    def get_queryset(self, since):
+        # Countries, regions and cities come from the reference registry, not from joins
+        radios = Radio.objects.prefetch_related(
+            'genres', 'languages',
+            Prefetch('streams', queryset=Stream.objects.filter(enabled=True).order_by('-bitrate'))
+        )
+        if since is None:
+            radios = radios.filter(enabled=True)
+        else:
+            # Stream edits and votes do not touch the radio row
+            radios = radios.filter(
+                Q(modified__gt=since) |
+                Q(id__in=Stream.objects.filter(modified__gt=since).values('radio_id')) |
+                Q(id__in=Vote.objects.filter(created__gt=since).values('radio_id'))
             )
-        ).order_by('-rating', 'name')
-        data = []
-        for radio in radios:
-            streams = radio.streams.filter(enabled=True).order_by('-bitrate')
-            default_stream = next((stream.stream_url for stream in streams if stream.stream_url.startswith("https:")), None)
-            data.append({
-                'id': radio.id,
-                'name': radio.name,
-                'slug': radio.slug,
-                'description': radio.description,
-                'enabled': radio.enabled,
-                'website_url': radio.website_url,
-                'logo': radio.logo.url if radio.logo else None,
-                'country': {
-                    'id': radio.country.id,
-                    'iso2': radio.country.iso2,
-                    'name': radio.country.name,
-                    'name_eng': radio.country.name_eng,
-                } if radio.country else None,
-                'region': {
-                    'id': radio.region.id,
-                    'name': radio.region.name,
-                    'name_eng': radio.region.name_eng,
-                } if radio.region else None,
-                'city': {
-                    'id': radio.city.id,
-                    'name': radio.city.name,
-                    'name_eng': radio.city.name_eng,
-                } if radio.city else None,
-                'genres': [
-                    {'id': genre.id, 'name': genre.name, 'name_eng': genre.name_eng}
-                    for genre in radio.genres.all()
-                ],
-                'languages': [
-                    {'id': lang.id, 'name': lang.name, 'name_eng': lang.name_eng}
-                    for lang in radio.languages.all()
-                ],
-                'streams': [
-                    {
-                        'id': stream.id,
-                        'stream_url': stream.stream_url,
-                        'audio_format': stream.audio_format,
-                        'bitrate': stream.bitrate,
-                        'server_type': stream.server_type,
-                    }
-                    for stream in streams
-                ],
-                'total_votes': radio.total_votes,
-                'total_score': radio.total_score,
-                'user_id': radio.user.id,
-                'rating': radio.rating,
-                'created': radio.created,
-                'default_stream': default_stream,
-            })
-        with open('exported_radios.json', 'w', encoding='utf-8') as f:
-            json.dump(data, f, cls=DjangoJSONEncoder, ensure_ascii=False, indent=2)
-        self.stdout.write(self.style.SUCCESS(f'Exported {len(data)} radios to exported_radios.json'))
+        return radios.order_by('-rating', 'name')
+
+    def radio_to_dict(self, radio):
+        streams = radio.streams.all()
+        country = self.registry.get('countries', radio.country_id)
+        region = self.registry.get('regions', radio.region_id)
+        city = self.registry.get('cities', radio.city_id)
+        default_stream = next((stream.stream_url for stream in streams if stream.stream_url.startswith("https:")), None)
+        return {
+            'id': radio.id,
+            'name': radio.name,
+            'slug': radio.slug,
+            'description': radio.description,
+            'enabled': radio.enabled,
+            'website_url': radio.website_url,
+            'logo': radio.logo.url if radio.logo else None,
+            'country': {
+                'id': country.id,
+                'iso2': country.iso2,
+                'name': country.name,
+                'name_eng': country.name_eng,
+            } if country else None,
+            'region': {
+                'id': region.id,
+                'name': region.name,
+                'name_eng': region.name_eng,
+            } if region else None,
+            'city': {
+                'id': city.id,
+                'name': city.name,
+                'name_eng': city.name_eng,
+            } if city else None,
+            'genres': [
+                {'id': genre.id, 'name': genre.name, 'name_eng': genre.name_eng}
+                for genre in radio.genres.all()
+            ],
+            'languages': [
+                {'id': lang.id, 'name': lang.name, 'name_eng': lang.name_eng}
+                for lang in radio.languages.all()
+            ],
+            'streams': [
+                {
+                    'id': stream.id,
+                    'stream_url': stream.stream_url,
+                    'audio_format': stream.audio_format,
+                    'bitrate': stream.bitrate,
+                    'server_type': stream.server_type,
+                }
+                for stream in streams
+            ],
+            'total_votes': radio.total_votes,
+            'total_score': radio.total_score,
+            'user_id': radio.user_id,
+            'rating': radio.rating,
+            'created': radio.created,
+            'modified': radio.modified,
+            'default_stream': default_stream,
+        }
+
+    def handle(self, *args, **options):
+        output = options['output']
+        ndjson = options['format'] == 'ndjson'
+        since = self.parse_since(options['since']) if options['since'] else None
+        encoder = DjangoJSONEncoder(ensure_ascii=False, separators=(',', ':'))
+        self.registry = get_registry()
+
+        # Write next to the target and rename: readers never see a half written file
+        directory = os.path.dirname(os.path.abspath(output))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.export_radios.', suffix='.tmp')
+        count = 0
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                if not ndjson:
+                    f.write('[')
+                for radio in self.get_queryset(since).iterator(chunk_size=options['chunk_size']):
+                    if ndjson:
+                        f.write(encoder.encode(self.radio_to_dict(radio)))
+                        f.write('\n')
+                    else:
+                        if count:
+                            f.write(',')
+                        f.write(encoder.encode(self.radio_to_dict(radio)))
+                    count += 1
+                if not ndjson:
+                    f.write(']')
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, output)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+        self.stdout.write(self.style.SUCCESS(f'Exported {count} radios to {output}'))
@@ -0,0 +1,337 @@
+import csv
+import json
+import os
+import time
+from collections import defaultdict
+
+from PIL import Image
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand, CommandError
+from django.db import IntegrityError, transaction
+from slugify import slugify
+
+from catalog.models import Radio, Stream, IndexVersion, VerificationStatus
+from catalog.registry import get_registry
+from mobile_application.models import ServerType
+from users.models import User
+
+
+# Multiple values in one CSV cell: "Rock|Pop"
+CSV_SEPARATOR = '|'
+
+AUDIO_FORMATS = {value for value, _ in Stream.AUDIO_FORMAT_CHOICES}
+SERVER_TYPES = {value for value, _ in ServerType.choices}
+
+LOGO_DIR = Radio._meta.get_field('logo').upload_to
+
+
+def check_logo(path):
+    """
+    Check a logo the way validate_logo_image does, only its header is read.
+    The logo is stored as is, its renditions are made by the render_logos command
+    like for any new logo. Returns the error, empty if valid
+    """
+    try:
+        with Image.open(path) as img:
+            width, height = img.size
+    except Exception as e:
+        return f"Invalid image file: {e}"
+    if width != height:
+        return "The logo must be a square image."
+    if width < 250:
+        return "The minimum size for the logo is 250x250 pixels."
+    return ''
+
+
+class Command(BaseCommand):
+    help = (
+        'Import radios from an NDJSON (as written by export_radios --format ndjson) or CSV file. '
+        'Radios are inserted in chunks with bulk queries, logos are rendered by render_logos. '
+        'CSV columns: name, description, website_url, logo, country (ISO2), region, city, genres, languages, '
+        f'stream_url, audio_format, bitrate, server_type; several values are separated by "{CSV_SEPARATOR}"'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='NDJSON or CSV file')
+        parser.add_argument(
+            '--format',
+            choices=['ndjson', 'csv'],
+            help='Input format (default: from the file extension)'
+        )
+        parser.add_argument(
+            '--user',
+            required=True,
+            help='Owner of the imported radios, id or email'
+        )
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=1000,
+            help='Number of radios inserted per chunk (default: 1000)'
+        )
+        parser.add_argument(
+            '--logo-dir',
+            help='Directory of the logo files with a relative path (default: the directory of the input file)'
+        )
+        parser.add_argument(
+            '--verify',
+            action='store_true',
+            help='Import the radios disabled and pending verification, for the verify_radios command'
+        )
+
+
+    def read_ndjson(self, path):
+        with open(path, encoding='utf-8') as f:
+            for line_number, line in enumerate(f, 1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    yield line_number, json.loads(line)
+                except json.JSONDecodeError as e:
+                    self.stderr.write(self.style.ERROR(f"Line {line_number}: invalid JSON ({e})"))
+
+    def read_csv(self, path):
+        def split(value):
+            return [item.strip() for item in (value or '').split(CSV_SEPARATOR) if item.strip()]
+
+        with open(path, encoding='utf-8', newline='') as f:
+            for line_number, row in enumerate(csv.DictReader(f), 2):
+                urls = split(row.get('stream_url'))
+                formats = split(row.get('audio_format'))
+                bitrates = split(row.get('bitrate'))
+                server_types = split(row.get('server_type'))
+                row['streams'] = [
+                    {
+                        'stream_url': url,
+                        'audio_format': formats[i] if i < len(formats) else '',
+                        'bitrate': bitrates[i] if i < len(bitrates) else '',
+                        'server_type': server_types[i] if i < len(server_types) else '',
+                    }
+                    for i, url in enumerate(urls)
+                ]
+                row['genres'] = split(row.get('genres'))
+                row['languages'] = split(row.get('languages'))
+                yield line_number, row
+
+    def chunks(self, records, size):
+        chunk = []
+        for record in records:
+            chunk.append(record)
+            if len(chunk) >= size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+
+    def find_in_country(self, key, country_id, name):
+        """Id of the region or city of the country named so, None if there is none"""
+        for row_id in self.registry.ids(key, name):
+            if self.registry.get(key, row_id).country_id == country_id:
+                return row_id
+        return None
+
+    def reference_name(self, value, *keys):
+        """A reference is a name, or a dict as written by export_radios"""
+        if isinstance(value, dict):
+            for key in keys:
+                if value.get(key):
+                    return str(value[key]).strip().lower()
+            return ''
+        return str(value or '').strip().lower()
+
+
+    def build_radio(self, record):
+        """Returns (Radio, [Stream], genre ids, language ids, logo path), raises ValueError"""
+        name = str(record.get('name') or '').strip()
+        if not name:
+            raise ValueError("no name")
+
+        country = self.reference_name(record.get('country'), 'iso2', 'name_eng', 'name')
+        country_id = self.registry.iso2.get(country) or next(iter(self.registry.ids('countries', country)), None)
+        if country_id is None:
+            raise ValueError(f"unknown country {record.get('country')!r}")
+        region_id = self.find_in_country('regions', country_id, self.reference_name(record.get('region'), 'name_eng', 'name'))
+        city_id = self.find_in_country('cities', country_id, self.reference_name(record.get('city'), 'name_eng', 'name'))
+
+        streams = []
+        for stream in record.get('streams') or []:
+            url = str(stream.get('stream_url') or '').strip()
+            if not (url.startswith('http://') or url.startswith('https://')):
+                raise ValueError(f"invalid stream URL {url!r}")
+            audio_format = str(stream.get('audio_format') or '').lower()
+            server_type = str(stream.get('server_type') or '').lower()
+            try:
+                bitrate = max(int(stream.get('bitrate') or 0), 0)
+            except (TypeError, ValueError):
+                bitrate = 0
+            streams.append(Stream(
+                stream_url=url,
+                audio_format=audio_format if audio_format in AUDIO_FORMATS else 'other',
+                bitrate=bitrate,
+                server_type=server_type if server_type in SERVER_TYPES else ServerType.SHOUTCAST,
+                enabled=not self.verify,
+            ))
+        if not streams:
+            raise ValueError("no streams")
+
+        genre_ids = {
+            genre_id
+            for genre in record.get('genres') or []
+            for genre_id in self.registry.ids('genres', self.reference_name(genre, 'name_eng', 'name'))[:1]
+        }
+        language_ids = {
+            language_id
+            for language in record.get('languages') or []
+            for language_id in self.registry.ids('languages', self.reference_name(language, 'name_eng', 'name'))[:1]
+        }
+
+        radio = Radio(
+            name=name[:200],
+            description=str(record.get('description') or ''),
+            website_url=str(record.get('website_url') or '').strip(),
+            country_id=country_id,
+            region_id=region_id,
+            city_id=city_id,
+            user=self.user,
+            enabled=not self.verify,
+            verification_status=VerificationStatus.PENDING if self.verify else VerificationStatus.VERIFIED,
+        )
+        radio.update_rating()
+
+        logo = str(record.get('logo') or '').strip()
+        if logo and not os.path.isabs(logo):
+            logo = os.path.join(self.logo_dir, logo)
+        return radio, streams, genre_ids, language_ids, logo
+
+
+    def load_slugs(self):
+        """Every slug taken, in one query; the allocation then needs no query per radio"""
+        self.taken_slugs = set(Radio.objects.exclude(slug=None).values_list('slug', flat=True).iterator())
+        self.next_suffix = defaultdict(lambda: 1)
+
+    def allocate_slug(self, name):
+        """Same slugs as Radio._generate_unique_slug: base, base-1, base-2..."""
+        base_slug = slugify(name) or "radio"
+        slug = base_slug
+        while slug in self.taken_slugs:
+            slug = f"{base_slug}-{self.next_suffix[base_slug]}"
+            self.next_suffix[base_slug] += 1
+        self.taken_slugs.add(slug)
+        return slug
+
+
+    def save_logos(self, radios, logos):
+        """Check the logos of the chunk and copy the valid ones to the storage. Returns the stored names"""
+        stored = []
+        for radio, path in zip(radios, logos):
+            if not path:
+                continue
+            error = check_logo(path)
+            if error:
+                self.logo_errors += 1
+                self.stderr.write(self.style.WARNING(f"Logo {path}: {error}"))
+                continue
+            with open(path, 'rb') as f:
+                radio.logo.name = default_storage.save(os.path.join(LOGO_DIR, os.path.basename(path)), File(f))
+            stored.append(radio.logo.name)
+        return stored
+
+    @transaction.atomic
+    def insert_chunk(self, radios, streams, genres, languages):
+        Radio.objects.bulk_create(radios)
+        if any(radio.pk is None for radio in radios):
+            # MySQL does not return the ids of a bulk insert, the slugs are unique
+            ids = dict(Radio.objects.filter(slug__in=[radio.slug for radio in radios]).values_list('slug', 'id'))
+            for radio in radios:
+                radio.pk = ids[radio.slug]
+
+        for radio, radio_streams in zip(radios, streams):
+            for stream in radio_streams:
+                stream.radio_id = radio.pk
+        Stream.objects.bulk_create([stream for radio_streams in streams for stream in radio_streams])
+        Radio.genres.through.objects.bulk_create([
+            Radio.genres.through(radio_id=radio.pk, genre_id=genre_id)
+            for radio, genre_ids in zip(radios, genres) for genre_id in genre_ids
+        ])
+        Radio.languages.through.objects.bulk_create([
+            Radio.languages.through(radio_id=radio.pk, language_id=language_id)
+            for radio, language_ids in zip(radios, languages) for language_id in language_ids
+        ])
+
+    def import_chunk(self, chunk):
+        radios, streams, genres, languages, logos = [], [], [], [], []
+        for line_number, record in chunk:
+            try:
+                radio, radio_streams, genre_ids, language_ids, logo = self.build_radio(record)
+            except (ValueError, AttributeError, TypeError) as e:
+                self.skipped += 1
+                self.stderr.write(self.style.WARNING(f"Line {line_number}: skipped, {e}"))
+                continue
+            radios.append(radio)
+            streams.append(radio_streams)
+            genres.append(genre_ids)
+            languages.append(language_ids)
+            logos.append(logo)
+        if not radios:
+            return
+
+        stored = self.save_logos(radios, logos)
+        try:
+            self.insert_radios(radios, streams, genres, languages)
+        except BaseException:
+            # Nothing refers to the logos of a chunk that was not inserted
+            for name in stored:
+                default_storage.delete(name)
+            raise
+        self.imported += len(radios)
+
+    def insert_radios(self, radios, streams, genres, languages):
+        for radio in radios:
+            radio.slug = self.allocate_slug(radio.name)
+        try:
+            self.insert_chunk(radios, streams, genres, languages)
+        except IntegrityError:
+            # A radio created meanwhile took one of the slugs: reload them and retry once
+            self.load_slugs()
+            for radio in radios:
+                radio.pk = None
+                radio.slug = self.allocate_slug(radio.name)
+            self.insert_chunk(radios, streams, genres, languages)
+
+    def get_user(self, value):
+        lookup = {'pk': value} if value.isdigit() else {'email': value}
+        try:
+            return User.objects.get(**lookup)
+        except User.DoesNotExist:
+            raise CommandError(f"User {value} not found")
+
+    def handle(self, *args, **options):
+        path = options['path']
+        if not os.path.isfile(path):
+            raise CommandError(f"File {path} not found")
+        input_format = options['format'] or ('csv' if path.lower().endswith('.csv') else 'ndjson')
+        self.user = self.get_user(options['user'])
+        self.logo_dir = options['logo_dir'] or os.path.dirname(os.path.abspath(path))
+        self.verify = options['verify']
+        self.imported = self.skipped = self.logo_errors = 0
+
+        start_time = time.time()
+        self.registry = get_registry()
+        self.load_slugs()
+        records = self.read_csv(path) if input_format == 'csv' else self.read_ndjson(path)
+
+        for chunk in self.chunks(records, max(options['chunk_size'], 1)):
+            self.import_chunk(chunk)
+            self.stdout.write(f"{self.imported} radios imported...")
+
+        if self.imported:
+            # Bulk inserts send no signals, let the web workers refresh their catalog indexes
+            IndexVersion.bump(IndexVersion.RADIOS)
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Imported {self.imported} radios in {time.time() - start_time:.2f} seconds, "
+            f"skipped {self.skipped} records, {self.logo_errors} logos failed"
+        ))
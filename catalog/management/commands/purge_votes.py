@@ -0,0 +1,66 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from django.utils import timezone
+
+from catalog.models import Vote
+
+
+class Command(BaseCommand):
+    help = (
+        'Delete the expired votes (older than CATALOG_VOTE_TTL) in small chunks, '
+        'so that the votes coming in are never blocked for long. Runs once, or under supervisor with --loop'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=1000,
+            help='Number of votes deleted per query (default: 1000)'
+        )
+        parser.add_argument(
+            '--pause',
+            type=float,
+            default=0,
+            help='Seconds to sleep between the chunks (default: 0)'
+        )
+        parser.add_argument(
+            '--loop',
+            action='store_true',
+            help='Keep running and purge again every --interval seconds'
+        )
+        parser.add_argument(
+            '--interval',
+            type=float,
+            default=60 * 60,
+            help='Seconds to wait between the purges, with --loop (default: 3600)'
+        )
+
+    def purge(self, chunk_size, pause):
+        """Returns the number of votes deleted"""
+        cutoff = timezone.now() - timezone.timedelta(seconds=Vote.ttl())
+        expired = Vote.objects.filter(created__lt=cutoff)
+        total = 0
+        while True:
+            # Range scan of the created index, then a delete by primary key
+            ids = list(expired.order_by('created').values_list('id', flat=True)[:chunk_size])
+            if not ids:
+                break
+            total += Vote.objects.filter(id__in=ids).delete()[0]
+            if len(ids) < chunk_size:
+                break
+            if pause:
+                time.sleep(pause)
+        return total
+
+    def handle(self, *args, **options):
+        chunk_size = max(options['chunk_size'], 1)
+        while True:
+            close_old_connections()
+            total = self.purge(chunk_size, options['pause'])
+            self.stdout.write(self.style.SUCCESS(f"Deleted {total} expired votes"))
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
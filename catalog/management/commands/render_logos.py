@@ -0,0 +1,164 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from catalog.logos import (
+    render_logo, rendition_name, source_digest, is_rendition, RENDITION_FORMATS, LOGO_FORMAT, LOGO_SIZE
+)
+from catalog.models import Radio, IndexVersion
+
+
+class Command(BaseCommand):
+    help = (
+        'Render the 64/128/256/512 px WebP and PNG renditions of the radio logos that have none '
+        '(new or changed logos) in a process pool, the 512 px PNG then stands for the logo itself'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=os.cpu_count(),
+            help='Number of rendering processes (default: number of CPUs)'
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=100,
+            help='Number of logos rendered per batch (default: 100)'
+        )
+        parser.add_argument(
+            '--all',
+            action='store_true',
+            help='Render every logo again, e.g. after a change of the rendition sizes'
+        )
+        parser.add_argument(
+            '--loop',
+            action='store_true',
+            help='Keep running and wait for new logos'
+        )
+        parser.add_argument(
+            '--interval',
+            type=float,
+            default=10,
+            help='Seconds to wait between polls when nothing is pending, with --loop (default: 10)'
+        )
+
+    def get_pending_radios(self, batch_size, after_id):
+        radios = Radio.objects.exclude(logo='').filter(id__gt=after_id)
+        if not self.render_all:
+            radios = radios.filter(logo_renditions={})
+        return list(radios.order_by('id').only('id', 'logo')[:batch_size])
+
+    def save_renditions(self, radio, renditions):
+        """
+        The logo is replaced by its LOGO_SIZE rendition, if the upload was that large
+        and it is not a rendition already (--all). The logo may have been replaced
+        during the rendering: the renditions then stay empty.
+        Returns 1 if the radio was updated
+        """
+        logo = radio.logo.name
+        capped = renditions.get(LOGO_FORMAT, {}).get(str(LOGO_SIZE))
+        if capped and not is_rendition(logo):
+            logo = capped
+        return Radio.objects.filter(id=radio.id, logo=radio.logo.name).update(
+            logo=logo, logo_renditions={'source': logo, **renditions}
+        )
+
+    def fail(self, radio, error):
+        """Record the error, the logo is not tried again until it is replaced"""
+        self.stderr.write(self.style.WARNING(f"Radio {radio.id}: {radio.logo.name} {error}"))
+        self.failed += self.save_renditions(radio, {'error': str(error)[:255]})
+
+    def read_logos(self, radios):
+        """{radio: (digest, content)}; the storage is read here, the pool only sees bytes"""
+        logos = {}
+        for radio in radios:
+            try:
+                with default_storage.open(radio.logo.name, 'rb') as f:
+                    content = f.read()
+            except OSError as e:
+                self.fail(radio, e)
+                continue
+            logos[radio] = (source_digest(content), content)
+        return logos
+
+    def store(self, digest, images):
+        """Save the renditions that are not stored yet. Returns {format: {size: name}}"""
+        renditions = {fmt: {} for fmt in RENDITION_FORMATS}
+        for (fmt, size), content in images.items():
+            name = rendition_name(digest, size, fmt)
+            # Content addressed: an existing file is this very rendition
+            if not default_storage.exists(name):
+                default_storage.save(name, ContentFile(content))
+            renditions[fmt][str(size)] = name
+        return renditions
+
+    def render_batch(self, pool, radios):
+        logos = self.read_logos(radios)
+        # One job per distinct image
+        jobs = {digest: content for digest, content in logos.values()}
+        digests = list(jobs)
+        rendered = {}
+        for digest, result in zip(digests, pool.map(self.safe_render, [jobs[digest] for digest in digests])):
+            rendered[digest] = result if isinstance(result, Exception) else self.store(digest, result)
+
+        updated = 0
+        for radio, (digest, _) in logos.items():
+            if isinstance(rendered[digest], Exception):
+                self.fail(radio, rendered[digest])
+            else:
+                updated += self.save_renditions(radio, rendered[digest])
+        return updated
+
+    @staticmethod
+    def safe_render(content):
+        try:
+            return render_logo(content)
+        except Exception as e:
+            return e
+
+    def publish(self):
+        """Queryset updates send no signals, the cached catalog pages must get the srcset"""
+        if self.unpublished:
+            IndexVersion.bump(IndexVersion.RADIOS)
+            self.unpublished = 0
+
+    def handle(self, *args, **options):
+        self.render_all = options['all']
+        self.failed = 0
+        # Renditions saved since the last bump: once per pass, not per batch, which
+        # would throw the catalog indexes and the cached pages away batch after batch
+        self.unpublished = 0
+        total = 0
+        last_id = 0
+        try:
+            with ProcessPoolExecutor(max_workers=max(options['workers'] or 1, 1)) as pool:
+                while True:
+                    close_old_connections()
+                    radios = self.get_pending_radios(options['batch_size'], last_id)
+                    if radios:
+                        start_time = time.time()
+                        updated = self.render_batch(pool, radios)
+                        total += updated
+                        self.unpublished += updated
+                        last_id = radios[-1].id
+                        self.stdout.write(self.style.SUCCESS(
+                            f"Rendered {updated} of {len(radios)} logos in {time.time() - start_time:.2f} seconds"
+                        ))
+                    elif options['loop'] and not self.render_all:
+                        self.publish()
+                        last_id = 0
+                        time.sleep(options['interval'])
+                    else:
+                        break
+        finally:
+            # The renditions saved before a crash or Ctrl-C are published too
+            self.publish()
+
+        self.stdout.write(self.style.SUCCESS(f"Completed, {total} logos rendered, {self.failed} failed"))
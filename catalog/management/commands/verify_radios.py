@@ -0,0 +1,161 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, transaction
+from django.db.models import Prefetch
+from django.utils import timezone
+
+from catalog.models import Radio, Stream, IndexVersion, VerificationStatus
+from catalog.probes import run_probe, check_website, get_fresh_probes, save_probes, normalize_url, error_code
+
+
+class Command(BaseCommand):
+    help = (
+        'Verify the website and stream URLs of the radios saved with CATALOG_DEFERRED_VALIDATION: '
+        'enable a new radio and its working streams, or record the errors for the dashboard'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=10,
+            help='Number of URLs checked concurrently (default: 10)'
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=50,
+            help='Number of pending radios verified per batch (default: 50)'
+        )
+        parser.add_argument(
+            '--timeout',
+            type=int,
+            default=5,
+            help='Timeout in seconds for each URL check (default: 5)'
+        )
+        parser.add_argument(
+            '--loop',
+            action='store_true',
+            help='Keep running and wait for new submissions'
+        )
+        parser.add_argument(
+            '--interval',
+            type=float,
+            default=5,
+            help='Seconds to wait between polls when nothing is pending, with --loop (default: 5)'
+        )
+
+    def get_pending_radios(self, batch_size):
+        return list(
+            Radio.objects.filter(verification_status__in=(VerificationStatus.PENDING, VerificationStatus.PENDING_EDIT))
+            .order_by('modified')
+            .prefetch_related(Prefetch('streams', queryset=Stream.objects.order_by('id')))[:batch_size]
+        )
+
+    def check_urls(self, radios, workers, timeout):
+        """
+        Check all URLs of the batch at once in a thread pool, reusing the fresh stream probes.
+        Returns ({normalized stream url: StreamProbe}, {website url: error code})
+        """
+        stream_urls = {normalize_url(stream.stream_url): stream.stream_url
+                       for radio in radios for stream in radio.streams.all()}
+        probes = get_fresh_probes(stream_urls)
+        missing = [url for key, url in stream_urls.items() if key not in probes]
+        websites = list({radio.website_url for radio in radios if radio.website_url})
+
+        # The threads only go over the network, the database is used from this thread
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            new_probes = pool.map(lambda url: run_probe(url, timeout), missing)
+            website_errors = dict(zip(websites, pool.map(lambda url: check_website(url, timeout), websites)))
+            new_probes = list(new_probes)
+
+        save_probes(new_probes)
+        probes.update((probe.url, probe) for probe in new_probes)
+        return probes, website_errors
+
+    def verification_result(self, radio, probes, website_errors):
+        """Returns (errors keyed like the serializer errors, {stream id: enabled})"""
+        errors = {}
+        if radio.website_url and website_errors[radio.website_url]:
+            errors['website_url'] = [website_errors[radio.website_url]]
+
+        streams = {}
+        stream_errors = []
+        for stream in radio.streams.all():
+            probe = probes[normalize_url(stream.stream_url)]
+            streams[stream.id] = probe.ok
+            stream_errors.append({} if probe.ok else {'stream_url': [error_code(probe)]})
+        if any(stream_errors):
+            errors['streams'] = stream_errors
+        return errors, streams
+
+    @transaction.atomic
+    def save_result(self, radio, errors, streams):
+        """
+        A first submission is enabled if it passed. An edit of a verified radio leaves
+        Radio.enabled as it was, as a rejected edit would with the synchronous validation:
+        the errors are recorded and the new streams that failed stay disabled.
+        Returns False if the radio was edited during the check: it is left
+        pending and verified again with its new URLs
+        """
+        if radio.verification_status == VerificationStatus.PENDING_EDIT:
+            # The radio stays watched by check_streams, which also owns its streams in service:
+            # only the working ones are enabled, the new streams were created disabled
+            changes = {'verification_status': VerificationStatus.VERIFIED}
+            streams = {stream_id: True for stream_id, ok in streams.items() if ok}
+        else:
+            changes = {
+                'verification_status': VerificationStatus.FAILED if errors else VerificationStatus.VERIFIED,
+                'enabled': not errors and any(streams.values()),
+            }
+        updated = Radio.objects.filter(
+            pk=radio.pk, modified=radio.modified, verification_status=radio.verification_status
+        ).update(verification_errors=errors, modified=timezone.now(), **changes)
+        if not updated:
+            return False
+        for enabled in (True, False):
+            ids = [stream_id for stream_id, ok in streams.items() if ok == enabled]
+            if ids:
+                Stream.objects.filter(radio=radio, id__in=ids).update(enabled=enabled)
+        return True
+
+    def verify_batch(self, radios, workers, timeout):
+        probes, website_errors = self.check_urls(radios, workers, timeout)
+        verified = 0
+        for radio in radios:
+            errors, streams = self.verification_result(radio, probes, website_errors)
+            if not self.save_result(radio, errors, streams):
+                self.stdout.write(self.style.WARNING(f"Radio '{radio.name}' changed during the check, verifying it again"))
+                continue
+            verified += 1
+            if errors:
+                self.stdout.write(self.style.WARNING(f"Radio '{radio.name}' failed verification: {errors}"))
+            else:
+                self.stdout.write(self.style.SUCCESS(f"Radio '{radio.name}' verified"))
+
+        if verified:
+            # Queryset updates send no signals, let the web workers refresh their catalog indexes
+            IndexVersion.bump(IndexVersion.RADIOS)
+        return verified
+
+    def handle(self, *args, **options):
+        workers = max(options['workers'], 1)
+        total = 0
+        while True:
+            close_old_connections()
+            radios = self.get_pending_radios(options['batch_size'])
+            if radios:
+                start_time = time.time()
+                verified = self.verify_batch(radios, workers, options['timeout'])
+                total += verified
+                self.stdout.write(self.style.SUCCESS(
+                    f"Verified {verified} of {len(radios)} pending radios in {time.time() - start_time:.2f} seconds"
+                ))
+            elif options['loop']:
+                time.sleep(options['interval'])
+            else:
+                break
+
+        self.stdout.write(self.style.SUCCESS(f"Completed, {total} radios verified"))
@@ -0,0 +1,53 @@
+# Generated by Django 4.2.5 on 2026-10-18 10:57
+
+from django.db import migrations, models
+from django.db.models import Case, F, FloatField, Value, When
+
+
+def fill_ratings(apps, schema_editor):
+    Radio = apps.get_model("catalog", "Radio")
+    # Same prior as catalog.models.RATING_PRIOR_VOTES / RATING_PRIOR_MEAN at the time of writing
+    prior_votes, prior_mean = 5, 3.0
+    Radio.objects.update(
+        rating=Case(
+            When(total_votes=0, then=Value(0.0)),
+            default=F("total_score") * 1.0 / F("total_votes"),
+            output_field=FloatField(),
+        ),
+        weighted_rating=(Value(prior_mean * prior_votes) + F("total_score"))
+        / (Value(float(prior_votes)) + F("total_votes")),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("catalog", "0013_indexversion"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="radio",
+            name="rating",
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddField(
+            model_name="radio",
+            name="weighted_rating",
+            field=models.FloatField(default=3.0),
+        ),
+        migrations.AddIndex(
+            model_name="radio",
+            index=models.Index(
+                fields=["enabled", "rating", "id"], name="catalog_radio_rating_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="radio",
+            index=models.Index(
+                fields=["enabled", "weighted_rating", "id"],
+                name="catalog_radio_weighted_idx",
+            ),
+        ),
+        migrations.RunPython(fill_ratings, migrations.RunPython.noop),
+    ]
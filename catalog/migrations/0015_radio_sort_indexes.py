@@ -0,0 +1,25 @@
+# Generated by Django 4.2.5 on 2026-10-18 10:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("catalog", "0014_radio_rating"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="radio",
+            index=models.Index(
+                fields=["enabled", "total_votes", "id"], name="catalog_radio_votes_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="radio",
+            index=models.Index(
+                fields=["enabled", "created", "id"], name="catalog_radio_created_idx"
+            ),
+        ),
+    ]
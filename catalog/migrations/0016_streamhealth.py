@@ -0,0 +1,47 @@
+# Generated by Django 4.2.5 on 2026-10-18 11:03
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("catalog", "0015_radio_sort_indexes"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="StreamHealth",
+            fields=[
+                (
+                    "stream",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        primary_key=True,
+                        related_name="health",
+                        serialize=False,
+                        to="catalog.stream",
+                    ),
+                ),
+                ("last_checked", models.DateTimeField(blank=True, null=True)),
+                ("last_ok", models.DateTimeField(blank=True, null=True)),
+                ("consecutive_failures", models.PositiveIntegerField(default=0)),
+                (
+                    "ttfb",
+                    models.PositiveIntegerField(
+                        blank=True, null=True, verbose_name="Time to first byte (ms)"
+                    ),
+                ),
+                ("content_type", models.CharField(blank=True, max_length=100)),
+                ("error", models.CharField(blank=True, max_length=255)),
+                (
+                    "next_check",
+                    models.DateTimeField(blank=True, db_index=True, null=True),
+                ),
+            ],
+            options={
+                "verbose_name_plural": "stream health",
+            },
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 4.2.5 on 2026-10-18 11:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("catalog", "0016_streamhealth"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="StreamProbe",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("url", models.URLField(unique=True)),
+                ("ok", models.BooleanField(default=False)),
+                ("content_type", models.CharField(blank=True, max_length=100)),
+                ("error", models.CharField(blank=True, max_length=255)),
+                ("checked_at", models.DateTimeField()),
+            ],
+        ),
+    ]
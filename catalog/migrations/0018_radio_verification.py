@@ -0,0 +1,31 @@
+# Generated by Django 4.2.5 on 2026-10-18 11:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("catalog", "0017_streamprobe"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="radio",
+            name="verification_errors",
+            field=models.JSONField(blank=True, default=dict),
+        ),
+        migrations.AddField(
+            model_name="radio",
+            name="verification_status",
+            field=models.PositiveSmallIntegerField(
+                choices=[
+                    (0, "Verified"),
+                    (1, "Pending verification"),
+                    (2, "Verification failed"),
+                ],
+                db_index=True,
+                default=0,
+            ),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.5 on 2026-10-18 11:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("catalog", "0018_radio_verification"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="vote",
+            index=models.Index(fields=["created"], name="catalog_vote_created_idx"),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.5 on 2026-10-18 11:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("catalog", "0019_vote_created_idx"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="radio",
+            name="logo_renditions",
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
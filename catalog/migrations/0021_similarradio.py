@@ -0,0 +1,49 @@
+# Generated by Django 4.2.5 on 2026-10-18 11:19
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("catalog", "0020_radio_logo_renditions"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="SimilarRadio",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("rank", models.PositiveSmallIntegerField()),
+                ("score", models.FloatField()),
+                (
+                    "radio",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="similar_radios",
+                        to="catalog.radio",
+                    ),
+                ),
+                (
+                    "similar",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="+",
+                        to="catalog.radio",
+                    ),
+                ),
+            ],
+            options={
+                "unique_together": {("radio", "rank")},
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.5 on 2026-10-18 11:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("catalog", "0021_similarradio"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="streamprobe",
+            name="url",
+            field=models.URLField(max_length=255, unique=True),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 4.2.5 on 2026-10-18 11:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("catalog", "0022_streamprobe_url_max_length"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="radio",
+            name="verification_status",
+            field=models.PositiveSmallIntegerField(
+                choices=[
+                    (0, "Verified"),
+                    (1, "Pending verification"),
+                    (2, "Verification failed"),
+                    (3, "Edit pending verification"),
+                ],
+                db_index=True,
+                default=0,
+            ),
+        ),
+    ]
@@ -1,17 +1,42 @@
 
 from django.db import models
+from django.conf import settings
+from django.db.models import F, FloatField
+from django.db.models.functions import Cast
 from slugify import slugify
 from django.core.exceptions import ValidationError
 from django.core.files.images import get_image_dimensions
 from django.contrib.auth import get_user_model
 from mobile_application.models import ServerType
-from PIL import Image
-from django.core.files.base import ContentFile
-from io import BytesIO
 from django_extensions.db.models import TimeStampedModel
 
 User = get_user_model()
 
+# Prior of the weighted (Bayesian) rating: every radio starts as if it had
+# RATING_PRIOR_VOTES votes of RATING_PRIOR_MEAN, so a single 5 does not
+# outrank hundreds of 4s
+RATING_PRIOR_VOTES = 5
+RATING_PRIOR_MEAN = 3.0
+
+# Fields derived from the votes, saved together with them
+RATING_FIELDS = ('rating', 'weighted_rating')
+
+class VerificationStatus:
+
+    VERIFIED = 0
+    PENDING = 1
+    FAILED = 2
+    # An edit of a verified radio: it stays in the catalog as it was while its new URLs are checked
+    PENDING_EDIT = 3
+
+    choices = (
+        (VERIFIED, 'Verified'),
+        (PENDING, 'Pending verification'),
+        (FAILED, 'Verification failed'),
+        (PENDING_EDIT, 'Edit pending verification'),
+    )
+
+
 def validate_logo_image(image):
     """
     Validator for the radio logo.
@@ -82,6 +107,8 @@ class Radio(TimeStampedModel):
     enabled = models.BooleanField(default=True)
     website_url = models.URLField(blank=True)
     logo = models.ImageField(upload_to='catalog_logos/', validators=[validate_logo_image])
+    # Resized copies of the logo made by the render_logos command, see catalog.logos
+    logo_renditions = models.JSONField(default=dict, blank=True)
     languages = models.ManyToManyField(Language, related_name='radios')
     country = models.ForeignKey(Country, on_delete=models.PROTECT, related_name='radios')
     region = models.ForeignKey(Region, on_delete=models.PROTECT, related_name='radios', null=True, blank=True)
@@ -89,6 +116,17 @@ class Radio(TimeStampedModel):
     genres = models.ManyToManyField(Genre, related_name='radios')
     total_votes = models.PositiveIntegerField(default=0)
     total_score = models.PositiveIntegerField(default=0)
+    # Stored (and indexed) so the catalog can sort by rating without computing it per row
+    rating = models.FloatField(default=0)
+    weighted_rating = models.FloatField(default=RATING_PRIOR_MEAN)
+    # URL checks of a submission deferred to the verify_radios command (CATALOG_DEFERRED_VALIDATION),
+    # errors are keyed like the serializer errors: {'website_url': [...], 'streams': [{...}, ...]}
+    verification_status = models.PositiveSmallIntegerField(
+        choices=VerificationStatus.choices,
+        default=VerificationStatus.VERIFIED,
+        db_index=True,
+    )
+    verification_errors = models.JSONField(default=dict, blank=True)
 
     user = models.ForeignKey(
         User,
@@ -98,9 +136,42 @@ class Radio(TimeStampedModel):
         on_delete=models.deletion.CASCADE
     )
 
+    class Meta(TimeStampedModel.Meta):
+        indexes = [
+            models.Index(fields=['enabled', 'rating', 'id'], name='catalog_radio_rating_idx'),
+            models.Index(fields=['enabled', 'weighted_rating', 'id'], name='catalog_radio_weighted_idx'),
+            models.Index(fields=['enabled', 'total_votes', 'id'], name='catalog_radio_votes_idx'),
+            models.Index(fields=['enabled', 'created', 'id'], name='catalog_radio_created_idx'),
+        ]
+
     def __str__(self):
         return self.name
 
+    def update_rating(self):
+        """Recalculate the stored ratings from total_score and total_votes"""
+        self.rating = self.total_score / self.total_votes if self.total_votes else 0.0
+        self.weighted_rating = (
+            (RATING_PRIOR_MEAN * RATING_PRIOR_VOTES + self.total_score) /
+            (RATING_PRIOR_VOTES + self.total_votes)
+        )
+
+    @classmethod
+    def add_vote(cls, radio_id, score):
+        """
+        Count a vote with a single UPDATE, no lost votes under concurrency.
+        Returns False if there is no such radio
+        """
+        total_votes = F('total_votes') + 1
+        total_score = Cast(F('total_score') + score, FloatField())
+        # The ratings come first: MySQL evaluates the assignments in order,
+        # F('total_*') must still be the values before the vote
+        return bool(cls.objects.filter(pk=radio_id).update(
+            rating=total_score / total_votes,
+            weighted_rating=(RATING_PRIOR_MEAN * RATING_PRIOR_VOTES + total_score) / (RATING_PRIOR_VOTES + total_votes),
+            total_votes=total_votes,
+            total_score=F('total_score') + score,
+        ))
+
     def _generate_unique_slug(self):
         base_slug = slugify(self.name) if self.name else "radio"
         slug = base_slug
@@ -115,22 +186,17 @@ class Radio(TimeStampedModel):
         if not self.pk and not self.slug:
             self.slug = self._generate_unique_slug()
 
-        # Resize logo if needed
-        if self.logo:
-            try:
-                self.logo.open()
-                img = Image.open(self.logo)
-                width, height = img.size
-                if width > 512 or height > 512:
-                    img = img.resize((512, 512), Image.LANCZOS)
-                    buffer = BytesIO()
-                    img_format = img.format if img.format else 'PNG'
-                    img.save(buffer, format=img_format)
-                    buffer.seek(0)
-                    file_name = self.logo.name.split('/')[-1]
-                    self.logo.save(file_name, ContentFile(buffer.read()), save=False)
-            except Exception:
-                pass  # If resizing fails, save original
+        self.update_rating()
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and {'total_votes', 'total_score'} & set(update_fields):
+            kwargs['update_fields'] = set(update_fields) | set(RATING_FIELDS)
+
+        # Stale renditions are dropped, the render_logos command makes new ones and
+        # caps the logo itself to 512 px. The logo is not decoded here, this runs in the request
+        if self.logo_renditions and self.logo_renditions.get('source') != self.logo.name:
+            self.logo_renditions = {}
+            if kwargs.get('update_fields') is not None:
+                kwargs['update_fields'] = set(kwargs['update_fields']) | {'logo_renditions'}
 
         super().save(*args, **kwargs)
 
@@ -163,7 +229,66 @@ class Stream(TimeStampedModel):
         return f"{self.radio.name} - {self.get_audio_format_display()} ({self.bitrate} kbps)"
 
 
+class StreamHealth(models.Model):
+    """
+    Outcome of the latest checks of a stream, kept by the check_streams command
+    to schedule the next check and to ride out one-off failures.
+    """
+    stream = models.OneToOneField(Stream, on_delete=models.CASCADE, primary_key=True, related_name='health')
+    last_checked = models.DateTimeField(null=True, blank=True)
+    last_ok = models.DateTimeField(null=True, blank=True)
+    consecutive_failures = models.PositiveIntegerField(default=0)
+    ttfb = models.PositiveIntegerField("Time to first byte (ms)", null=True, blank=True)
+    content_type = models.CharField(max_length=100, blank=True)
+    error = models.CharField(max_length=255, blank=True)
+    next_check = models.DateTimeField(null=True, blank=True, db_index=True)
+
+    class Meta:
+        verbose_name_plural = "stream health"
+
+    def __str__(self):
+        return f"{self.stream_id}: {self.consecutive_failures} failures"
+
+
+class StreamProbe(models.Model):
+    """
+    Latest probe of a stream URL, shared by the serializer validation and the
+    check_streams command: a URL checked recently by either is not probed again.
+    Keyed by the normalized URL, see catalog.probes.normalize_url
+    """
+    # Longer than Stream.stream_url: the normalization may append a "/"
+    url = models.URLField(max_length=255, unique=True)
+    ok = models.BooleanField(default=False)
+    content_type = models.CharField(max_length=100, blank=True)
+    error = models.CharField(max_length=255, blank=True)
+    checked_at = models.DateTimeField()
+
+    def __str__(self):
+        return f"{self.url}: {'ok' if self.ok else self.error}"
+
+
+class SimilarRadio(models.Model):
+    """
+    Precomputed "similar stations" of a radio, by rank; rebuilt offline by the
+    build_similar_radios command
+    """
+    radio = models.ForeignKey(Radio, on_delete=models.CASCADE, related_name='similar_radios')
+    similar = models.ForeignKey(Radio, on_delete=models.CASCADE, related_name='+')
+    rank = models.PositiveSmallIntegerField()
+    score = models.FloatField()
+
+    class Meta:
+        unique_together = ('radio', 'rank')
+
+    def __str__(self):
+        return f"{self.radio_id} -> {self.similar_id} ({self.score:.3f})"
+
+
 class Vote(TimeStampedModel):
+    """
+    A vote from an IP address, it blocks another vote for the same radio
+    until it expires (CATALOG_VOTE_TTL); expired votes are removed by purge_votes
+    """
 
     radio = models.ForeignKey(Radio, on_delete=models.CASCADE, related_name='votes')
     ip =  models.GenericIPAddressField(
@@ -174,3 +299,40 @@ class Vote(TimeStampedModel):
 
     class Meta:
         unique_together = ('radio', 'ip')
+        indexes = [
+            models.Index(fields=['created'], name='catalog_vote_created_idx'),
+        ]
+
+    @staticmethod
+    def ttl():
+        """Seconds before an IP address can vote for the same radio again"""
+        return getattr(settings, 'CATALOG_VOTE_TTL', 60 * 60)
+
+
+class IndexVersion(models.Model):
+    """
+    Version stamps of the in-process catalog indexes.
+    Every write an index depends on bumps its stamp, a worker rebuilds
+    its own copy of the index once it sees a newer stamp.
+    """
+    RADIOS = 'radios'
+    REFERENCE = 'reference'
+    VOTES = 'votes'
+
+    name = models.CharField(max_length=32, unique=True)
+    version = models.PositiveBigIntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.name}: {self.version}"
+
+    @classmethod
+    def bump(cls, *names):
+        for name in names:
+            if not cls.objects.filter(name=name).update(version=F('version') + 1):
+                cls.objects.get_or_create(name=name, defaults={'version': 1})
+
+    @classmethod
+    def current(cls, *names):
+        """Return the stamps of the given indexes as a tuple, in one query"""
+        versions = dict(cls.objects.filter(name__in=names).values_list('name', 'version'))
+        return tuple(versions.get(name, 0) for name in names)
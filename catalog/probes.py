@@ -0,0 +1,184 @@
+"""
+Stream probes shared by the radio serializers and the check_streams command.
+
+The latest outcome for every stream URL is kept in StreamProbe, keyed by the
+normalized URL. A probe is reused while it is fresh: STREAM_PROBE_TTL seconds
+for a working stream, STREAM_PROBE_FAILURE_TTL for a failing one (short, an
+owner fixing the stream should not wait for the checker to notice).
+
+check_website checks a radio website the same way, without a cache.
+"""
+import threading
+from datetime import timedelta
+from urllib.parse import urlsplit, urlunsplit
+
+import requests
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+from requests.exceptions import RequestException
+from urllib3.util.ssl_ import create_urllib3_context
+
+from .models import StreamProbe
+
+
+URL_INVALID = 'url_invalid'
+NOT_AUDIO = 'content_type_not_audio'
+NOT_HTML = 'content_type'
+CONNECTION_ERROR = 'connection_error'
+
+HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/108.0.0.0 Safari/537.36',
+    'Icy-MetaData': '1'  # Request metadata from Shoutcast/Icecast servers
+}
+
+WEBSITE_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3'
+}
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+# Maximum number of urls in one SELECT ... WHERE url IN (...)
+QUERY_CHUNK_SIZE = 1000
+
+ctx = create_urllib3_context()
+ctx.set_ciphers('DEFAULT@SECLEVEL=1')  # Critical for OpenSSL 3.0+
+class LegacyHTTPSAdapter(requests.adapters.HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs['ssl_context'] = ctx
+        return super().init_poolmanager(*args, **kwargs)
+
+
+_local = threading.local()
+
+
+def get_session():
+    """One session per thread: the connection pools survive between the requests"""
+    session = getattr(_local, 'session', None)
+    if session is None:
+        session = requests.Session()
+        session.headers.update(HEADERS)
+        session.mount('https://', LegacyHTTPSAdapter())
+        _local.session = session
+    return session
+
+
+def normalize_url(url):
+    """Lower case scheme and host, no default port, no fragment"""
+    url = url.strip()
+    try:
+        parts = urlsplit(url)
+        port = parts.port
+    except ValueError:
+        return url
+    scheme = parts.scheme.lower()
+    netloc = (parts.hostname or '').lower()
+    if ':' in netloc:
+        netloc = f'[{netloc}]'
+    if port and port != DEFAULT_PORTS.get(scheme):
+        netloc = f'{netloc}:{port}'
+    if parts.username or parts.password:
+        userinfo = parts.username or ''
+        if parts.password:
+            userinfo = f'{userinfo}:{parts.password}'
+        netloc = f'{userinfo}@{netloc}'
+    return urlunsplit((scheme, netloc, parts.path or '/', parts.query, ''))
+
+
+def is_fresh(probe, now=None):
+    now = now or timezone.now()
+    if probe.ok:
+        ttl = getattr(settings, 'STREAM_PROBE_TTL', 60 * 60)
+    else:
+        ttl = getattr(settings, 'STREAM_PROBE_FAILURE_TTL', 5 * 60)
+    return probe.checked_at > now - timedelta(seconds=ttl)
+
+
+def get_fresh_probes(urls):
+    """{normalized url: StreamProbe} of the urls probed recently enough"""
+    keys = list({normalize_url(url) for url in urls})
+    now = timezone.now()
+    probes = {}
+    for i in range(0, len(keys), QUERY_CHUNK_SIZE):
+        for probe in StreamProbe.objects.filter(url__in=keys[i:i + QUERY_CHUNK_SIZE]):
+            if is_fresh(probe, now):
+                probes[probe.url] = probe
+    return probes
+
+
+def save_probes(probes):
+    """Insert or update StreamProbe rows, probes is an iterable of unsaved StreamProbe"""
+    # The last probe of a url wins, one row per url in the statement
+    probes = list({probe.url: probe for probe in probes}.values())
+    # MySQL upserts on any unique key (ON DUPLICATE KEY UPDATE) and rejects a conflict target
+    unique_fields = ['url'] if connection.features.supports_update_conflicts_with_target else None
+    StreamProbe.objects.bulk_create(
+        probes,
+        batch_size=QUERY_CHUNK_SIZE,
+        update_conflicts=True,
+        unique_fields=unique_fields,
+        update_fields=['ok', 'content_type', 'error', 'checked_at'],
+    )
+
+
+def run_probe(url, timeout=5):
+    """
+    Check over the network that the url is a connectable audio stream.
+    Returns an unsaved StreamProbe: no database access, safe to call from any thread
+    """
+    probe = StreamProbe(url=normalize_url(url), checked_at=timezone.now())
+    if not (url.startswith('http://') or url.startswith('https://')):
+        probe.error = URL_INVALID
+    else:
+        try:
+            # stream=True: only the headers are read, never the stream itself
+            with get_session().get(url, timeout=timeout, stream=True) as response:
+                response.raise_for_status()  # Check for HTTP errors like 404 or 500
+                probe.content_type = response.headers.get('Content-Type', '').lower()[:100]
+                if 'audio' not in probe.content_type:
+                    probe.error = NOT_AUDIO
+        except RequestException as e:
+            # Catches connection errors, timeouts, DNS errors, etc.
+            probe.error = f"{CONNECTION_ERROR}: {e}"[:255]
+    probe.ok = not probe.error
+    return probe
+
+
+def probe_stream(url, timeout=5):
+    """
+    Check that the url is a connectable audio stream, reusing a fresh probe.
+    Returns the StreamProbe; only a probe that went over the network is saved.
+    """
+    key = normalize_url(url)
+    probe = get_fresh_probes([key]).get(key)
+    if probe is None:
+        probe = run_probe(url, timeout)
+        save_probes([probe])
+    return probe
+
+
+def error_code(probe):
+    """Validation error code of a failed probe"""
+    if probe.error in (URL_INVALID, NOT_AUDIO):
+        return probe.error
+    return CONNECTION_ERROR
+
+
+def check_website(url, timeout=5):
+    """Check that the url is a reachable HTML page. Returns the error code, empty if valid"""
+    if not (url.startswith('http://') or url.startswith('https://')):
+        return URL_INVALID
+    try:
+        # Use HEAD request to be efficient and not download the whole page
+        response = requests.head(url, timeout=timeout, headers=WEBSITE_HEADERS, allow_redirects=True, verify=False)
+
+        # Check for a successful status code (e.g., 200 OK)
+        response.raise_for_status()
+    except RequestException:
+        # This will catch connection errors, timeouts, invalid URLs, etc.
+        return CONNECTION_ERROR
+
+    # Check if the Content-Type header indicates an HTML document
+    if 'text/html' not in response.headers.get('Content-Type', ''):
+        return NOT_HTML
+    return ''
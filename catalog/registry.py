@@ -0,0 +1,138 @@
+"""
+In-process registry of the catalog reference data: countries, regions, cities,
+genres and languages.
+
+The tables are small and change a few times a year, yet every catalog filter
+used to join them and match names with iexact on both columns. The registry
+keeps their rows and name -> ids maps (Russian and English names, case
+insensitive) in memory, so a filter by name becomes an integer id filter and
+a name is printed without a join.
+
+It is loaded once per process and reloaded when the reference data version
+stamp changes (see IndexVersion and catalog/signals.py).
+
+It also serves the name autocomplete: a sorted array of (normalized name, id)
+per scope (e.g. the cities of a country), searched by prefix with bisect. Names
+are normalized like the search index does, a Latin prefix finds Cyrillic names.
+"""
+import threading
+from bisect import bisect_left
+from collections import namedtuple
+
+from .models import Country, Region, City, Genre, Language, IndexVersion
+from .search import normalize
+
+
+# Key -> (model, fields kept besides id, name and name_eng)
+REFERENCES = {
+    'countries': (Country, ('iso2',)),
+    'regions': (Region, ('country_id',)),
+    'cities': (City, ('country_id', 'region_id', 'latitude', 'longitude')),
+    'genres': (Genre, ()),
+    'languages': (Language, ()),
+}
+
+# Autocomplete scope field -> key of the rows it refers to
+SCOPES = {
+    'country_id': 'countries',
+    'region_id': 'regions',
+}
+
+
+class ReferenceRegistry:
+
+    def __init__(self, version):
+        self.version = version
+        # key -> {id: row}
+        self.rows = {}
+        # key -> {lowercase name or name_eng: [ids]}
+        self.lookup = {}
+        # lowercase ISO2 code -> country id
+        self.iso2 = {}
+        # (key, scope) -> sorted [(normalized name, id)], built on first use
+        self.prefixes = {}
+
+    def build(self):
+        for key, (model, extra) in REFERENCES.items():
+            row_class = namedtuple(model.__name__, ('id', 'name', 'name_eng') + extra)
+            rows = {}
+            lookup = {}
+            for values in model.objects.order_by('id').values_list('id', 'name', 'name_eng', *extra):
+                row = row_class(*values)
+                rows[row.id] = row
+                for name in {row.name, row.name_eng}:
+                    if name:
+                        lookup.setdefault(name.strip().lower(), []).append(row.id)
+            self.rows[key] = rows
+            self.lookup[key] = lookup
+
+        self.iso2 = {row.iso2.lower(): row.id for row in self.rows['countries'].values() if row.iso2}
+        return self
+
+    def get(self, key, row_id):
+        """The row of the id, None if there is none"""
+        return self.rows[key].get(row_id)
+
+    def ids(self, key, name):
+        """Ids of the rows named so in either language, case insensitive"""
+        return self.lookup[key].get(name.strip().lower(), [])
+
+    def prefix_index(self, key, scope):
+        entries = self.prefixes.get((key, scope))
+        if entries is None:
+            entries = sorted({
+                (normalize(name).strip(), row.id)
+                for row in self.rows[key].values()
+                if all(getattr(row, field) == value for field, value in scope)
+                for name in (row.name, row.name_eng)
+                if name
+            })
+            self.prefixes[(key, scope)] = entries
+        return entries
+
+    def autocomplete(self, key, prefix, limit=10, **scope):
+        """
+        Rows whose name or name_eng starts with the prefix, in alphabetical order,
+        within the scope given as field values (e.g. country_id=1)
+        """
+        prefix = normalize(prefix).strip()
+        # Unknown scopes would fill the cache with empty indexes
+        if not prefix or any(value not in self.rows[SCOPES[field]] for field, value in scope.items()):
+            return []
+        entries = self.prefix_index(key, tuple(sorted(scope.items())))
+        rows = []
+        seen = set()
+        for i in range(bisect_left(entries, (prefix,)), len(entries)):
+            name, row_id = entries[i]
+            if not name.startswith(prefix) or len(rows) >= limit:
+                break
+            if row_id not in seen:
+                seen.add(row_id)
+                rows.append(self.rows[key][row_id])
+        return rows
+
+    def name(self, key, row_id, lang=''):
+        """Name in the language asked for ('ru' or english), the other one if it is empty"""
+        row = self.rows[key].get(row_id)
+        if row is None:
+            return None
+        if lang == 'ru':
+            return row.name or row.name_eng
+        return row.name_eng or row.name
+
+
+_registry = None
+_lock = threading.Lock()
+
+
+def get_registry():
+    """Return the reference registry, reloading it if the reference data changed since it was loaded"""
+    global _registry
+    version = IndexVersion.current(IndexVersion.REFERENCE)
+    registry = _registry
+    if registry is not None and registry.version == version:
+        return registry
+    with _lock:
+        if _registry is None or _registry.version != version:
+            _registry = ReferenceRegistry(version).build()
+        return _registry
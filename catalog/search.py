@@ -0,0 +1,203 @@
+"""
+In-process full-text search over the public catalog.
+
+Radio names, descriptions and the names (both languages) of their genres,
+country and city are tokenized into an inverted index: token -> {radio id: weight}.
+Cyrillic is transliterated to Latin before indexing, so "радио" and "radio"
+land on the same token and a query finds stations in either script.
+
+Query tokens match indexed tokens by prefix (bisect over the sorted vocabulary),
+all query tokens must match and radios are ranked by the summed field weights.
+
+Like the facet index the search index lives in each worker: it is rebuilt when
+the reference data stamp changes and refreshed incrementally (only the radios
+whose `modified` moved) when the radios stamp changes. The refresh also evicts
+the radios deleted or disabled by a bulk update, which do not move `modified`.
+"""
+import re
+import threading
+import unicodedata
+from bisect import bisect_left, insort
+from datetime import timedelta
+
+from .models import Radio, Genre, Country, City, IndexVersion
+
+
+# Field weights, a match in the name matters more than one in the description
+NAME_WEIGHT = 8
+GENRE_WEIGHT = 4
+PLACE_WEIGHT = 2
+DESCRIPTION_WEIGHT = 1
+
+# An exact token match ranks above a prefix match
+EXACT_MATCH_BONUS = 2
+
+# Ranking is applied in SQL with a CASE over the ids, keep it bounded: every match
+# is returned (and counted), the ones past the first MAX_RANKED rank equally
+MAX_RANKED = 1000
+
+# Writes committed slightly out of order must still be picked by the incremental refresh
+REFRESH_MARGIN = timedelta(minutes=1)
+
+TRANSLITERATION = {
+    'а': 'a', 'б': 'b', 'в': 'v', 'г': 'g', 'д': 'd', 'е': 'e', 'ё': 'e',
+    'ж': 'zh', 'з': 'z', 'и': 'i', 'й': 'y', 'к': 'k', 'л': 'l', 'м': 'm',
+    'н': 'n', 'о': 'o', 'п': 'p', 'р': 'r', 'с': 's', 'т': 't', 'у': 'u',
+    'ф': 'f', 'х': 'kh', 'ц': 'ts', 'ч': 'ch', 'ш': 'sh', 'щ': 'shch', 'ъ': '',
+    'ы': 'y', 'ь': '', 'э': 'e', 'ю': 'yu', 'я': 'ya',
+    'і': 'i', 'ї': 'yi', 'є': 'ye', 'ґ': 'g',
+}
+TRANSLITERATION_TABLE = str.maketrans(TRANSLITERATION)
+
+NON_WORD_RE = re.compile(r'[\W_]+')
+
+
+def normalize(text):
+    """Lowercase, transliterate Cyrillic to Latin and strip the diacritics"""
+    text = (text or '').lower().translate(TRANSLITERATION_TABLE)
+    text = unicodedata.normalize('NFKD', text)
+    text = ''.join(c for c in text if not unicodedata.combining(c))
+    return NON_WORD_RE.sub(' ', text)
+
+
+def tokenize(text):
+    return normalize(text).split()
+
+
+class SearchIndex:
+
+    def __init__(self, reference_version):
+        self.reference_version = reference_version
+        self.radios_version = None
+        self.watermark = None
+        # token -> {radio id: weight}
+        self.postings = {}
+        # Sorted vocabulary for the prefix lookups
+        self.tokens = []
+        # radio id -> tokens it is indexed under, to drop it on reindex
+        self.documents = {}
+        # Names of the reference data (both languages) by id
+        self.genres = {}
+        self.countries = {}
+        self.cities = {}
+
+    def build(self, radios_version):
+        for model, names in ((Genre, self.genres), (Country, self.countries), (City, self.cities)):
+            for value_id, name, name_eng in model.objects.values_list('id', 'name', 'name_eng'):
+                names[value_id] = f"{name or ''} {name_eng or ''}"
+        self.refresh(radios_version)
+        return self
+
+    def refresh(self, radios_version):
+        """Reindex the radios modified since the previous refresh (all of them on the first one)"""
+        radios = Radio.objects.all()
+        if self.watermark is not None:
+            radios = radios.filter(modified__gte=self.watermark - REFRESH_MARGIN)
+        rows = list(radios.values_list(
+            'id', 'enabled', 'name', 'description', 'country_id', 'city_id', 'modified'
+        ))
+
+        genres = {}
+        genre_links = Radio.genres.through.objects.filter(radio__enabled=True)
+        if self.watermark is not None:
+            genre_links = genre_links.filter(radio_id__in=[row[0] for row in rows])
+        for radio_id, genre_id in genre_links.values_list('radio_id', 'genre_id'):
+            genres.setdefault(radio_id, []).append(genre_id)
+
+        if self.watermark is not None:
+            # Deleted radios and bulk disables leave no row to reindex
+            enabled_ids = set(Radio.objects.filter(enabled=True).values_list('id', flat=True))
+            for radio_id in [radio_id for radio_id in self.documents if radio_id not in enabled_ids]:
+                self.remove(radio_id)
+
+        for radio_id, enabled, name, description, country_id, city_id, modified in rows:
+            self.remove(radio_id)
+            if enabled:
+                self.add(radio_id, (
+                    (NAME_WEIGHT, name),
+                    (GENRE_WEIGHT, ' '.join(self.genres.get(g, '') for g in genres.get(radio_id, ()))),
+                    (PLACE_WEIGHT, self.countries.get(country_id, '')),
+                    (PLACE_WEIGHT, self.cities.get(city_id, '')),
+                    (DESCRIPTION_WEIGHT, description),
+                ))
+            if self.watermark is None or modified > self.watermark:
+                self.watermark = modified
+
+        self.radios_version = radios_version
+
+    def add(self, radio_id, fields):
+        weights = {}
+        for weight, text in fields:
+            for token in set(tokenize(text)):
+                weights[token] = weights.get(token, 0) + weight
+        for token, weight in weights.items():
+            postings = self.postings.get(token)
+            if postings is None:
+                postings = self.postings[token] = {}
+                insort(self.tokens, token)
+            postings[radio_id] = weight
+        self.documents[radio_id] = tuple(weights)
+
+    def remove(self, radio_id):
+        for token in self.documents.pop(radio_id, ()):
+            postings = self.postings[token]
+            postings.pop(radio_id, None)
+            if not postings:
+                del self.postings[token]
+                del self.tokens[bisect_left(self.tokens, token)]
+
+    def match_token(self, query_token):
+        """Scores of the radios having a token starting with the query token"""
+        scores = {}
+        position = bisect_left(self.tokens, query_token)
+        while position < len(self.tokens) and self.tokens[position].startswith(query_token):
+            token = self.tokens[position]
+            bonus = EXACT_MATCH_BONUS if token == query_token else 1
+            for radio_id, weight in self.postings[token].items():
+                score = weight * bonus
+                if score > scores.get(radio_id, 0):
+                    scores[radio_id] = score
+            position += 1
+        return scores
+
+    def search(self, query, limit=None):
+        """Ids of the enabled radios matching every query token, best match first, all of them by default"""
+        tokens = tokenize(query)
+        # A lone letter matches half of the vocabulary, ignore it next to real words
+        if len(tokens) > 1:
+            tokens = [token for token in tokens if len(token) > 1] or tokens
+        if not tokens:
+            return []
+
+        scores = None
+        # Start from the rarest token so the intersections stay small
+        for matched in sorted((self.match_token(token) for token in set(tokens)), key=len):
+            if scores is None:
+                scores = matched
+            else:
+                scores = {radio_id: score + matched[radio_id] for radio_id, score in scores.items() if radio_id in matched}
+            if not scores:
+                return []
+
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+        return [radio_id for radio_id, _ in ranked[:limit]]
+
+
+_index = None
+_lock = threading.Lock()
+
+
+def search_radios(query, limit=None):
+    """
+    Ids of the enabled radios matching the query, best match first.
+    The index is brought up to date with the catalog first, the lock keeps
+    a refresh from mutating the postings under a running search.
+    """
+    global _index
+    radios_version, reference_version = IndexVersion.current(IndexVersion.RADIOS, IndexVersion.REFERENCE)
+    with _lock:
+        if _index is None or _index.reference_version != reference_version:
+            _index = SearchIndex(reference_version).build(radios_version)
+        elif _index.radios_version != radios_version:
+            _index.refresh(radios_version)
+        return _index.search(query, limit)
@@ -1,17 +1,10 @@
-import ssl
-import requests
-from urllib3.util.ssl_ import create_urllib3_context
+from functools import cached_property
 
+from django.conf import settings
 from rest_framework import serializers
-from requests.exceptions import RequestException
-from .models import Radio, Language, Country, Genre, Stream, Vote, Region, City
-
-ctx = create_urllib3_context()
-ctx.set_ciphers('DEFAULT@SECLEVEL=1')  # Critical for OpenSSL 3.0+
-class LegacyHTTPSAdapter(requests.adapters.HTTPAdapter):
-    def init_poolmanager(self, *args, **kwargs):
-        kwargs['ssl_context'] = ctx
-        return super().init_poolmanager(*args, **kwargs)
+from .models import Radio, Language, Country, Genre, Stream, Vote, Region, City, VerificationStatus
+from .logos import srcset
+from .probes import probe_stream, check_website, error_code, normalize_url, URL_INVALID
 
 class LanguageSerializer(serializers.ModelSerializer):
     class Meta:
@@ -49,44 +42,31 @@ class StreamSerializer(serializers.ModelSerializer):
     def validate_stream_url(self, value):
         """
         Validates that the stream URL is a connectable audio stream.
+        The URLs the radio already has are not probed again, the check_streams
+        command keeps track of them; the others reuse a recent probe if any.
         """
         if not (value.startswith('http://') or value.startswith('https://')):
-            raise serializers.ValidationError("url_invalid")
-
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/108.0.0.0 Safari/537.36',
-            'Icy-MetaData': '1'  # Request metadata from Shoutcast/Icecast servers
-        }
-
-        try:
-            session = requests.Session()
-            session.mount('https://', LegacyHTTPSAdapter())
-
-            # Use stream=True to avoid downloading the entire file
-            # response = requests.get(value, timeout=5, headers=headers, stream=True, verify=False)
-            response = session.get(value, timeout=5, headers=headers, stream=True)
+            raise serializers.ValidationError(URL_INVALID)
 
-            response.raise_for_status()  # Check for HTTP errors like 404 or 500
+        if normalize_url(value) in self.current_urls:
+            return value
 
-            # server_type = self.initial_data.get('server_type', '').lower()
-            # if server_type == 'icecast':
-            #     # Read the first few bytes of the stream to check for "icecast"
-            #     first_chunk = next(response.iter_content(chunk_size=512), b'')
-            #     if b'icecast' in first_chunk.lower():
-            #         return value
-
-            # Check if Content-Type header indicates an audio stream
-            content_type = response.headers.get('Content-Type', '').lower()
-            if 'audio' not in content_type:
-                raise serializers.ValidationError("content_type_not_audio")
+        if getattr(self.root, 'deferred_validation', False):
+            return value  # Checked by the verify_radios command
 
+        probe = probe_stream(value)
+        if not probe.ok:
+            raise serializers.ValidationError(error_code(probe))
+        return value
 
-        except RequestException:
-            # Catches connection errors, timeouts, DNS errors, etc.
-            raise serializers.ValidationError("connection_error")
+    @cached_property
+    def current_urls(self):
+        """Normalized stream URLs of the radio being updated"""
+        radio = self.root.instance
+        if not isinstance(radio, Radio):
+            return set()
+        return {normalize_url(url) for url in radio.streams.values_list('stream_url', flat=True)}
 
-        return value
-        
     class Meta:
         model = Stream
         fields = ['id', 'stream_url', 'audio_format', 'bitrate', 'server_type']
@@ -101,9 +81,11 @@ class RadioSerializer(serializers.ModelSerializer):
         fields = [
             'id', 'name', 'slug', 'description', 'enabled', 'website_url', 'logo',
             'languages', 'country', 'region', 'city', 'genres', 'streams',
-            'total_votes', 'total_score', 'user'
+            'total_votes', 'total_score', 'user', 'verification_status', 'verification_errors'
+        ]
+        read_only_fields = [
+            'id', 'slug', 'enabled', 'total_votes', 'total_score', 'verification_status', 'verification_errors'
         ]
-        read_only_fields = ['id', 'slug', 'enabled', 'total_votes', 'total_score']
 
     def __init__(self, *args, **kwargs):
         # Call the superclass's __init__ first
@@ -113,11 +95,24 @@ class RadioSerializer(serializers.ModelSerializer):
         if self.instance:
             self.fields['logo'].required = False
 
+    @property
+    def deferred_validation(self):
+        """
+        Save the radio right away and leave the URL checks to the verify_radios
+        command, instead of blocking the request on them
+        """
+        return getattr(settings, 'CATALOG_DEFERRED_VALIDATION', False)
+
     def create(self, validated_data):
         streams_data = validated_data.pop('streams')
         languages_data = validated_data.pop('languages', None)
         genres_data = validated_data.pop('genres', None)
-        
+
+        if self.deferred_validation:
+            # Hidden from the catalog until its URLs are verified
+            validated_data['enabled'] = False
+            validated_data['verification_status'] = VerificationStatus.PENDING
+
         radio = Radio.objects.create(**validated_data)
 
         if languages_data:
@@ -126,7 +121,7 @@ class RadioSerializer(serializers.ModelSerializer):
             radio.genres.set(genres_data)
 
         for stream_data in streams_data:
-            Stream.objects.create(radio=radio, **stream_data)
+            Stream.objects.create(radio=radio, enabled=not self.deferred_validation, **stream_data)
         return radio
 
     def validate_website_url(self, value):
@@ -136,33 +131,38 @@ class RadioSerializer(serializers.ModelSerializer):
         if not (value.startswith('http://') or value.startswith('https://')):
             raise serializers.ValidationError("url_invalid")
 
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3'
-        }
-
-        try:
-            # Use HEAD request to be efficient and not download the whole page
-            response = requests.head(value, timeout=5, headers=headers, allow_redirects=True, verify=False)
+        if self.instance and value == self.instance.website_url:
+            return value  # Unchanged, it was validated when it was set
 
-            # Check for a successful status code (e.g., 200 OK)
-            response.raise_for_status()
-
-            # Check if the Content-Type header indicates an HTML document
-            content_type = response.headers.get('Content-Type', '')
-            if 'text/html' not in content_type:
-                raise serializers.ValidationError("content_type")
-
-        except RequestException:
-            # This will catch connection errors, timeouts, invalid URLs, etc.
-            raise serializers.ValidationError("connection_error")
+        if self.deferred_validation:
+            return value  # Checked by the verify_radios command
 
+        error = check_website(value)
+        if error:
+            raise serializers.ValidationError(error)
         return value
 
     def update(self, instance, validated_data):
         streams_data = validated_data.pop('streams', None)
         languages_data = validated_data.pop('languages', None)
         genres_data = validated_data.pop('genres', None)
-        
+
+        new_urls = set()
+        if self.deferred_validation:
+            current_urls = {normalize_url(url) for url in instance.streams.values_list('stream_url', flat=True)}
+            new_urls = {
+                normalize_url(stream_data['stream_url']) for stream_data in streams_data or []
+            } - current_urls
+            website_changed = validated_data.get('website_url', instance.website_url) != instance.website_url
+            # A failed submission (or edit) is verified again even if nothing changed: the owner may have fixed the servers
+            if (new_urls or website_changed or instance.verification_errors
+                    or instance.verification_status != VerificationStatus.VERIFIED):
+                if instance.verification_status in (VerificationStatus.VERIFIED, VerificationStatus.PENDING_EDIT):
+                    validated_data['verification_status'] = VerificationStatus.PENDING_EDIT
+                else:
+                    validated_data['verification_status'] = VerificationStatus.PENDING
+                validated_data['verification_errors'] = {}
+
         instance = super().update(instance, validated_data)
 
         if languages_data is not None:
@@ -171,11 +171,36 @@ class RadioSerializer(serializers.ModelSerializer):
             instance.genres.set(genres_data)
 
         if streams_data is not None:
-            instance.streams.all().delete()
-            for stream_data in streams_data:
-                Stream.objects.create(radio=instance, **stream_data)
+            self.update_streams(instance, streams_data, new_urls)
         return instance
 
+    def update_streams(self, instance, streams_data, new_urls):
+        """
+        Match the streams by normalized URL: the ones the radio keeps are updated
+        in place, with the status and health the check_streams command gave them.
+        Only the added URLs get new rows, only the removed ones are deleted
+        """
+        current = {}
+        for stream in instance.streams.order_by('id'):
+            current.setdefault(normalize_url(stream.stream_url), []).append(stream)
+
+        for stream_data in streams_data:
+            url = normalize_url(stream_data['stream_url'])
+            if current.get(url):
+                stream = current[url].pop(0)
+                changed = [field for field, value in stream_data.items() if getattr(stream, field) != value]
+                if changed:
+                    for field in changed:
+                        setattr(stream, field, stream_data[field])
+                    stream.save()
+            else:
+                # New URLs stay disabled until they are verified
+                Stream.objects.create(radio=instance, enabled=url not in new_urls, **stream_data)
+
+        removed = [stream.id for streams in current.values() for stream in streams]
+        if removed:
+            Stream.objects.filter(id__in=removed).delete()
+
 
 class VoteSerializer(serializers.ModelSerializer):
     class Meta:
@@ -218,6 +243,7 @@ class PublicRadioSerializer(serializers.ModelSerializer):
     languages = serializers.SerializerMethodField()
     streams = PublicStreamSerializer(many=True, read_only=True)
     default_stream = serializers.SerializerMethodField()
+    srcset = serializers.SerializerMethodField()
     created = serializers.DateField(source='created_at', format='%Y-%m-%d', read_only=True)
 
     class Meta:
@@ -226,34 +252,65 @@ class PublicRadioSerializer(serializers.ModelSerializer):
             'id', 'name', 'slug', 'description', 'enabled', 'website_url', 'logo',
             'country_code', 'country_name', 'region_name', 'city_name',
             'rating', 'total_votes', 'created', 'genres', 'languages',
-            'default_stream', 'streams'
+            'default_stream', 'streams', 'srcset'
         ]
 
     def get_rating(self, obj):
-        """Calculate average rating from total_score and total_votes"""
-        if obj.total_votes > 0:
-            return round(obj.total_score / obj.total_votes, 1)
-        return 0.0
+        """Average rating, stored on the radio"""
+        return round(obj.rating, 1)
+
+    @cached_property
+    def lang(self):
+        """Response language, parsed once: a many=True serializer reuses its child for every row"""
+        request = self.context.get('request')
+        return request.query_params.get('lang', '').strip() if request else ''
 
     def get_genres(self, obj):
         """Return list of genre names"""
-        request = self.context.get('request')
-        lang = request.query_params.get('lang', '').strip() if request else ''
-        
-        if lang == 'ru':
+        if self.lang == 'ru':
             return [genre.name or genre.name_eng for genre in obj.genres.all()]
         return [genre.name_eng or genre.name for genre in obj.genres.all()]
 
     def get_languages(self, obj):
         """Return list of language names"""
-        request = self.context.get('request')
-        lang = request.query_params.get('lang', '').strip() if request else ''
-        
-        if lang == 'ru':
+        if self.lang == 'ru':
             return [lang_obj.name or lang_obj.name_eng for lang_obj in obj.languages.all()]
         return [lang_obj.name_eng or lang_obj.name for lang_obj in obj.languages.all()]
 
     def get_default_stream(self, obj):
-        """Return the URL of the first enabled stream"""
-        first_stream = obj.streams.filter(enabled=True).first()
-        return first_stream.stream_url if first_stream else None
+        """
+        Return the URL of the first enabled stream.
+        The catalog prefetches the enabled streams only, ordered by id: read them
+        instead of filtering, which would be one more query per radio.
+        """
+        for stream in obj.streams.all():
+            if stream.enabled:
+                return stream.stream_url
+        return None
+
+    def get_srcset(self, obj):
+        """
+        {'webp': srcset, 'png': srcset} of the logo renditions, for the lists to load
+        a small image instead of the full size logo. None until they are rendered
+        """
+        if not obj.logo_renditions.get('webp'):
+            return None
+        request = self.context.get('request')
+        storage = obj.logo.storage
+
+        def build_url(name):
+            url = storage.url(name)
+            return request.build_absolute_uri(url) if request else url
+
+        return {fmt: srcset(obj.logo_renditions, fmt, build_url) for fmt in ('webp', 'png')}
+
+
+class NearbyRadioSerializer(PublicRadioSerializer):
+    """Public radio with its distance (km) from the point asked for, passed in the context"""
+    distance = serializers.SerializerMethodField()
+
+    class Meta(PublicRadioSerializer.Meta):
+        fields = PublicRadioSerializer.Meta.fields + ['distance']
+
+    def get_distance(self, obj):
+        return round(self.context['distances'][obj.id], 1)
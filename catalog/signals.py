@@ -0,0 +1,61 @@
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.dispatch import receiver
+from django.utils import timezone
+from catalog.models import Radio, Stream, Genre, Country, Region, City, Language, IndexVersion
+
+# Radio fields written by voting, they do not change any index content
+VOTE_FIELDS = {'total_votes', 'total_score', 'rating', 'weighted_rating'}
+
+
+@receiver(post_save, sender=Radio)
+def radio_saved(sender, instance, update_fields=None, **kwargs):
+    if update_fields and set(update_fields) <= VOTE_FIELDS:
+        # Only the ratings moved, the indexes are still valid
+        IndexVersion.bump(IndexVersion.VOTES)
+        return
+    IndexVersion.bump(IndexVersion.RADIOS)
+
+
+@receiver(post_delete, sender=Radio)
+@receiver(post_save, sender=Stream)
+def radio_changed(sender, **kwargs):
+    IndexVersion.bump(IndexVersion.RADIOS)
+
+
+@receiver(post_delete, sender=Stream)
+def stream_deleted(sender, instance, **kwargs):
+    # A deleted stream leaves no row behind, move `modified` so the incremental exports see the radio
+    Radio.objects.filter(pk=instance.radio_id).update(modified=timezone.now())
+    IndexVersion.bump(IndexVersion.RADIOS)
+
+
+@receiver(m2m_changed, sender=Radio.genres.through)
+@receiver(m2m_changed, sender=Radio.languages.through)
+def radio_relations_changed(sender, instance, action, reverse, pk_set=None, **kwargs):
+    if action == 'pre_clear' and reverse:
+        # post_clear gets no pk_set, the radios of the genre (language) are gone by then
+        instance._cleared_radio_ids = list(
+            sender.objects.filter(**{instance._meta.model_name: instance}).values_list('radio_id', flat=True)
+        )
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        # Relations do not touch the radio row, move `modified` so the search index reindexes it
+        if action == 'post_clear' and reverse:
+            pk_set = instance.__dict__.pop('_cleared_radio_ids', None)
+        radio_ids = pk_set if reverse else [instance.pk]
+        if radio_ids:
+            Radio.objects.filter(pk__in=radio_ids).update(modified=timezone.now())
+        IndexVersion.bump(IndexVersion.RADIOS)
+
+
+@receiver(post_save, sender=Genre)
+@receiver(post_save, sender=Country)
+@receiver(post_save, sender=Region)
+@receiver(post_save, sender=City)
+@receiver(post_save, sender=Language)
+@receiver(post_delete, sender=Genre)
+@receiver(post_delete, sender=Country)
+@receiver(post_delete, sender=Region)
+@receiver(post_delete, sender=City)
+@receiver(post_delete, sender=Language)
+def reference_changed(sender, **kwargs):
+    IndexVersion.bump(IndexVersion.REFERENCE)
@@ -1,3 +1,358 @@
-from django.test import TestCase
+import json
+import os
+import shutil
+import tempfile
+from datetime import timedelta
+from io import BytesIO, StringIO
+from unittest import mock
 
-# Create your tests here.
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management import call_command
+from django.db import DatabaseError, connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from PIL import Image
+from rest_framework.request import Request
+from rest_framework.test import APIClient, APIRequestFactory
+
+from catalog import search
+from catalog.facets import get_facet_index
+from catalog.models import (
+    Radio, Stream, StreamHealth, StreamProbe, Country, City, Genre, Language, VerificationStatus
+)
+from catalog.probes import normalize_url, save_probes
+from catalog.serializers import PublicRadioSerializer, RadioSerializer
+from catalog.views import PublicRadioCatalogViewSet
+from mobile_application.models import ServerType
+from users.models import User
+
+
+class PublicCatalogQueryCountTest(TestCase):
+    """The public catalog must not issue any query per radio"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(email='owner@example.com')
+        cls.country = Country.objects.create(name='Россия', name_eng='Russia', iso2='RU')
+        cls.city = City.objects.create(name='Москва', name_eng='Moscow', country=cls.country)
+        cls.genre = Genre.objects.create(name='Рок', name_eng='Rock')
+        cls.language = Language.objects.create(name='Русский', name_eng='Russian')
+
+    def create_radios(self, count):
+        for _ in range(count):
+            radio = Radio.objects.create(
+                name=f'Radio {Radio.objects.count()}', country=self.country, city=self.city, user=self.user
+            )
+            radio.genres.set([self.genre])
+            radio.languages.set([self.language])
+            Stream.objects.create(radio=radio, stream_url='http://example.com/off', audio_format='mp3', bitrate=128, enabled=False)
+            Stream.objects.create(radio=radio, stream_url='http://example.com/live', audio_format='mp3', bitrate=128)
+
+    def count_list_queries(self):
+        cache.clear()
+        # The in-process indexes are built once per change, not per request
+        get_facet_index()
+        with CaptureQueriesContext(connection) as context:
+            response = APIClient().get('/api/v1/catalog/public/', {'lang': 'ru', 'per_page': 100})
+        self.assertEqual(response.status_code, 200)
+        return len(context.captured_queries), response
+
+    def test_list_query_count_does_not_depend_on_page_size(self):
+        self.create_radios(2)
+        queries_small, _ = self.count_list_queries()
+        self.create_radios(8)
+        queries_large, response = self.count_list_queries()
+
+        self.assertEqual(len(response.data['results']), 10)
+        self.assertEqual(queries_small, queries_large)
+
+    def test_serializer_reads_prefetched_data_only(self):
+        self.create_radios(5)
+        request = Request(APIRequestFactory().get('/api/v1/catalog/public/', {'lang': 'ru'}))
+        view = PublicRadioCatalogViewSet(request=request, format_kwarg=None)
+        radios = list(view.get_queryset())
+
+        with self.assertNumQueries(0):
+            data = PublicRadioSerializer(radios, many=True, context={'request': request}).data
+
+        self.assertEqual(len(data), 5)
+        for row in data:
+            self.assertEqual(row['default_stream'], 'http://example.com/live')
+            self.assertEqual(row['genres'], ['Рок'])
+            self.assertEqual(row['languages'], ['Русский'])
+
+
+class CachedResponseTest(TestCase):
+    """A cached page holds absolute links, it is only served back to its own host"""
+
+    def test_cached_page_links_point_to_the_requesting_host(self):
+        country = Country.objects.create(name='Россия', name_eng='Russia', iso2='RU')
+        City.objects.bulk_create([City(name=name, name_eng=name, country=country) for name in ('Kazan', 'Moscow')])
+        cache.clear()
+        for host in ('api.example.com', 'api.example.org'):
+            response = APIClient().get('/api/v1/catalog/cities/', {'limit': 1}, HTTP_HOST=host)
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response.data['next'].startswith(f'http://{host}/'))
+
+
+class SearchIndexTest(TestCase):
+    """The incremental refresh of the search index must follow every catalog write"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(email='owner@example.com')
+        cls.country = Country.objects.create(name='Россия', name_eng='Russia', iso2='RU')
+        cls.genre = Genre.objects.create(name='Джаз', name_eng='Jazz')
+
+    def setUp(self):
+        search._index = None
+
+    def create_radios(self, count):
+        radios = [Radio.objects.create(name=f'Radio {i}', country=self.country, user=self.user) for i in range(count)]
+        for radio in radios:
+            radio.genres.set([self.genre])
+        # Out of the refresh margin of the latest radio, only a moved `modified` gets them reindexed
+        Radio.objects.update(modified=timezone.now() - timedelta(days=1))
+        Radio.objects.create(name='Latest', country=self.country, user=self.user)
+        return radios
+
+    def test_reverse_clear_reindexes_the_radios(self):
+        radio, = self.create_radios(1)
+        self.assertEqual(search.search_radios('jazz'), [radio.id])
+
+        self.genre.radios.clear()
+        self.assertEqual(search.search_radios('jazz'), [])
+
+    def test_deleted_and_disabled_radios_are_evicted(self):
+        deleted, disabled, kept = self.create_radios(3)
+        self.assertEqual(len(search.search_radios('jazz')), 3)
+
+        Radio.objects.filter(id=disabled.id).update(enabled=False)
+        deleted.delete()
+        self.assertEqual(search.search_radios('jazz'), [kept.id])
+
+    def test_total_counts_the_matches_past_the_ranked_ones(self):
+        self.create_radios(3)
+        with mock.patch('catalog.views.MAX_RANKED', 1):
+            response = APIClient().get('/api/v1/catalog/public/', {'search': 'jazz'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['total'], 3)
+        self.assertEqual(len(response.data['results']), 3)
+
+
+class RadioSerializerStreamsTest(TestCase):
+    """Stream edits through RadioSerializer: probes of the new URLs, rows of the kept ones"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(email='owner@example.com')
+        cls.country = Country.objects.create(name='Россия', name_eng='Russia', iso2='RU')
+
+    def setUp(self):
+        self.radio = Radio.objects.create(name='Radio', country=self.country, user=self.user, logo='catalog_logos/radio.png')
+        self.disabled = Stream.objects.create(
+            radio=self.radio, stream_url='http://example.com/down', audio_format='mp3', bitrate=128, enabled=False
+        )
+        StreamHealth.objects.create(stream=self.disabled, consecutive_failures=3)
+        self.live = Stream.objects.create(radio=self.radio, stream_url='http://example.com/live', audio_format='mp3', bitrate=128)
+
+    def update_streams(self, streams):
+        def run_probe(url, timeout=5):
+            return StreamProbe(url=normalize_url(url), ok=True, content_type='audio/mpeg', checked_at=timezone.now())
+
+        serializer = RadioSerializer(self.radio, data={'streams': streams}, partial=True)
+        with mock.patch('catalog.probes.run_probe', run_probe):
+            self.assertTrue(serializer.is_valid(), serializer.errors)
+            serializer.save()
+
+    def stream(self, url, bitrate=128):
+        return {'stream_url': url, 'audio_format': 'mp3', 'bitrate': bitrate, 'server_type': ServerType.SHOUTCAST}
+
+    def test_new_url_is_probed_and_saved(self):
+        self.update_streams([self.stream('http://example.com/live'), self.stream('http://EXAMPLE.com:80/new')])
+
+        probe = StreamProbe.objects.get()
+        self.assertEqual(probe.url, 'http://example.com/new')
+        self.assertTrue(probe.ok)
+        # A second probe of the URL updates the row
+        StreamProbe.objects.update(checked_at=timezone.now() - timedelta(days=1))
+        save_probes([StreamProbe(url=probe.url, ok=False, error='connection_error', checked_at=timezone.now())])
+        self.assertFalse(StreamProbe.objects.get().ok)
+
+    def test_upsert_has_no_conflict_target_without_backend_support(self):
+        with mock.patch.object(connection.features, 'supports_update_conflicts_with_target', False), \
+                mock.patch.object(StreamProbe.objects, 'bulk_create') as bulk_create:
+            save_probes([StreamProbe(url='http://example.com/', ok=True, checked_at=timezone.now())])
+        self.assertIsNone(bulk_create.call_args.kwargs['unique_fields'])
+
+    @override_settings(CATALOG_DEFERRED_VALIDATION=True)
+    def test_deferred_edit_of_a_verified_radio_keeps_it_enabled(self):
+        self.update_streams([self.stream('http://example.com/live'), self.stream('http://example.com/new')])
+
+        self.radio.refresh_from_db()
+        self.assertTrue(self.radio.enabled)
+        self.assertEqual(self.radio.verification_status, VerificationStatus.PENDING_EDIT)
+        self.assertFalse(self.radio.streams.get(stream_url='http://example.com/new').enabled)
+
+    def test_probe_key_fits_the_longest_stream_url(self):
+        max_length = Stream._meta.get_field('stream_url').max_length
+        url = 'http://' + 'a' * (max_length - len('http://.com')) + '.com'
+        self.assertEqual(len(url), max_length)
+        self.assertLessEqual(len(normalize_url(url)), StreamProbe._meta.get_field('url').max_length)
+
+    def test_kept_streams_keep_their_status_and_health(self):
+        self.update_streams([self.stream('http://example.com/down', bitrate=64), self.stream('http://example.com/new')])
+
+        self.disabled.refresh_from_db()
+        self.assertFalse(self.disabled.enabled)
+        self.assertEqual(self.disabled.bitrate, 64)
+        self.assertEqual(self.disabled.health.consecutive_failures, 3)
+        self.assertFalse(Stream.objects.filter(id=self.live.id).exists())
+        self.assertEqual(
+            sorted(self.radio.streams.values_list('stream_url', 'enabled')),
+            [('http://example.com/down', False), ('http://example.com/new', True)],
+        )
+
+
+class VerifyRadiosTest(TestCase):
+    """Deferred verification: a new radio is published if it passes, an edit never unpublishes one"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(email='owner@example.com')
+        cls.country = Country.objects.create(name='Россия', name_eng='Russia', iso2='RU')
+
+    def create_radio(self, status, enabled, urls):
+        radio = Radio.objects.create(
+            name='Radio', country=self.country, user=self.user, logo='catalog_logos/radio.png',
+            enabled=enabled, verification_status=status,
+        )
+        for url in urls:
+            Stream.objects.create(radio=radio, stream_url=url, audio_format='mp3', bitrate=128, enabled=False)
+        return radio
+
+    def verify(self):
+        def run_probe(url, timeout=5):
+            ok = 'typo' not in url
+            return StreamProbe(url=normalize_url(url), ok=ok, error='' if ok else 'connection_error', checked_at=timezone.now())
+
+        with mock.patch('catalog.management.commands.verify_radios.run_probe', run_probe), \
+                mock.patch('catalog.management.commands.verify_radios.check_website', return_value=''):
+            call_command('verify_radios', stdout=StringIO())
+
+    def test_first_submission_is_enabled_when_it_passes(self):
+        radio = self.create_radio(VerificationStatus.PENDING, False, ['http://example.com/live'])
+        self.verify()
+
+        radio.refresh_from_db()
+        self.assertTrue(radio.enabled)
+        self.assertEqual(radio.verification_status, VerificationStatus.VERIFIED)
+        self.assertTrue(radio.streams.get().enabled)
+
+    def test_failed_edit_keeps_the_radio_as_it_was(self):
+        live = self.create_radio(VerificationStatus.PENDING_EDIT, True, ['http://example.com/new', 'http://example.com/typo'])
+        hidden = self.create_radio(VerificationStatus.PENDING_EDIT, False, ['http://example.com/new'])
+        self.verify()
+
+        live.refresh_from_db()
+        self.assertTrue(live.enabled)
+        self.assertEqual(live.verification_status, VerificationStatus.VERIFIED)
+        self.assertEqual(live.verification_errors, {'streams': [{}, {'stream_url': ['connection_error']}]})
+        self.assertEqual(
+            sorted(live.streams.values_list('stream_url', 'enabled')),
+            [('http://example.com/new', True), ('http://example.com/typo', False)],
+        )
+        hidden.refresh_from_db()
+        self.assertFalse(hidden.enabled)
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+class ImportRadiosTest(TestCase):
+    """Logos are copied from the disk, and removed again if their chunk is not inserted"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(email='owner@example.com')
+        Country.objects.create(name='Россия', name_eng='Russia', iso2='RU')
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        Image.new('RGB', (300, 300)).save(os.path.join(self.directory, 'logo.png'))
+        Image.new('RGB', (300, 200)).save(os.path.join(self.directory, 'wide.png'))
+        self.path = os.path.join(self.directory, 'radios.ndjson')
+        with open(self.path, 'w') as f:
+            for name, logo in (('Radio', 'logo.png'), ('Wide', 'wide.png')):
+                f.write(json.dumps({
+                    'name': name, 'country': 'RU', 'logo': logo,
+                    'streams': [{'stream_url': 'http://example.com/live', 'audio_format': 'mp3', 'bitrate': 128}],
+                }) + '\n')
+
+    def stored_logos(self):
+        directory = os.path.join(settings.MEDIA_ROOT, 'catalog_logos')
+        return os.listdir(directory) if os.path.isdir(directory) else []
+
+    def import_radios(self):
+        call_command('import_radios', self.path, user=str(self.user.pk), stdout=StringIO(), stderr=StringIO())
+
+    def test_valid_logos_are_stored(self):
+        self.import_radios()
+
+        self.assertEqual(Radio.objects.get(name='Radio').logo.name, 'catalog_logos/logo.png')
+        self.assertEqual(Radio.objects.get(name='Wide').logo.name, '')
+        self.assertEqual(self.stored_logos(), ['logo.png'])
+
+    def test_logos_of_a_failed_chunk_are_removed(self):
+        with mock.patch('catalog.management.commands.import_radios.Command.insert_chunk', side_effect=DatabaseError):
+            with self.assertRaises(DatabaseError):
+                self.import_radios()
+
+        self.assertFalse(Radio.objects.exists())
+        self.assertEqual(self.stored_logos(), [])
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+class RenderLogosTest(TestCase):
+    """The rendered logo stands in for the upload, no client gets a file larger than 512 px"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(email='owner@example.com')
+        cls.country = Country.objects.create(name='Россия', name_eng='Russia', iso2='RU')
+
+    def create_radio(self, size):
+        buffer = BytesIO()
+        Image.new('RGB', (size, size)).save(buffer, format='PNG')
+        logo = default_storage.save('catalog_logos/logo.png', ContentFile(buffer.getvalue()))
+        return Radio.objects.create(name='Radio', country=self.country, user=self.user, logo=logo)
+
+    def render_logos(self):
+        call_command('render_logos', workers=1, stdout=StringIO(), stderr=StringIO())
+
+    def test_large_logo_is_replaced_by_its_512_rendition(self):
+        radio = self.create_radio(1000)
+        self.render_logos()
+
+        radio.refresh_from_db()
+        self.assertEqual(radio.logo.name, radio.logo_renditions['png']['512'])
+        self.assertEqual(radio.logo.width, 512)
+        # A later save keeps the renditions, they are those of the logo
+        radio.save()
+        radio.refresh_from_db()
+        self.assertEqual(radio.logo_renditions['source'], radio.logo.name)
+        # Rendering again does not replace a rendition by another one
+        self.render_logos()
+        self.assertEqual(Radio.objects.get(id=radio.id).logo.name, radio.logo.name)
+
+    def test_small_logo_is_kept(self):
+        radio = self.create_radio(300)
+        upload = radio.logo.name
+        self.render_logos()
+
+        radio.refresh_from_db()
+        self.assertEqual(radio.logo.name, upload)
+        self.assertEqual(radio.logo_renditions['source'], radio.logo.name)
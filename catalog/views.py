@@ -1,7 +1,8 @@
 import logging
 
 from django.utils import timezone
-from django.db.models import Q, Prefetch
+from django.db import IntegrityError, transaction
+from django.db.models import Q, Prefetch, Case, When, IntegerField
 
 from rest_framework.views import APIView
 
@@ -15,14 +16,23 @@ def _get_client_ip(request):
     return ip or 'unknown'
 
 from rest_framework import viewsets, permissions, parsers
+from rest_framework.decorators import action
 from rest_framework.response import Response
-from rest_framework.pagination import PageNumberPagination
+from rest_framework.pagination import PageNumberPagination, BasePagination
+from rest_framework.exceptions import NotFound
+from django.utils.dateparse import parse_datetime
+import base64
 import json
-from .models import Radio, Language, Country, Genre, Vote, Region, City, Stream
+from .models import Radio, Language, Country, Genre, Vote, Region, City, Stream, SimilarRadio, IndexVersion
+from .caching import CachedResponseMixin, get_catalog_cache
+from .facets import get_facet_index, to_bitset, FACETS
+from .geo import get_geo_index
+from .registry import get_registry
+from .search import search_radios, MAX_RANKED
 from .serializers import (
     RadioSerializer, LanguageSerializer, CountrySerializer,
     GenreSerializer, VoteSerializer, RegionSerializer, CitySerializer,
-    PublicRadioSerializer
+    PublicRadioSerializer, NearbyRadioSerializer
 )
 
 
@@ -117,19 +127,19 @@ class RadioViewSet(viewsets.ModelViewSet):
         return super().destroy(request, *args, **kwargs)
 
 
-class LanguageViewSet(viewsets.ReadOnlyModelViewSet):
+class LanguageViewSet(CachedResponseMixin, viewsets.ReadOnlyModelViewSet):
     queryset = Language.objects.all()
     serializer_class = LanguageSerializer
     permission_classes = [permissions.IsAuthenticated]
 
 
-class CountryViewSet(viewsets.ReadOnlyModelViewSet):
+class CountryViewSet(CachedResponseMixin, viewsets.ReadOnlyModelViewSet):
     queryset = Country.objects.order_by('name_eng')
     serializer_class = CountrySerializer
     permission_classes = [permissions.IsAuthenticated]
 
 
-class GenreViewSet(viewsets.ReadOnlyModelViewSet):
+class GenreViewSet(CachedResponseMixin, viewsets.ReadOnlyModelViewSet):
     queryset = Genre.objects.all()
     serializer_class = GenreSerializer
     permission_classes = [permissions.IsAuthenticated]
@@ -143,6 +153,10 @@ class VoteViewSet(APIView):
         radio_id = request.data.get('radio_id')
         if not radio_id:
             return Response({"error": "radio_not_set"}, status=400)
+        try:
+            radio_id = int(radio_id)
+        except (TypeError, ValueError):
+            return Response({"error": "radio_not_found"}, status=400)
 
         ip = request.META.get('HTTP_X_FORWARDED_FOR') or request.META.get('REMOTE_ADDR')
         if not ip:
@@ -151,32 +165,73 @@ class VoteViewSet(APIView):
         score = request.data.get('score')
         if score is None:
             return Response({"error": "score_not_set"}, status=400)
-        
         try:
-            radio = Radio.objects.get(id=radio_id)
-        except Radio.DoesNotExist:
-            return Response({"error": "radio_not_found"}, status=400)
+            score = int(score)
+        except (TypeError, ValueError):
+            return Response({"error": "score_invalid"}, status=400)
+        if not 1 <= score <= 5:
+            return Response({"error": "score_invalid"}, status=400)
+
+        # Repeated votes are turned down by the cache, without touching the database
+        ttl = Vote.ttl()
+        dedupe_key = f'catalog-vote:{radio_id}:{ip}'
+        cache = get_catalog_cache()
+        if not cache.add(dedupe_key, 1, ttl):
+            return Response({"error": "vote_exists"}, status=403)
 
-        # Delete Vote object older than 1 hour
-        Vote.objects.filter(created__lt=timezone.now()-timezone.timedelta(hours=1)).delete()
-        if Vote.objects.filter(radio=radio, ip=ip).exists():
+        try:
+            with transaction.atomic():
+                if not Radio.add_vote(radio_id, score):
+                    cache.delete(dedupe_key)
+                    return Response({"error": "radio_not_found"}, status=400)
+                # The unique (radio, ip) row is the source of truth, the cache is per server.
+                # An expired row the purge_votes job has not removed yet must not block the vote
+                Vote.objects.filter(
+                    radio_id=radio_id, ip=ip, created__lt=timezone.now() - timezone.timedelta(seconds=ttl)
+                ).delete()
+                Vote.objects.create(radio_id=radio_id, ip=ip)
+        except IntegrityError:
             return Response({"error": "vote_exists"}, status=403)
-            
-        Vote.objects.create(
-            radio=radio,
-            ip=ip,
-        )
-        
-        radio.total_votes += 1
-        radio.total_score += int(score)
-        radio.save(update_fields=['total_votes', 'total_score'])
+
+        # A queryset update sends no signal
+        IndexVersion.bump(IndexVersion.VOTES)
         return Response({}, status=201)
 
 
-class RegionViewSet(viewsets.ReadOnlyModelViewSet):
+class AutocompleteMixin:
+    """
+    Typeahead over the reference registry: ?q=<prefix>, scoped by the
+    autocomplete_scope query parameters, at most `limit` compact rows.
+    No SQL besides the registry version stamp
+    """
+    registry_key = None
+    autocomplete_scope = ()
+    autocomplete_size = 10
+    max_autocomplete_size = 50
+
+    @action(detail=False, methods=['get'])
+    def autocomplete(self, request):
+        params = request.query_params
+        scope = {}
+        try:
+            for param in self.autocomplete_scope:
+                if params.get(param):
+                    scope[param] = int(params[param])
+            limit = int(params.get('limit') or self.autocomplete_size)
+        except ValueError:
+            return Response({"error": "invalid_parameter"}, status=400)
+        limit = max(1, min(limit, self.max_autocomplete_size))
+
+        rows = get_registry().autocomplete(self.registry_key, params.get('q', ''), limit, **scope)
+        return Response([{'id': row.id, 'name': row.name, 'name_eng': row.name_eng} for row in rows])
+
+
+class RegionViewSet(AutocompleteMixin, CachedResponseMixin, viewsets.ReadOnlyModelViewSet):
     queryset = Region.objects.order_by('name_eng')
     serializer_class = RegionSerializer
     permission_classes = [permissions.IsAuthenticated]
+    registry_key = 'regions'
+    autocomplete_scope = ('country_id',)
 
     def get_queryset(self):
         queryset = super().get_queryset()
@@ -186,9 +241,11 @@ class RegionViewSet(viewsets.ReadOnlyModelViewSet):
         return queryset
 
 
-class CityViewSet(viewsets.ReadOnlyModelViewSet):
+class CityViewSet(AutocompleteMixin, CachedResponseMixin, viewsets.ReadOnlyModelViewSet):
     queryset = City.objects.order_by('name_eng')
     serializer_class = CitySerializer
+    registry_key = 'cities'
+    autocomplete_scope = ('country_id', 'region_id')
 
     def get_queryset(self):
         queryset = super().get_queryset()
@@ -208,85 +265,169 @@ class CatalogPagination(PageNumberPagination):
     max_page_size = 100
 
 
-class PublicRadioCatalogViewSet(viewsets.ReadOnlyModelViewSet):
+class CatalogCursorPagination(BasePagination):
+    """
+    Keyset pagination for public catalog (infinite scroll in the mobile apps).
+    The cursor holds the sort value and the id of the last radio of the page,
+    the next page is a range scan of the (enabled, <sort field>, id) index:
+    no COUNT(*) and no OFFSET whatever the depth.
+    """
+    page_size = 30
+    page_size_query_param = 'per_page'
+    max_page_size = 100
+    cursor_query_param = 'cursor'
+
+    # Sort parameter -> field, every order is descending with the id as tiebreaker
+    sort_fields = {
+        'rating': 'rating',
+        'weighted': 'weighted_rating',
+        'votes': 'total_votes',
+        'created': 'created',
+    }
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params.get(self.page_size_query_param, self.page_size))
+        except ValueError:
+            return self.page_size
+        return min(max(page_size, 1), self.max_page_size)
+
+    def decode_cursor(self, cursor, field):
+        try:
+            value, pk = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+            if field == 'created':
+                value = parse_datetime(value)
+                if value is None:
+                    raise ValueError
+            return value, int(pk)
+        except (TypeError, ValueError):
+            raise NotFound("Invalid cursor")
+
+    def encode_cursor(self, radio, field):
+        value = getattr(radio, field)
+        if field == 'created':
+            value = value.isoformat()
+        return base64.urlsafe_b64encode(json.dumps([value, radio.pk]).encode()).decode()
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.view = view
+        self.page_size = self.get_page_size(request)
+        field = self.sort_fields[view.sort]
+        queryset = queryset.order_by(f'-{field}', '-id')
+
+        cursor = request.query_params.get(self.cursor_query_param, '').strip()
+        if cursor:
+            value, pk = self.decode_cursor(cursor, field)
+            queryset = queryset.filter(Q(**{f'{field}__lt': value}) | Q(**{field: value, 'id__lt': pk}))
+
+        # One extra row tells whether there is a next page
+        page = list(queryset[:self.page_size + 1])
+        self.next_cursor = self.encode_cursor(page[self.page_size - 1], field) if len(page) > self.page_size else None
+        return page[:self.page_size]
+
+    def get_paginated_response(self, data):
+        response = {
+            'next_cursor': self.next_cursor,
+            'per_page': self.page_size,
+            'results': data,
+        }
+        if self.request.query_params.get('with_total'):
+            response['total'] = self.view.estimate_total()
+        return Response(response)
+
+
+class PublicRadioCatalogViewSet(CachedResponseMixin, viewsets.ReadOnlyModelViewSet):
     """
     Public API endpoint for radio catalog.
     Does not require authentication.
     Supports filtering, searching, sorting, and pagination.
+    Responses are cached until a radio, stream, vote or reference data write.
     """
     serializer_class = PublicRadioSerializer
     permission_classes = [permissions.AllowAny]
     pagination_class = CatalogPagination
+    cache_tags = (IndexVersion.RADIOS, IndexVersion.REFERENCE, IndexVersion.VOTES)
+    search_ids = None
+    sort = 'rating'
+    # Default and maximum number of radios of the nearby lookup
+    nearby_size = 30
+    max_nearby_size = 100
+    # Default and maximum number of radios of the similar stations
+    similar_size = 10
+    max_similar_size = 20
+
+    def is_cursor_mode(self):
+        params = self.request.query_params
+        return params.get('pagination') == 'cursor' or CatalogCursorPagination.cursor_query_param in params
+
+    @property
+    def paginator(self):
+        """Page numbers by default, keyset pagination on demand"""
+        if not hasattr(self, '_paginator'):
+            if self.is_cursor_mode():
+                self._paginator = CatalogCursorPagination()
+            else:
+                self._paginator = self.pagination_class()
+        return self._paginator
+
+    def get_base_queryset(self):
+        return Radio.objects.filter(enabled=True).select_related(
+            'country', 'region', 'city'
+        ).prefetch_related(
+            'genres', 'languages', 
+            Prefetch('streams', queryset=Stream.objects.filter(enabled=True).order_by('id'))
+        )
 
     def get_queryset(self):
         """
         Build queryset with filtering, searching, and sorting
         """
-        queryset = Radio.objects.filter(enabled=True).select_related(
-            'country', 'region', 'city'
-        ).prefetch_related(
-            'genres', 'languages', 
-            Prefetch('streams', queryset=Stream.objects.filter(enabled=True))
-        )
+        queryset = self.get_base_queryset()
 
         # Get query parameters
         search = self.request.query_params.get('search', '').strip()
-        genre = self.request.query_params.get('genre', '').strip()
-        country = self.request.query_params.get('country', '').strip()
-        region = self.request.query_params.get('region', '').strip()
-        city = self.request.query_params.get('city', '').strip()
-        language = self.request.query_params.get('language', '').strip()
-        sort = self.request.query_params.get('sort', 'rating').strip()
-
-        # Apply search filter (minimum 3 characters)
+        # Search results are ranked by relevance unless another order is asked for
+        sort = self.request.query_params.get('sort', '').strip() or ('relevance' if search else 'rating')
+        if self.is_cursor_mode() and sort not in CatalogCursorPagination.sort_fields:
+            # There is no key to seek on for relevance
+            sort = 'rating'
+        self.sort = sort
+
+        # Apply search filter (minimum 3 characters), served by the search index
+        self.search_ids = None
         if search and len(search) >= 3:
-            queryset = queryset.filter(
-                Q(name__icontains=search) |
-                Q(description__icontains=search) |
-                Q(genres__name_eng__icontains=search) |
-                Q(genres__name__icontains=search) |
-                Q(country__name_eng__icontains=search) |
-                Q(country__name__icontains=search) |
-                Q(city__name_eng__icontains=search) |
-                Q(city__name__icontains=search)
-            ).distinct()
-
-        # Apply filters
-        if genre:
-            queryset = queryset.filter(
-                Q(genres__name_eng__iexact=genre) | Q(genres__name__iexact=genre)
-            )
-        
-        if country:
-            queryset = queryset.filter(
-                Q(country__name_eng__iexact=country) | Q(country__name__iexact=country)
-            )
-        
-        if region:
-            queryset = queryset.filter(
-                Q(region__name_eng__iexact=region) | Q(region__name__iexact=region)
-            )
-        
-        if city:
-            queryset = queryset.filter(
-                Q(city__name_eng__iexact=city) | Q(city__name__iexact=city)
-            )
-        
-        if language:
-            queryset = queryset.filter(
-                Q(languages__name_eng__iexact=language) | Q(languages__name__iexact=language)
-            )
+            self.search_ids = search_radios(search)
+            queryset = queryset.filter(id__in=self.search_ids)
+
+        # Apply filters: the names resolve to ids in the reference registry,
+        # the database gets plain id filters without joins on the reference tables
+        registry = get_registry()
+        for key, param, field in FACETS:
+            value = self.request.query_params.get(param, '').strip()
+            if value:
+                queryset = queryset.filter(**{f'{field}__in': registry.ids(key, value)})
 
         # Apply sorting
-        if sort == 'votes':
-            queryset = queryset.order_by('-total_votes')
+        if sort == 'relevance' and self.search_ids is not None:
+            # The matches past the first MAX_RANKED follow by rating, the CASE stays bounded
+            ranked = self.search_ids[:MAX_RANKED]
+            queryset = queryset.order_by(
+                Case(
+                    *[When(pk=pk, then=pos) for pos, pk in enumerate(ranked)],
+                    default=len(ranked), output_field=IntegerField(),
+                ),
+                '-rating', '-id',
+            )
+        elif sort == 'votes':
+            queryset = queryset.order_by('-total_votes', '-id')
         elif sort == 'created':
-            queryset = queryset.order_by('-created')
+            queryset = queryset.order_by('-created', '-id')
+        elif sort == 'weighted':
+            queryset = queryset.order_by('-weighted_rating', '-id')
         else:  # default to rating
-            # Sort by rating calculation: total_score / total_votes (handle division by zero)
-            queryset = queryset.extra(
-                select={'rating_calc': 'CASE WHEN total_votes > 0 THEN CAST(total_score AS FLOAT) / total_votes ELSE 0 END'}
-            ).order_by('-rating_calc')
+            # Stored rating, the id keeps the order stable between pages
+            queryset = queryset.order_by('-rating', '-id')
 
         return queryset
 
@@ -294,6 +435,9 @@ class PublicRadioCatalogViewSet(viewsets.ReadOnlyModelViewSet):
         """
         Override list method to add filters in response
         """
+        return self.cached_response(self._list, request, *args, **kwargs)
+
+    def _list(self, request, *args, **kwargs):
         queryset = self.filter_queryset(self.get_queryset())
         
         page = self.paginate_queryset(queryset)
@@ -314,47 +458,115 @@ class PublicRadioCatalogViewSet(viewsets.ReadOnlyModelViewSet):
             'filters': self._get_available_filters(queryset)
         })
 
+    @action(detail=False, methods=['get'])
+    def nearby(self, request):
+        """
+        Radios near a point: ?lat=&lon= and a radius in km and/or the number
+        of radios k (default 30, at most 100), ranked by distance then by
+        weighted rating. The catalog filters (genre, country...) apply.
+        Served by the geo index, the database only loads the radios returned.
+        """
+        params = request.query_params
+        try:
+            latitude = float(params['lat'])
+            longitude = float(params['lon'])
+        except (KeyError, ValueError):
+            return Response({"error": "coordinates_invalid"}, status=400)
+        if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+            return Response({"error": "coordinates_invalid"}, status=400)
+        try:
+            radius = float(params['radius']) if params.get('radius') else None
+            limit = int(params['k']) if params.get('k') else None
+        except ValueError:
+            return Response({"error": "radius_invalid"}, status=400)
+        if radius is not None and radius <= 0:
+            return Response({"error": "radius_invalid"}, status=400)
+        if limit is None:
+            limit = self.max_nearby_size if radius is not None else self.nearby_size
+        limit = max(1, min(limit, self.max_nearby_size))
+
+        accept = None
+        if any(params.get(param, '').strip() for _, param, _ in FACETS):
+            bits = get_facet_index().select(params)
+            accept = lambda radio_id: bits >> radio_id & 1
+
+        candidates = get_geo_index().nearby(latitude, longitude, radius=radius, limit=limit, accept=accept)
+        distances = {radio_id: distance for distance, radio_id in candidates}
+        # The candidates of the farthest city may exceed the limit: rank them before cutting
+        ratings = dict(Radio.objects.filter(id__in=list(distances)).values_list('id', 'weighted_rating'))
+        ranked = sorted(
+            (radio_id for radio_id in distances if radio_id in ratings),
+            key=lambda radio_id: (distances[radio_id], -ratings[radio_id], radio_id)
+        )[:limit]
+
+        radios = self.get_base_queryset().in_bulk(ranked)
+        serializer = NearbyRadioSerializer(
+            [radios[radio_id] for radio_id in ranked if radio_id in radios],
+            many=True,
+            context={**self.get_serializer_context(), 'distances': distances},
+        )
+        return Response({'results': serializer.data})
+
+    @action(detail=True, methods=['get'])
+    def similar(self, request, pk=None):
+        """
+        Radios similar to this one by genres, languages and country, most similar
+        first, ?k= of them (default 10, at most 20). Precomputed by the
+        build_similar_radios command, the lookup reads the neighbor table only.
+        """
+        try:
+            radio_id = int(pk)
+        except ValueError:
+            raise NotFound()
+        if not Radio.objects.filter(id=radio_id, enabled=True).exists():
+            raise NotFound()
+        try:
+            limit = int(request.query_params['k']) if request.query_params.get('k') else self.similar_size
+        except ValueError:
+            return Response({"error": "limit_invalid"}, status=400)
+        limit = max(1, min(limit, self.max_similar_size))
+
+        similar_ids = list(
+            SimilarRadio.objects.filter(radio_id=radio_id).order_by('rank').values_list('similar_id', flat=True)[:limit]
+        )
+        # A radio disabled since the last build is skipped
+        radios = self.get_base_queryset().in_bulk(similar_ids)
+        serializer = self.get_serializer([radios[i] for i in similar_ids if i in radios], many=True)
+        return Response({'results': serializer.data})
+
+    def _get_selected_radios(self):
+        """Facet index and the bitset of the radios matching the current filters and search"""
+        index = get_facet_index()
+        bits = index.select(self.request.query_params)
+        if self.search_ids is not None:
+            bits &= to_bitset(self.search_ids)
+        return index, bits
+
     def _get_available_filters(self, queryset):
         """
-        Get available filter options based on current queryset
+        Get available filter options based on current queryset.
+        Served from the facet and search indexes, no SQL involved.
         """
-        # Get lang parameter to determine which field to use
+        # Get lang parameter to determine which names to use
         lang = self.request.query_params.get('lang', '').strip()
-        name_field = 'name' if lang == 'ru' else 'name_eng'
-        
-        # Get distinct values for each filter
-        genres = Genre.objects.filter(
-            radios__in=queryset
-        ).distinct().values_list(name_field, flat=True)
-        
-        countries = Country.objects.filter(
-            radios__in=queryset
-        ).distinct().values_list(name_field, flat=True)
-        
-        regions = Region.objects.filter(
-            radios__in=queryset
-        ).exclude(**{f'{name_field}__isnull': True}).distinct().values_list(name_field, flat=True)
-        
-        cities = City.objects.filter(
-            radios__in=queryset
-        ).exclude(**{f'{name_field}__isnull': True}).distinct().values_list(name_field, flat=True)
-        
-        languages = Language.objects.filter(
-            radios__in=queryset
-        ).distinct().values_list(name_field, flat=True)
-
-        return {
-            'genres': sorted([g for g in genres if g]),
-            'countries': sorted([c for c in countries if c]),
-            'regions': sorted([r for r in regions if r]),
-            'cities': sorted([c for c in cities if c]),
-            'languages': sorted([lang for lang in languages if lang])
-        }
+        index, bits = self._get_selected_radios()
+        return index.available(bits, lang)
+
+    def estimate_total(self):
+        """
+        Number of radios matching the current filters, counted in the facet index
+        instead of a COUNT(*). Approximate: the index matches names case-insensitively
+        in Python, the database by its collation.
+        """
+        _, bits = self._get_selected_radios()
+        return bin(bits).count('1')
 
     def get_paginated_response(self, data):
         """
         Customize paginated response format
         """
+        if isinstance(self.paginator, CatalogCursorPagination):
+            return self.paginator.get_paginated_response(data)
         return Response({
             'total': self.paginator.page.paginator.count,
             'total_pages': self.paginator.page.paginator.num_pages,
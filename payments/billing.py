@@ -0,0 +1,286 @@
+"""
+Set-based daily billing of the self hosted and hosted radios.
+
+The charge command used to price every radio on its own (the user currency,
+the services price and the disk quota were each a query) and to charge every
+line in its own transaction. Users are now billed by chunks:
+
+- collect_lines() prices every radio of the chunk with two queries, the
+  services price and the disk quota being annotated on the hosted radios;
+- charge_lines() charges the lines in one transaction: the Charge rows are
+  inserted or ignored on their idempotency key (billing date, user, service,
+  description), so the lines already charged for the day are skipped without
+  a lookup or a lock, and the balances are updated by a single UPDATE, like
+  the monthly rollups of the charges (payments/rollups.py).
+
+A nightly run makes a few queries per chunk, whatever the number of radios.
+
+The users of a run are partitioned by id range into shards that separate
+processes charge in parallel (ChargeRun, ChargeShard). A shard is leased by a
+single process and records its position after every chunk, in the chunk
+transaction: a crashed shard is resumed after its last committed chunk. A chunk
+that fails is charged again by halves down to the users failing on their own,
+which are recorded on the shard and charged later by charge --retry-failed.
+"""
+import datetime
+import os
+import socket
+import traceback
+import uuid
+from collections import namedtuple
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import transaction, IntegrityError
+from django.db.models import F, Q, Case, When, Value, DecimalField, OuterRef, Subquery, Sum, Min, Max
+from django.utils import timezone
+
+from radiotochka.billing import PRICE_PER_EXTRA_GB, PRICE_PER_EXTRA_GB_USD
+from radio.models import SelfHostedRadio, HostedRadio, HostedRadioService, ServiceType
+from users.models import User
+from .models import Charge, ChargedServiceType, ChargeRun, ChargeShard
+from .rollups import add_charges
+
+
+# Charges and balances are stored with 6 decimal places
+PRICE_QUANTUM = Decimal('0.000001')
+
+# A line of the daily bill. dedupe_by_description: whether the description is part
+# of its idempotency key, not for the disk usage whose description changes between runs
+BillingLine = namedtuple('BillingLine', ('user_id', 'service_type', 'description', 'price', 'dedupe_by_description'))
+
+
+
+class LeaseLost(Exception):
+    """Another process took the shard over: this one stopped heartbeating for too long"""
+
+
+def lease_owner():
+    """Identifies the process holding a shard lease, worker processes are forked after the imports"""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def shard_lease():
+    """A shard whose heartbeat is older than this is considered crashed"""
+    return datetime.timedelta(seconds=getattr(settings, 'CHARGE_SHARD_LEASE', 600))
+
+
+def billable_users():
+    return User.objects.filter(Q(balance__gt=0) | Q(id__in=[2775, 2774]), is_staff=False)
+
+
+def daily_price(price, n_month_days):
+    return (Decimal(price) / Decimal(n_month_days)).quantize(PRICE_QUANTUM)
+
+
+def line(user_id, service_type, description, price, dedupe_by_description=True):
+    return BillingLine(user_id, service_type, description, price, dedupe_by_description)
+
+
+def line_key(billing_line, billing_date):
+    return Charge.make_key(
+        billing_date, billing_line.user_id, billing_line.service_type,
+        billing_line.description if billing_line.dedupe_by_description else None,
+    )
+
+
+def hosted_radios(user_ids):
+    """The hosted radios of the users, with their services price and disk quota annotated"""
+    services = HostedRadioService.objects.filter(radio=OuterRef('pk'))
+    return HostedRadio.objects.filter(user_id__in=user_ids).exclude(is_demo=True).annotate(
+        services_price=Subquery(services.values('radio').annotate(total=Sum('price')).values('total')[:1]),
+        # The last disk service, as get_disk_quota() reads it
+        disk_quota=Subquery(services.filter(service_type=ServiceType.DISK).order_by('-id').values('du')[:1]),
+    ).order_by('id')
+
+
+def collect_lines(users, n_month_days):
+    """The billable lines of the day of the users ({id: user}), in two queries"""
+    lines = []
+
+    for radio in SelfHostedRadio.objects.filter(user_id__in=list(users)).order_by('id'):
+        user = users[radio.user_id]
+        # The user is at hand, price() must not load it again
+        radio.user = user
+        try:
+            price = radio.price()
+            if price <= 0:
+                continue
+            description = radio.ip
+            if radio.domain:
+                description += f" ({radio.domain})"
+            lines.append(line(user.id, ChargedServiceType.RADIO_SELF_HOSTED, description, daily_price(price, n_month_days)))
+        except Exception as e:
+            print(f"Failed to charge self hosted radio {radio.pk} of user {user.pk} ({user.email}): {e}")
+            traceback.print_exc()
+
+    for radio in hosted_radios(list(users)):
+        user = users[radio.user_id]
+        radio.user = user
+        try:
+            price = radio.price()
+            if price <= 0:
+                continue
+            radio_lines = [line(user.id, ChargedServiceType.RADIO_HOSTED_STREAM, radio.login, daily_price(price, n_month_days))]
+
+            # Disk usage extra
+            above_allowed_du = radio.disk_usage - radio.get_disk_quota() * 1024.
+            if above_allowed_du > 0:
+                du_price = PRICE_PER_EXTRA_GB_USD if user.is_usd() else PRICE_PER_EXTRA_GB
+                radio_lines.append(line(
+                    user.id, ChargedServiceType.RADIO_HOSTED_DU, str(above_allowed_du),
+                    Decimal(du_price / n_month_days * (above_allowed_du / 1024.)).quantize(PRICE_QUANTUM),
+                    dedupe_by_description=False,
+                ))
+            lines.extend(radio_lines)
+        except Exception as e:
+            print(f"Failed to charge hosted radio {radio.pk} of user {user.pk} ({user.email}): {e}")
+            traceback.print_exc()
+
+    return lines
+
+
+def charge_lines(users, lines, billing_date):
+    """
+    Charge the lines of the users ({id: user}) in one transaction and set
+    their balance. Returns the lines charged: those charged earlier for the
+    billing date (a re-run, an overlapping run) are skipped.
+    """
+    # The first of the lines sharing a key is charged, like the insert would keep it
+    keyed = {}
+    for billing_line in lines:
+        keyed.setdefault(line_key(billing_line, billing_date), billing_line)
+
+    batch = uuid.uuid4()
+    charges = {
+        key: Charge(
+            user_id=billing_line.user_id,
+            service_type=billing_line.service_type,
+            description=billing_line.description,
+            currency=users[billing_line.user_id].currency,
+            price=billing_line.price,
+            billing_date=billing_date,
+            idempotency_key=key,
+            batch=batch,
+        )
+        for key, billing_line in keyed.items()
+    }
+    deltas = {}
+    with transaction.atomic():
+        Charge.objects.bulk_create(list(charges.values()), ignore_conflicts=True)
+        # The rows of the batch are the lines actually inserted
+        inserted = set(Charge.objects.filter(batch=batch).values_list('idempotency_key', flat=True))
+        new_lines = [billing_line for key, billing_line in keyed.items() if key in inserted]
+        # Bulk inserts send no signals
+        add_charges(charges[key] for key in inserted)
+
+        for billing_line in new_lines:
+            deltas[billing_line.user_id] = deltas.get(billing_line.user_id, 0) + billing_line.price
+        if deltas:
+            # F() and a single statement for the whole chunk, a payment landing meanwhile is kept
+            User.objects.filter(id__in=list(deltas)).update(balance=F('balance') - Case(
+                *[When(id=user_id, then=Value(delta)) for user_id, delta in deltas.items()],
+                output_field=DecimalField(max_digits=12, decimal_places=6),
+            ))
+        balances = dict(User.objects.filter(id__in=list(users)).values_list('id', 'balance'))
+
+    for user_id, balance in balances.items():
+        users[user_id].balance = balance
+    return new_lines
+
+
+def shard_ranges(shard_count):
+    """Split the user ids in shard_count ranges of equal width, as (first id, last id or None)"""
+    bounds = User.objects.aggregate(first=Min('id'), last=Max('id'))
+    first, last = bounds['first'] or 0, bounds['last'] or 0
+    width = (last - first) // shard_count + 1
+    return [
+        (first + i * width if i else 0, first + (i + 1) * width - 1 if i < shard_count - 1 else None)
+        for i in range(shard_count)
+    ]
+
+
+def get_run(billing_date, shard_count):
+    """
+    The charge run of the date, created with its shards on first call.
+    Returns None if the run exists with another number of shards
+    """
+    try:
+        with transaction.atomic():
+            run, created = ChargeRun.objects.get_or_create(billing_date=billing_date, defaults={'shard_count': shard_count})
+            if created:
+                ChargeShard.objects.bulk_create([
+                    ChargeShard(run=run, shard=i + 1, first_user_id=first, last_user_id=last)
+                    for i, (first, last) in enumerate(shard_ranges(shard_count))
+                ])
+    except IntegrityError:
+        # Created by a concurrent process
+        run = ChargeRun.objects.get(billing_date=billing_date)
+    return run if run.shard_count == shard_count else None
+
+
+def claim_shard(run, shard_number):
+    """Lease the shard of the run to this process. Returns the shard, None if it is finished or leased"""
+    now = timezone.now()
+    owner = lease_owner()
+    claimed = ChargeShard.objects.filter(
+        Q(owner=owner) | Q(heartbeat__isnull=True) | Q(heartbeat__lt=now - shard_lease()),
+        run=run, shard=shard_number, finished__isnull=True,
+    ).update(owner=owner, heartbeat=now)
+    if not claimed:
+        return None
+    return ChargeShard.objects.get(run=run, shard=shard_number)
+
+
+def shard_users(shard, chunk_size):
+    """The next chunk of billable users of the shard, {id: user}"""
+    users = billable_users().filter(id__gt=max(shard.position, shard.first_user_id - 1))
+    if shard.last_user_id is not None:
+        users = users.filter(id__lte=shard.last_user_id)
+    return {user.id: user for user in users.order_by('id')[:chunk_size]}
+
+
+def save_progress(shard, position, failed_user_ids=(), **counters):
+    """
+    Move the shard past position, add to its counters and record the users that
+    failed, heartbeating the lease. Called in the chunk transaction: raises
+    LeaseLost, which rolls the chunk back, if another process took the shard over
+    """
+    fields = {}
+    if failed_user_ids:
+        # Only the lease owner writes the shard, the list read at the claim is current
+        fields['failed_user_ids'] = shard.failed_user_ids + list(failed_user_ids)
+    updated = ChargeShard.objects.filter(id=shard.id, owner=lease_owner()).update(
+        position=position,
+        heartbeat=timezone.now(),
+        **fields,
+        **{name: F(name) + value for name, value in counters.items() if value},
+    )
+    if not updated:
+        raise LeaseLost(f"Shard {shard.shard} is now charged by another process")
+    shard.position = position
+    shard.failed_user_ids = fields.get('failed_user_ids', shard.failed_user_ids)
+
+
+def save_retry(shard, user_id, **counters):
+    """
+    Drop a failed user charged by charge --retry-failed from the shard and add to
+    its counters. Called in the user transaction, once the run is finished
+    """
+    shard = ChargeShard.objects.select_for_update().get(id=shard.id)
+    ChargeShard.objects.filter(id=shard.id).update(
+        failed_user_ids=[failed for failed in shard.failed_user_ids if failed != user_id],
+        **{name: F(name) + value for name, value in counters.items() if value},
+    )
+
+
+def finish_shard(shard):
+    """
+    Mark the shard finished. Returns True if it was the last one of the run:
+    the caller then sends the daily summary, exactly once per run
+    """
+    now = timezone.now()
+    ChargeShard.objects.filter(id=shard.id, owner=lease_owner()).update(finished=now, heartbeat=now)
+    if ChargeShard.objects.filter(run_id=shard.run_id, finished__isnull=True).exists():
+        return False
+    return ChargeRun.objects.filter(id=shard.run_id, finished__isnull=True).update(finished=now) == 1
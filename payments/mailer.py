@@ -0,0 +1,216 @@
+"""
+Outgoing mail of the billing, decoupled from the charge run.
+
+The charge run only enqueues Notification rows, in its chunk transaction. The
+send_notifications command takes the due ones by batches, renders them and
+sends them over a small pool of persistent SMTP connections per sender
+(Radio-Tochka, Streaming.center), each connection served by its own thread and
+the sends of a sender throttled to a rate.
+
+A connection that fails is reopened by its thread and the message is tried
+once more on it (an idle timeout, a server restart); if it fails again it is
+retried later with an exponential backoff, until it runs out of attempts.
+A slow or dead mail server only delays its own messages.
+"""
+import datetime
+import queue
+import smtplib
+import threading
+import time
+
+from django.conf import settings
+from django.core.mail import EmailMessage, EmailMultiAlternatives, get_connection
+from django.template.loader import get_template
+from django.utils import timezone
+from django.utils.html import strip_tags
+
+from .models import Notification, NotificationSender, NotificationStatus
+
+
+# The server answered (e.g. a refused recipient): the connection works, the message is retried later
+SERVER_ERRORS = (smtplib.SMTPRecipientsRefused, smtplib.SMTPResponseException)
+
+
+def sender_connection(sender):
+    """A new, unopened SMTP connection of the sender"""
+    if sender == NotificationSender.STREAMING_CENTER:
+        return get_connection(
+            host=settings.SC_EMAIL_HOST,
+            port=settings.SC_EMAIL_PORT,
+            username=settings.SC_EMAIL_HOST_USER,
+            password=settings.SC_EMAIL_HOST_PASSWORD,
+            use_ssl=settings.SC_EMAIL_USE_SSL,
+            use_tls=settings.SC_EMAIL_USE_TLS,
+        )
+    return get_connection()
+
+
+def sender_email(sender):
+    return settings.SC_ADMIN_EMAIL if sender == NotificationSender.STREAMING_CENTER else settings.ADMIN_EMAIL
+
+
+def connection_label(sender, connection):
+    """Describe the mail server behind a connection, so the logs tell which one failed."""
+    name = dict(NotificationSender.choices)[sender]
+    host = getattr(connection, "host", None)
+    if not host:
+        # Console / file / locmem backends have no host
+        return f"{name} ({connection.__class__.__module__})"
+    username = getattr(connection, "username", None)
+    return f"{name} ({host}:{getattr(connection, 'port', '?')} as {username})"
+
+
+def render(notification):
+    """The email of the notification, html with a text alternative or plain text"""
+    from_email = sender_email(notification.sender)
+    if not notification.template:
+        return EmailMessage(notification.subject, notification.body, from_email, [notification.recipient])
+    content = get_template(notification.template).render(notification.context)
+    message = EmailMultiAlternatives(notification.subject, strip_tags(content), from_email, [notification.recipient])
+    message.attach_alternative(content, "text/html")
+    return message
+
+
+class RateLimiter:
+    """Spaces the sends of the threads of a sender to at most rate per second, 0 for no limit"""
+
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate > 0 else 0
+        self.next_send = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            send_at = max(self.next_send, now)
+            self.next_send = send_at + self.interval
+        if send_at > now:
+            time.sleep(send_at - now)
+
+
+class SenderPool:
+    """
+    The persistent connections of a sender, each one served by a thread.
+    Jobs are (notification id, message), results (notification id, error or None)
+    """
+
+    def __init__(self, sender, size, rate):
+        self.sender = sender
+        self.limiter = RateLimiter(rate)
+        self.jobs = queue.Queue()
+        self.results = queue.Queue()
+        self.threads = [threading.Thread(target=self.serve, daemon=True) for _ in range(max(size, 1))]
+        for thread in self.threads:
+            thread.start()
+
+    def open(self, connection):
+        """Connect and log in. Never raises: the sends then report the error"""
+        try:
+            connection.open()
+        except Exception as e:
+            print(f"Failed to open the {connection_label(self.sender, connection)} SMTP connection: {e}")
+
+    def close(self, connection):
+        """Close the connection (quit + socket). Never raises."""
+        try:
+            connection.close()
+        except Exception as e:
+            print(f"Failed to close the {connection_label(self.sender, connection)} SMTP connection: {e}")
+
+    def send(self, connection, message):
+        self.limiter.wait()
+        message.connection = connection
+        message.send()
+
+    def serve(self):
+        connection = sender_connection(self.sender)
+        self.open(connection)
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                self.close(connection)
+                self.jobs.task_done()
+                return
+            notification_id, message = job
+            error = None
+            try:
+                self.send(connection, message)
+            except SERVER_ERRORS as e:
+                error = f"{connection_label(self.sender, connection)}: {e}"
+            except Exception:
+                # The connection may be dead (idle timeout, server restart): reconnect and try once more
+                self.close(connection)
+                self.open(connection)
+                try:
+                    self.send(connection, message)
+                except Exception as e:
+                    error = f"{connection_label(self.sender, connection)}: {e}"
+            self.results.put((notification_id, error))
+            self.jobs.task_done()
+
+    def stop(self):
+        for _ in self.threads:
+            self.jobs.put(None)
+        for thread in self.threads:
+            thread.join()
+
+
+class Mailer:
+
+    def __init__(self, connections=2, rate=10, max_attempts=5, retry_delay=60):
+        self.max_attempts = max_attempts
+        self.retry_delay = max(retry_delay, 1)
+        self.pools = {
+            sender: SenderPool(sender, connections, rate)
+            for sender, _ in NotificationSender.choices
+        }
+
+    def due_notifications(self, batch_size):
+        return list(
+            Notification.objects.filter(
+                status=NotificationStatus.PENDING, next_attempt__lte=timezone.now()
+            ).order_by('next_attempt', 'id')[:batch_size]
+        )
+
+    def send_batch(self, notifications):
+        """Render the notifications, send them through the pools and record the outcome. Returns (sent, failed)"""
+        notifications = {notification.id: notification for notification in notifications}
+        errors = {}
+        for notification in notifications.values():
+            try:
+                message = render(notification)
+            except Exception as e:
+                # A broken template does not get better with a retry
+                errors[notification.id] = f"Render: {e}"
+                notification.attempts = self.max_attempts - 1
+                continue
+            self.pools[notification.sender].jobs.put((notification.id, message))
+
+        for pool in self.pools.values():
+            pool.jobs.join()
+            while not pool.results.empty():
+                notification_id, error = pool.results.get()
+                if error:
+                    errors[notification_id] = error
+
+        now = timezone.now()
+        sent = [notification_id for notification_id in notifications if notification_id not in errors]
+        Notification.objects.filter(id__in=sent).update(status=NotificationStatus.SENT, sent=now, error='')
+        for notification_id, error in errors.items():
+            notification = notifications[notification_id]
+            attempts = notification.attempts + 1
+            print(f"Failed to send email '{notification.subject}' to {notification.recipient} (attempt {attempts}): {error}")
+            Notification.objects.filter(id=notification_id).update(
+                attempts=attempts,
+                error=error[:255],
+                status=NotificationStatus.FAILED if attempts >= self.max_attempts else NotificationStatus.PENDING,
+                next_attempt=now + datetime.timedelta(seconds=self.retry_delay * 2 ** (attempts - 1)),
+            )
+        return len(sent), len(errors)
+
+    def close(self):
+        """Quit every connection"""
+        for pool in self.pools.values():
+            pool.stop()
@@ -1,192 +1,44 @@
 import calendar
+import datetime
+import multiprocessing
 import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from django.core.management import call_command
 from django.core.management.base import BaseCommand, CommandError
-from django.template.loader import get_template
 from decimal import Decimal
 
-from users.models import User
-from payments.models import Charge, ChargedServiceType
-from django.utils.html import strip_tags
-from django.core.mail import EmailMultiAlternatives, get_connection
+from payments.billing import (
+    billable_users, collect_lines, charge_lines, get_run, claim_shard, shard_users, save_progress, save_retry,
+    finish_shard, LeaseLost,
+)
+from payments.models import ChargedServiceType, ChargeRun, Notification, NotificationSender
 from django.conf import settings
-from radiotochka.billing import PRICE_PER_EXTRA_GB, PRICE_PER_EXTRA_GB_USD
 from django.utils import timezone
-from django.core.mail import EmailMessage
-from django.db import transaction
-from django.db.models import F, Q
+from django.db import connections, transaction
+from django.db.models import Sum
 
 class Command(BaseCommand):
     help = "Charge users daily"
 
-    def open_connections(self):
-        """Open both SMTP connections once, they are reused for the whole run:
-        the default one (Radio-Tochka) and the Streaming.center one."""
-        self.default_connection = get_connection()
-        self.sc_connection = get_connection(
-            host=settings.SC_EMAIL_HOST,
-            port=settings.SC_EMAIL_PORT,
-            username=settings.SC_EMAIL_HOST_USER,
-            password=settings.SC_EMAIL_HOST_PASSWORD,
-            use_ssl=settings.SC_EMAIL_USE_SSL,
-            use_tls=settings.SC_EMAIL_USE_TLS,
-        )
-        for name, connection in self.smtp_connections():
-            self.open_connection(name, connection)
-
-    def smtp_connections(self):
-        return (
-            ("default", self.default_connection),
-            ("streaming.center", self.sc_connection),
-        )
-
-    def connection_label(self, name, connection):
-        """Describe the mail server behind a connection, so the logs tell which one failed."""
-        host = getattr(connection, "host", None)
-        if not host:
-            # Console / file / locmem backends have no host
-            return f"{name} ({connection.__class__.__module__})"
-        username = getattr(connection, "username", None)
-        return f"{name} ({host}:{getattr(connection, 'port', '?')} as {username})"
-
-    def open_connection(self, name, connection):
-        """Connect and log in. Never raises: a dead mail server must not stop the charges."""
-        try:
-            connection.open()
-        except Exception as e:
-            print(f"Failed to open the {self.connection_label(name, connection)} SMTP connection: {e}")
-
-    def close_connection(self, name, connection):
-        """Close the connection (quit + socket). Never raises."""
-        try:
-            connection.close()
-        except Exception as e:
-            print(f"Failed to close the {self.connection_label(name, connection)} SMTP connection: {e}")
-
-    def close_connections(self):
-        for name, connection in self.smtp_connections():
-            self.close_connection(name, connection)
-
-    def send_email(self, subject, content, from_email, recipients, use_sc_connection=False):
-        """Send an html email over the shared connection. Never raises: any failure is printed
-        and swallowed, so a broken mailbox / SMTP server does not stop the charge run."""
-        if use_sc_connection:
-            name, connection = "streaming.center", self.sc_connection
-        else:
-            name, connection = "default", self.default_connection
-
-        try:
-            text_content = strip_tags(content)
-            # The connection is already open, so send_messages() reuses it instead of
-            # opening and closing one per message
-            msg = EmailMultiAlternatives(subject, text_content, from_email, list(recipients), connection=connection)
-            msg.attach_alternative(content, "text/html")
-            msg.send()
-        except Exception as e:
-            print(f"Failed to send email '{subject}' to {recipients} "
-                  f"via {self.connection_label(name, connection)}: {e}")
-            # The shared connection may be dead now (idle timeout, server restart), reconnect
-            # so that the failure does not cascade to every following user
-            self.close_connection(name, connection)
-            self.open_connection(name, connection)
-
-    def apply_charge(self, user, now, service_type, description, price, dedupe_by_description=True):
-        """Create the charge record and deduct the balance in a single transaction, so a crash
-        can never leave a charge without the matching deduction (which a re-run would then skip).
-
-        Returns True if the user was charged, False if this service was already charged today.
-        """
-        price = Decimal(price)
-        dedupe = {
-            "user": user,
-            "service_type": service_type,
-            "created__date": now.date(),
+    def notifications(self, user, total_daily, billing_date):
+        """The balance notifications of the user after the charge, sent later by send_notifications"""
+        context = {
+            "balance": str(round(user.balance, 2)),
+            "email": user.email,
+            "currency": user.get_currency_display(),
         }
-        if dedupe_by_description:
-            dedupe["description"] = description
-
-        with transaction.atomic():
-            # Lock the user row so two overlapping runs cannot both pass the check below
-            User.objects.select_for_update().get(pk=user.pk)
 
-            if Charge.objects.filter(**dedupe).exists():
-                return False
-
-            Charge.objects.create(
+        def notification(sender, recipient, subject, template):
+            return Notification(
+                key=f"charge:{billing_date}:{user.id}:{recipient}",
                 user=user,
-                service_type=service_type,
-                description=description,
-                currency=user.currency,
-                price=price,
+                sender=sender,
+                recipient=recipient,
+                subject=subject,
+                template=template,
+                context=context,
             )
-            # F() instead of user.save(): never overwrite a payment that landed during the run
-            User.objects.filter(pk=user.pk).update(balance=F("balance") - price)
-
-        user.refresh_from_db(fields=["balance"])
-        return True
-
-    def charge_self_hosted(self, user, now, n_month_days):
-        """Charge all self hosted radios of the user, returns the daily total."""
-        total_daily = Decimal(0)
-
-        for self_hosted_radio in user.selfhostedradio_set.all():
-            try:
-                price = self_hosted_radio.price()
-                if price <= 0:
-                    continue
-
-                daily_price = Decimal(Decimal(price) / Decimal(n_month_days))
-                total_daily += daily_price
-                description = self_hosted_radio.ip
-                if self_hosted_radio.domain:
-                    description += f" ({self_hosted_radio.domain})"
-
-                if self.apply_charge(user, now, ChargedServiceType.RADIO_SELF_HOSTED, description, daily_price):
-                    print(f"User {user.email} self hosted radio charged {daily_price}, balance: {user.balance}")
-            except Exception as e:
-                print(f"Failed to charge self hosted radio {self_hosted_radio.pk} of user {user.pk} ({user.email}): {e}")
-                traceback.print_exc()
-
-        return total_daily
-
-    def charge_hosted(self, user, now, n_month_days):
-        """Charge all hosted radios (stream + extra disk usage) of the user, returns the daily total."""
-        total_daily = Decimal(0)
 
-        for hosted_radio in user.hostedradio_set.exclude(is_demo=True):
-            try:
-                # Skip 5 days trial
-                price = hosted_radio.price()
-                if price <= 0:
-                    continue
-
-                daily_price = Decimal(price) / Decimal(n_month_days)
-                total_daily += daily_price
-                if self.apply_charge(user, now, ChargedServiceType.RADIO_HOSTED_STREAM, hosted_radio.login, daily_price):
-                    print(f"User {user.email} hosted radio {hosted_radio.login} charged {daily_price}, balance: {user.balance}")
-
-                # Disk usage extra
-                disk_quota = hosted_radio.get_disk_quota()
-                disk_quota_mb = disk_quota * 1024.
-                above_allowed_du = hosted_radio.disk_usage - disk_quota_mb
-                if above_allowed_du > 0:
-                    du_price = PRICE_PER_EXTRA_GB_USD if user.is_usd() else PRICE_PER_EXTRA_GB
-                    price_du_day = du_price / n_month_days * (above_allowed_du / 1024.)
-                    total_daily += Decimal(price_du_day)
-                    # Deduped per day only: the reported usage changes between runs, so matching
-                    # on the description would charge twice on a re-run
-                    if self.apply_charge(
-                        user, now, ChargedServiceType.RADIO_HOSTED_DU, str(above_allowed_du), price_du_day,
-                        dedupe_by_description=False,
-                    ):
-                        print(f"User {user.email} disk usage {above_allowed_du} charged {price_du_day}, balance: {user.balance}")
-            except Exception as e:
-                print(f"Failed to charge hosted radio {hosted_radio.pk} of user {user.pk} ({user.email}): {e}")
-                traceback.print_exc()
-
-        return total_daily
-
-    def notify_user(self, user, total_daily):
-        """Send the balance notification to the user. Never raises."""
         if user.balance <= 0:
             template = "email/service_stop_en.html"
             subject = f"Streaming.center: account balance is negative, service have been suspended: {round(user.balance, 2)} {user.get_currency_display()}"
@@ -194,93 +46,274 @@ class Command(BaseCommand):
                 template = "email/service_stop_ru.html"
                 subject = f"Radio-Tochka.com: деньги закончились, услуги приостановлены {round(user.balance, 2)} {user.get_currency_display()}"
 
-            content = get_template(template).render({
-                "balance": round(user.balance, 2),
-                "email": user.email,
-                "currency": user.get_currency_display(),
-            })
-
             if user.is_russian():
-                self.send_email(subject, content, settings.ADMIN_EMAIL, [user.email,])
-            else:
-                self.send_email(subject, content, settings.SC_ADMIN_EMAIL, [user.email,], use_sc_connection=True)
+                return [notification(NotificationSender.RADIO_TOCHKA, user.email, subject, template)]
+            return [notification(NotificationSender.STREAMING_CENTER, user.email, subject, template)]
 
-        elif user.balance < total_daily * 5:
+        if user.balance < total_daily * 5:
             template = "email/payment_reminder_en.html"
             subject = f"Streaming.center: Low balance notification: {round(user.balance, 2)} {user.get_currency_display()}"
             if user.is_russian():
                 template = "email/payment_reminder_ru.html"
                 subject = f"Radio-Tochka.com: на балансе осталось {round(user.balance, 2)} {user.get_currency_display()}"
 
-            content = get_template(template).render({
-                "balance": round(user.balance, 2),
-                "email": user.email,
-                "currency": user.get_currency_display(),
-            })
-
             if user.is_russian():
-                self.send_email(subject, content, settings.ADMIN_EMAIL, [user.email,])
-            else:
+                return [notification(NotificationSender.RADIO_TOCHKA, user.email, subject, template)]
+            return [
                 # Notify admin as well
-                self.send_email(
-                    f"Low balance: {user.email}: {round(user.balance, 2)}",
-                    content,
+                notification(
+                    NotificationSender.RADIO_TOCHKA,
                     settings.ADMIN_EMAIL,
-                    [settings.ADMIN_EMAIL,],
-                )
-                self.send_email(subject, content, settings.SC_ADMIN_EMAIL, [user.email,], use_sc_connection=True)
-
-    def handle(self, *args, **options):
-        now = timezone.now()
-        print(f"Charge at {now}")
-        n_month_days = calendar.monthrange(now.year, now.month)[1]
-        paid_clients_rub = 0
-        paid_clients_usd = 0
-        total_rub = 0
-        total_usd = 0
-        failed_users = 0
+                    f"Low balance: {user.email}: {round(user.balance, 2)}",
+                    template,
+                ),
+                notification(NotificationSender.STREAMING_CENTER, user.email, subject, template),
+            ]
+
+        return []
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=500,
+            help="Number of users charged per transaction (default: 500)"
+        )
+        parser.add_argument(
+            "--shard",
+            help="Charge only the shard N of M of the users (by id range), e.g. 2/4"
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=1,
+            help="Charge the users in that many shards, each in its own process (default: 1)"
+        )
+        parser.add_argument(
+            "--billing-date",
+            help="Charge run to resume, YYYY-MM-DD (default: today)"
+        )
+        parser.add_argument(
+            "--backfill",
+            action="store_true",
+            help="Allow --billing-date to start a new charge run for a past day"
+        )
+        parser.add_argument(
+            "--retry-failed",
+            action="store_true",
+            help="Charge the users that failed in the finished run of the billing date"
+        )
 
-        self.open_connections()
+    def get_billing_date(self, options, today):
+        """
+        Today, or the date of a run to resume: a mistyped or past date must not start a
+        real charge run, --backfill is required to charge a missed day
+        """
+        if not options["billing_date"]:
+            return today
         try:
-            for user in User.objects.filter(Q(balance__gt=0) | Q(id__in=[2775, 2774]), is_staff=False):
+            billing_date = datetime.date.fromisoformat(options["billing_date"])
+        except ValueError:
+            raise CommandError(f"Invalid billing date {options['billing_date']}, expected YYYY-MM-DD")
+        if billing_date > today:
+            raise CommandError(f"The billing date {billing_date} is in the future")
+        if billing_date < today and not options["backfill"] and not ChargeRun.objects.filter(billing_date=billing_date).exists():
+            raise CommandError(
+                f"There is no charge run of {billing_date} to resume, use --backfill to charge that day"
+            )
+        return billing_date
 
-                total_daily = Decimal(0)
+    def parse_shard(self, value):
+        try:
+            number, count = (int(part) for part in value.split("/"))
+        except ValueError:
+            raise CommandError(f"Invalid shard {value}, expected N/M")
+        if not 1 <= number <= count:
+            raise CommandError(f"Invalid shard {value}, N must be between 1 and M")
+        return number, count
+
+    def charge_users(self, run, users, n_month_days, save):
+        """
+        Charge the users ({id: user}) with their notifications in one transaction,
+        save(**counters) records the outcome in it. Returns the lines charged
+        """
+        lines = collect_lines(users, n_month_days)
+        total_daily = {user_id: Decimal(0) for user_id in users}
+        for line in lines:
+            total_daily[line.user_id] += line.price
+        rub = [total for user_id, total in total_daily.items() if total > 0 and users[user_id].is_rub()]
+        usd = [total for user_id, total in total_daily.items() if total > 0 and not users[user_id].is_rub()]
+
+        # The progress and the notifications are saved with the charges:
+        # a crash neither replays a committed chunk nor loses its emails
+        with transaction.atomic():
+            charged = charge_lines(users, lines, run.billing_date)
+            notifications = []
+            for user_id, user in users.items():
                 try:
-                    total_daily += self.charge_self_hosted(user, now, n_month_days)
-                    total_daily += self.charge_hosted(user, now, n_month_days)
+                    notifications.extend(self.notifications(user, total_daily[user_id], run.billing_date))
                 except Exception as e:
-                    # Anything unexpected for this user must not stop the whole run
-                    failed_users += 1
-                    print(f"Failed to charge user {user.pk} ({user.email}): {e}")
+                    # Building the message must not stop the run either
+                    print(f"Failed to notify user {user.pk} ({user.email}): {e}")
                     traceback.print_exc()
-                    continue
+            Notification.objects.bulk_create(notifications, ignore_conflicts=True)
+            save(
+                charges=len(charged),
+                paid_clients_rub=len(rub), total_rub=sum(rub),
+                paid_clients_usd=len(usd), total_usd=sum(usd),
+            )
 
-                if total_daily > 0:
-                    if user.is_rub():
-                        total_rub += total_daily
-                        paid_clients_rub += 1
-                    else:
-                        total_usd += total_daily
-                        paid_clients_usd += 1
+        service_names = dict(ChargedServiceType.choices)
+        for line in charged:
+            user = users[line.user_id]
+            print(f"User {user.email} {service_names[line.service_type].lower()} {line.description} "
+                  f"charged {line.price}, balance: {user.balance}")
+        return charged
 
-                # Send payment notification
+    def charge_chunk(self, run, shard, users, n_month_days):
+        """
+        Charge a chunk of the shard and move the shard past it. A failed chunk is
+        rolled back as a whole and charged again by halves, down to the users that
+        fail on their own: they are recorded on the shard, the others are charged anyway
+        """
+        last_id = max(users)
+        try:
+            self.charge_users(run, users, n_month_days, lambda **counters: save_progress(shard, last_id, **counters))
+            return
+        except LeaseLost:
+            raise
+        except Exception as e:
+            error = e
+            traceback.print_exc()
+
+        if len(users) == 1:
+            print(f"Failed to charge user {last_id}: {error}")
+            with transaction.atomic():
+                save_progress(shard, last_id, failed_user_ids=[last_id])
+            return
+        print(f"Failed to charge users {min(users)}..{last_id}, charging them by halves: {error}")
+        user_ids = sorted(users)
+        middle = len(user_ids) // 2
+        for half in (user_ids[:middle], user_ids[middle:]):
+            self.charge_chunk(run, shard, {user_id: users[user_id] for user_id in half}, n_month_days)
+
+    def charge_shard(self, run, number, chunk_size):
+        """Charge the users of a shard chunk by chunk, from where a crashed run stopped"""
+        shard = claim_shard(run, number)
+        if shard is None:
+            print(f"Shard {number}/{run.shard_count} of {run.billing_date} is finished or charged by another process")
+            return
+        print(f"Charge shard {number}/{run.shard_count} of {run.billing_date}, after user {shard.position}")
+        n_month_days = calendar.monthrange(run.billing_date.year, run.billing_date.month)[1]
+
+        while True:
+            users = shard_users(shard, chunk_size)
+            if not users:
+                break
+            try:
+                self.charge_chunk(run, shard, users, n_month_days)
+            except LeaseLost as e:
+                print(e)
+                return
+
+        if finish_shard(shard):
+            self.enqueue_summary(run)
+
+    def retry_failed(self, run):
+        """Charge again, one by one, the users recorded as failed by the shards of a finished run"""
+        n_month_days = calendar.monthrange(run.billing_date.year, run.billing_date.month)[1]
+        retried = failed = 0
+        for shard in run.shards.exclude(failed_user_ids=[]).order_by('shard'):
+            users = billable_users().in_bulk(shard.failed_user_ids)
+            for user_id in shard.failed_user_ids:
+                retried += 1
+                if user_id not in users:
+                    # No longer billable, nothing to charge
+                    with transaction.atomic():
+                        save_retry(shard, user_id)
+                    continue
                 try:
-                    self.notify_user(user, total_daily)
+                    self.charge_users(
+                        run, {user_id: users[user_id]}, n_month_days,
+                        lambda **counters: save_retry(shard, user_id, **counters),
+                    )
                 except Exception as e:
-                    # Rendering a template / building the message must not stop the run either
-                    print(f"Failed to notify user {user.pk} ({user.email}): {e}")
+                    failed += 1
+                    print(f"Failed to charge user {user_id}: {e}")
                     traceback.print_exc()
+        print(f"Retried {retried} failed users of {run.billing_date}, {failed} still failing")
+
+    def enqueue_summary(self, run):
+        """Daily income of the whole run, enqueued by the process finishing its last shard"""
+        totals = run.shards.aggregate(
+            paid_clients_rub=Sum("paid_clients_rub"),
+            paid_clients_usd=Sum("paid_clients_usd"),
+            total_rub=Sum("total_rub"),
+            total_usd=Sum("total_usd"),
+        )
+        failed_user_ids = sorted(
+            user_id for user_ids in run.shards.values_list("failed_user_ids", flat=True) for user_id in user_ids
+        )
+        content = f"RUB paid clients: {totals['paid_clients_rub']}\nUSD paid clients: {totals['paid_clients_usd']}\n"
+        if run.shard_count > 1:
+            content += f"Shards: {run.shard_count}\n"
+        if failed_user_ids:
+            content += (
+                f"Failed users ({len(failed_user_ids)}, charge them with --retry-failed): "
+                f"{', '.join(map(str, failed_user_ids))}\n"
+            )
+        Notification.objects.bulk_create([
+            Notification(
+                key=f"summary:{run.billing_date}",
+                sender=NotificationSender.RADIO_TOCHKA,
+                recipient=settings.ADMIN_EMAIL,
+                subject=f"Daily Income: {totals['total_rub']:.2f} RUB, {totals['total_usd']:.2f} USD",
+                body=content,
+            )
+        ], ignore_conflicts=True)
 
-            content = f"RUB paid clients: {paid_clients_rub}\nUSD paid clients: {paid_clients_usd}\n"
-            if failed_users:
-                content += f"Failed users: {failed_users}\n"
-            subject = f"Daily Income: {total_rub:.2f} RUB, {total_usd:.2f} USD"
-            msg = EmailMessage(subject, content, settings.ADMIN_EMAIL, to=[settings.ADMIN_EMAIL,], connection=self.default_connection)
-            try:
-                msg.send()
-            except Exception as e:
-                print(f"Failed to send email '{subject}' "
-                      f"via {self.connection_label('default', self.default_connection)}: {e}")
-        finally:
-            # Quit both sessions on any exit: normal end, crash or Ctrl-C
-            self.close_connections()
+    def handle(self, *args, **options):
+        now = timezone.now()
+        print(f"Charge at {now}")
+        billing_date = self.get_billing_date(options, now.date())
+        if options["retry_failed"]:
+            run = ChargeRun.objects.filter(billing_date=billing_date).first()
+            if run is None or run.finished is None:
+                raise CommandError(f"The charge run of {billing_date} is not finished, resume it first")
+            self.retry_failed(run)
+            return
+
+        chunk_size = max(options["chunk_size"], 1)
+        workers = max(options["workers"], 1)
+        number, shard_count = self.parse_shard(options["shard"]) if options["shard"] else (None, workers)
+
+        run = get_run(billing_date, shard_count)
+        if run is None:
+            run = ChargeRun.objects.get(billing_date=billing_date)
+            raise CommandError(
+                f"The charge run of {billing_date} is split in {run.shard_count} shards, "
+                f"use --workers {run.shard_count} or --shard N/{run.shard_count}"
+            )
+
+        if number is None and workers > 1:
+            # Forked workers must not share the parent's database connection
+            connections.close_all()
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("fork")) as pool:
+                futures = {
+                    pool.submit(charge_shard_process, f"{i}/{workers}", billing_date.isoformat(), chunk_size): i
+                    for i in range(1, workers + 1)
+                }
+                for future in as_completed(futures):
+                    try:
+                        future.result()
+                    except Exception as e:
+                        # The shard is resumed by the next run
+                        print(f"Shard {futures[future]}/{workers} failed: {e}")
+            return
+
+        self.charge_shard(run, number or 1, chunk_size)
+
+
+def charge_shard_process(shard, billing_date, chunk_size):
+    """Runs in a worker process, with its own database connection"""
+    call_command("charge", shard=shard, billing_date=billing_date, chunk_size=chunk_size)
@@ -0,0 +1,87 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from payments.mailer import Mailer
+
+
+class Command(BaseCommand):
+    help = (
+        'Send the pending billing notifications over a pool of persistent SMTP connections '
+        'per sender, with throttling and retries'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=200,
+            help='Number of notifications rendered and sent per batch (default: 200)'
+        )
+        parser.add_argument(
+            '--connections',
+            type=int,
+            default=2,
+            help='Number of SMTP connections per sender (default: 2)'
+        )
+        parser.add_argument(
+            '--rate',
+            type=float,
+            default=10,
+            help='Maximum number of emails per second and sender, 0 for no limit (default: 10)'
+        )
+        parser.add_argument(
+            '--max-attempts',
+            type=int,
+            default=5,
+            help='Number of attempts before a notification is given up (default: 5)'
+        )
+        parser.add_argument(
+            '--retry-delay',
+            type=float,
+            default=60,
+            help='Seconds before the first retry, doubled at every attempt (default: 60)'
+        )
+        parser.add_argument(
+            '--loop',
+            action='store_true',
+            help='Keep running and wait for new notifications'
+        )
+        parser.add_argument(
+            '--interval',
+            type=float,
+            default=10,
+            help='Seconds to wait between polls when nothing is due, with --loop (default: 10)'
+        )
+
+    def handle(self, *args, **options):
+        mailer = Mailer(
+            connections=options['connections'],
+            rate=options['rate'],
+            max_attempts=max(options['max_attempts'], 1),
+            retry_delay=options['retry_delay'],
+        )
+        total_sent = 0
+        total_failed = 0
+        try:
+            while True:
+                close_old_connections()
+                notifications = mailer.due_notifications(options['batch_size'])
+                if notifications:
+                    start_time = time.time()
+                    sent, failed = mailer.send_batch(notifications)
+                    total_sent += sent
+                    total_failed += failed
+                    self.stdout.write(self.style.SUCCESS(
+                        f"Sent {sent} of {len(notifications)} notifications in {time.time() - start_time:.2f} seconds"
+                    ))
+                elif options['loop']:
+                    time.sleep(options['interval'])
+                else:
+                    break
+        finally:
+            # Quit every SMTP session on any exit: normal end, crash or Ctrl-C
+            mailer.close()
+
+        self.stdout.write(self.style.SUCCESS(f"Completed, {total_sent} sent, {total_failed} failed"))
@@ -0,0 +1,76 @@
+# Generated by Django 4.2.5 on 2026-10-18 11:25
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("payments", "0005_alter_charge_service_type"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ChargeRun",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("billing_date", models.DateField(unique=True)),
+                ("shard_count", models.PositiveSmallIntegerField(default=1)),
+                ("started", models.DateTimeField(auto_now_add=True)),
+                ("finished", models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name="ChargeShard",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("shard", models.PositiveSmallIntegerField()),
+                ("first_user_id", models.PositiveIntegerField(default=0)),
+                ("last_user_id", models.PositiveIntegerField(blank=True, null=True)),
+                ("position", models.PositiveIntegerField(default=0)),
+                ("owner", models.CharField(blank=True, default="", max_length=255)),
+                ("heartbeat", models.DateTimeField(blank=True, null=True)),
+                ("finished", models.DateTimeField(blank=True, null=True)),
+                ("charges", models.PositiveIntegerField(default=0)),
+                ("failed_users", models.PositiveIntegerField(default=0)),
+                ("paid_clients_rub", models.PositiveIntegerField(default=0)),
+                ("paid_clients_usd", models.PositiveIntegerField(default=0)),
+                (
+                    "total_rub",
+                    models.DecimalField(decimal_places=6, default=0, max_digits=14),
+                ),
+                (
+                    "total_usd",
+                    models.DecimalField(decimal_places=6, default=0, max_digits=14),
+                ),
+                (
+                    "run",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="shards",
+                        to="payments.chargerun",
+                    ),
+                ),
+            ],
+            options={
+                "unique_together": {("run", "shard")},
+            },
+        ),
+    ]
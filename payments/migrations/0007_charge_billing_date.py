@@ -0,0 +1,65 @@
+# Generated by Django 4.2.5 on 2026-10-18 11:27
+
+import datetime
+import hashlib
+import json
+
+from django.db import migrations, models
+from django.db.models.functions import TruncDate
+import payments.models
+
+
+def fill_billing_dates(apps, schema_editor):
+    Charge = apps.get_model("payments", "Charge")
+    Charge.objects.update(billing_date=TruncDate("created"))
+
+    # Key the recent charge run charges like Charge.make_key() at the time of writing:
+    # a charge run right after the deploy must not bill them again
+    self_hosted, hosted_stream, hosted_du = 1, 2, 3
+    since = datetime.date.today() - datetime.timedelta(days=1)
+    keys = set()
+    charges = []
+    for charge in Charge.objects.filter(
+        billing_date__gte=since, service_type__in=[self_hosted, hosted_stream, hosted_du]
+    ).order_by("id"):
+        description = None if charge.service_type == hosted_du else charge.description
+        key = json.dumps([charge.billing_date.isoformat(), charge.user_id, charge.service_type, description])
+        key = hashlib.sha256(key.encode()).hexdigest()
+        # Duplicates of the old runs keep no key
+        if key not in keys:
+            keys.add(key)
+            charge.idempotency_key = key
+            charges.append(charge)
+    Charge.objects.bulk_update(charges, ["idempotency_key"], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("payments", "0006_chargerun"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="charge",
+            name="batch",
+            field=models.UUIDField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="charge",
+            name="billing_date",
+            field=models.DateField(default=payments.models.today),
+        ),
+        migrations.AddField(
+            model_name="charge",
+            name="idempotency_key",
+            field=models.CharField(blank=True, max_length=64, null=True, unique=True),
+        ),
+        migrations.AddIndex(
+            model_name="charge",
+            index=models.Index(
+                fields=["user", "billing_date"], name="payments_charge_user_date_idx"
+            ),
+        ),
+        migrations.RunPython(fill_billing_dates, migrations.RunPython.noop),
+    ]
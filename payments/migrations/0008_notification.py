@@ -0,0 +1,87 @@
+# Generated by Django 4.2.5 on 2026-10-18 11:29
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ("payments", "0007_charge_billing_date"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="Notification",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("created", models.DateTimeField(auto_now_add=True)),
+                (
+                    "key",
+                    models.CharField(
+                        blank=True, max_length=255, null=True, unique=True
+                    ),
+                ),
+                (
+                    "sender",
+                    models.PositiveSmallIntegerField(
+                        choices=[(0, "Radio-Tochka"), (1, "Streaming.center")],
+                        default=0,
+                        verbose_name="Sender",
+                    ),
+                ),
+                (
+                    "recipient",
+                    models.EmailField(max_length=254, verbose_name="Recipient"),
+                ),
+                ("subject", models.CharField(max_length=255)),
+                ("template", models.CharField(blank=True, default="", max_length=255)),
+                ("context", models.JSONField(blank=True, default=dict)),
+                ("body", models.TextField(blank=True, default="")),
+                (
+                    "status",
+                    models.PositiveSmallIntegerField(
+                        choices=[(0, "Pending"), (1, "Sent"), (2, "Failed")],
+                        default=0,
+                        verbose_name="Status",
+                    ),
+                ),
+                ("attempts", models.PositiveSmallIntegerField(default=0)),
+                (
+                    "next_attempt",
+                    models.DateTimeField(default=django.utils.timezone.now),
+                ),
+                ("sent", models.DateTimeField(blank=True, null=True)),
+                ("error", models.CharField(blank=True, default="", max_length=255)),
+                (
+                    "user",
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to=settings.AUTH_USER_MODEL,
+                        verbose_name="User",
+                    ),
+                ),
+            ],
+            options={
+                "indexes": [
+                    models.Index(
+                        fields=["status", "next_attempt"],
+                        name="payments_notification_due_idx",
+                    )
+                ],
+            },
+        ),
+    ]
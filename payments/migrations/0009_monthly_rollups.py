@@ -0,0 +1,139 @@
+# Generated by Django 4.2.5 on 2026-10-18 11:32
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Sum
+from django.db.models.functions import TruncMonth
+import django.db.models.deletion
+
+
+def fill_rollups(apps, schema_editor):
+    Charge = apps.get_model("payments", "Charge")
+    UserPayment = apps.get_model("payments", "UserPayment")
+    MonthlyCharge = apps.get_model("payments", "MonthlyCharge")
+    MonthlyPayment = apps.get_model("payments", "MonthlyPayment")
+
+    MonthlyCharge.objects.bulk_create(
+        [
+            MonthlyCharge(**row)
+            for row in Charge.objects.annotate(month=TruncMonth("billing_date"))
+            .values("user_id", "month", "service_type", "currency")
+            .annotate(total=Sum("price"), count=Count("id"))
+            .order_by()
+        ],
+        batch_size=1000,
+    )
+    MonthlyPayment.objects.bulk_create(
+        [
+            MonthlyPayment(**row)
+            for row in UserPayment.objects.annotate(month=TruncMonth("created", output_field=models.DateField()))
+            .values("user_id", "month", "currency")
+            .annotate(total=Sum("amount"), count=Count("id"))
+            .order_by()
+        ],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ("payments", "0008_notification"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="MonthlyPayment",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("month", models.DateField()),
+                (
+                    "currency",
+                    models.PositiveSmallIntegerField(
+                        choices=[(0, "$"), (1, "₽"), (2, "€")],
+                        default=1,
+                        verbose_name="Currency",
+                    ),
+                ),
+                (
+                    "total",
+                    models.DecimalField(decimal_places=6, default=0, max_digits=14),
+                ),
+                ("count", models.PositiveIntegerField(default=0)),
+                (
+                    "user",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to=settings.AUTH_USER_MODEL,
+                        verbose_name="User",
+                    ),
+                ),
+            ],
+            options={
+                "unique_together": {("user", "month", "currency")},
+            },
+        ),
+        migrations.CreateModel(
+            name="MonthlyCharge",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("month", models.DateField()),
+                (
+                    "service_type",
+                    models.PositiveSmallIntegerField(
+                        choices=[
+                            (0, "Other services"),
+                            (1, "Self hosted radio service"),
+                            (2, "Hosted radio stream (traffic)"),
+                            (3, "Hosted radio disk usage"),
+                            (4, "Text to speech"),
+                        ],
+                        default=0,
+                        verbose_name="Service type",
+                    ),
+                ),
+                (
+                    "currency",
+                    models.PositiveSmallIntegerField(
+                        choices=[(0, "$"), (1, "₽"), (2, "€")],
+                        default=0,
+                        verbose_name="Currency",
+                    ),
+                ),
+                (
+                    "total",
+                    models.DecimalField(decimal_places=6, default=0, max_digits=14),
+                ),
+                ("count", models.PositiveIntegerField(default=0)),
+                (
+                    "user",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to=settings.AUTH_USER_MODEL,
+                        verbose_name="User",
+                    ),
+                ),
+            ],
+            options={
+                "unique_together": {("user", "month", "service_type", "currency")},
+            },
+        ),
+        migrations.RunPython(fill_rollups, migrations.RunPython.noop),
+    ]
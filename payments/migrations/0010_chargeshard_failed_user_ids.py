@@ -0,0 +1,22 @@
+# Generated by Django 4.2.5 on 2026-10-18 11:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("payments", "0009_monthly_rollups"),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name="chargeshard",
+            name="failed_users",
+        ),
+        migrations.AddField(
+            model_name="chargeshard",
+            name="failed_user_ids",
+            field=models.JSONField(blank=True, default=list),
+        ),
+    ]
@@ -1,7 +1,14 @@
+import hashlib
+import json
+
 from django.db import models
 from django.conf import settings
+from django.utils import timezone
 from users.models import Currency
 
+def today():
+    return timezone.now().date()
+
 class InvoiceRequest(models.Model):
     created = models.DateTimeField(auto_now_add=True)
     user = models.ForeignKey(
@@ -65,6 +72,27 @@ class Charge(models.Model):
         default=Currency.USD,
         choices=Currency.choices,
     )
+    # The day the charge bills, the charge run dedupes on it
+    billing_date = models.DateField(default=today)
+    # Unique per billed line and day (see make_key), set by the charge run: its
+    # inserts ignore the lines already charged
+    idempotency_key = models.CharField(max_length=64, unique=True, null=True, blank=True)
+    # The charge run chunk that inserted the charge, tells its rows from the ignored ones
+    batch = models.UUIDField(null=True, blank=True, db_index=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'billing_date'], name='payments_charge_user_date_idx'),
+        ]
+
+    @staticmethod
+    def make_key(billing_date, user_id, service_type, description=None):
+        """
+        Idempotency key of a daily charge. The disk usage is keyed without its
+        description (the usage), which changes between runs
+        """
+        key = json.dumps([billing_date.isoformat(), user_id, service_type, description])
+        return hashlib.sha256(key.encode()).hexdigest()
 
 class UserPayment(models.Model):
     user = models.ForeignKey(
@@ -84,3 +112,173 @@ class UserPayment(models.Model):
         default=Currency.RUB,
         choices=Currency.choices,
     )
+
+class ChargeRun(models.Model):
+    """
+    The daily charge run of a billing date. Its users are partitioned by id
+    range into shard_count shards (ChargeShard) when it is created, so a
+    crashed run resumes with the very same partition
+    """
+    billing_date = models.DateField(unique=True)
+    shard_count = models.PositiveSmallIntegerField(default=1)
+    started = models.DateTimeField(auto_now_add=True)
+    # Set once every shard is done, by the process that sends the daily summary
+    finished = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.billing_date} ({self.shard_count} shards)"
+
+class ChargeShard(models.Model):
+    """
+    Progress of a shard of a charge run: the users with first_user_id <= id <= last_user_id
+    (no upper bound for the last shard). owner and heartbeat make a lease, a single
+    process charges a shard at a time, and a crashed one is taken over once its
+    heartbeat is stale. position is the last user id charged, a resumed shard starts after it.
+    The users whose charge failed are skipped and recorded in failed_user_ids, for
+    charge --retry-failed
+    """
+    run = models.ForeignKey(ChargeRun, on_delete=models.deletion.CASCADE, related_name='shards')
+    shard = models.PositiveSmallIntegerField()
+    first_user_id = models.PositiveIntegerField(default=0)
+    last_user_id = models.PositiveIntegerField(null=True, blank=True)
+    position = models.PositiveIntegerField(default=0)
+
+    owner = models.CharField(max_length=255, blank=True, default='')
+    heartbeat = models.DateTimeField(null=True, blank=True)
+    finished = models.DateTimeField(null=True, blank=True)
+
+    # Counters of the daily summary
+    charges = models.PositiveIntegerField(default=0)
+    failed_user_ids = models.JSONField(default=list, blank=True)
+    paid_clients_rub = models.PositiveIntegerField(default=0)
+    paid_clients_usd = models.PositiveIntegerField(default=0)
+    total_rub = models.DecimalField(max_digits=14, decimal_places=6, default=0)
+    total_usd = models.DecimalField(max_digits=14, decimal_places=6, default=0)
+
+    class Meta:
+        unique_together = ('run', 'shard')
+
+    def __str__(self):
+        return f"{self.run.billing_date} {self.shard}/{self.run.shard_count}"
+
+class NotificationSender:
+    """The mailbox and SMTP server a notification is sent from"""
+
+    RADIO_TOCHKA = 0
+    STREAMING_CENTER = 1
+
+    choices = (
+        (RADIO_TOCHKA, 'Radio-Tochka'),
+        (STREAMING_CENTER, 'Streaming.center'),
+    )
+
+class NotificationStatus:
+
+    PENDING = 0
+    SENT = 1
+    FAILED = 2
+
+    choices = (
+        (PENDING, 'Pending'),
+        (SENT, 'Sent'),
+        (FAILED, 'Failed'),
+    )
+
+class Notification(models.Model):
+    """
+    An email of the billing waiting for the mailer (payments/mailer.py): the
+    charge run enqueues them, the send_notifications command renders and sends them
+    """
+    created = models.DateTimeField(auto_now_add=True)
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        verbose_name="User",
+        blank=True,
+        null=True,
+        on_delete=models.deletion.CASCADE
+    )
+    # Unique per message of a charge run, a resumed run enqueues nothing twice
+    key = models.CharField(max_length=255, unique=True, null=True, blank=True)
+
+    sender = models.PositiveSmallIntegerField(
+        "Sender",
+        default=NotificationSender.RADIO_TOCHKA,
+        choices=NotificationSender.choices,
+    )
+    recipient = models.EmailField("Recipient")
+    subject = models.CharField(max_length=255)
+    # An html template rendered with the context, or a plain text body
+    template = models.CharField(max_length=255, blank=True, default='')
+    context = models.JSONField(default=dict, blank=True)
+    body = models.TextField(blank=True, default='')
+
+    status = models.PositiveSmallIntegerField(
+        "Status",
+        default=NotificationStatus.PENDING,
+        choices=NotificationStatus.choices,
+    )
+    attempts = models.PositiveSmallIntegerField(default=0)
+    next_attempt = models.DateTimeField(default=timezone.now)
+    sent = models.DateTimeField(null=True, blank=True)
+    error = models.CharField(max_length=255, blank=True, default='')
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'next_attempt'], name='payments_notification_due_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.recipient}: {self.subject}"
+
+class MonthlyCharge(models.Model):
+    """
+    Charges of a user rolled up by month, service type and currency, for the
+    billing history and the month totals. Maintained by the charge run (in its
+    chunk transaction) and by a signal for the charges saved one by one
+    """
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        verbose_name="User",
+        blank=False,
+        null=False,
+        on_delete=models.deletion.CASCADE
+    )
+    # First day of the month
+    month = models.DateField()
+    service_type = models.PositiveSmallIntegerField(
+        "Service type",
+        default=ChargedServiceType.OTHER,
+        choices=ChargedServiceType.choices,
+    )
+    currency = models.PositiveSmallIntegerField(
+        "Currency",
+        default=Currency.USD,
+        choices=Currency.choices,
+    )
+    total = models.DecimalField(max_digits=14, decimal_places=6, default=0)
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ('user', 'month', 'service_type', 'currency')
+
+class MonthlyPayment(models.Model):
+    """Payments of a user rolled up by month and currency, maintained by a signal"""
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        verbose_name="User",
+        blank=False,
+        null=False,
+        on_delete=models.deletion.CASCADE
+    )
+    # First day of the month
+    month = models.DateField()
+    currency = models.PositiveSmallIntegerField(
+        "Currency",
+        default=Currency.RUB,
+        choices=Currency.choices,
+    )
+    total = models.DecimalField(max_digits=14, decimal_places=6, default=0)
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ('user', 'month', 'currency')
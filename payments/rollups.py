@@ -0,0 +1,122 @@
+"""
+Monthly rollups of the charges and payments (MonthlyCharge, MonthlyPayment).
+
+A long-time customer has thousands of daily charge rows. The billing page and
+the month totals read one row per month and service type instead. The rollups
+are kept up to date incrementally: the charge run adds a chunk's charges in
+its transaction, and the signals in payments/signals.py add the charges and
+payments that are created one by one. An edit or a delete (a refund, an admin
+correction) cannot be applied as a delta, the signals rebuild the months it
+touches from the ledger instead. Bulk writes send no signals, so whoever
+bulk-writes charges or payments must call add_charges()/add_payments(), or
+rebuild_charges()/rebuild_payments() for the months they changed.
+"""
+import datetime
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import F, Case, When, Value, DecimalField, IntegerField, Sum, Count
+
+from .models import Charge, UserPayment, MonthlyCharge, MonthlyPayment
+
+
+def month_of(date):
+    return date.replace(day=1)
+
+
+def next_month(month):
+    return (month + datetime.timedelta(days=32)).replace(day=1)
+
+
+def add_to_rollups(model, key_fields, deltas):
+    """
+    Add {key values: (total, count)} to the rollup rows of the model, keyed by
+    key_fields (user_id first, then month). Three queries whatever the number of rows:
+    the missing rows are created at zero, then all of them are incremented
+    with F() by a single UPDATE, so concurrent writers never lose an increment
+    """
+    if not deltas:
+        return
+    model.objects.bulk_create(
+        [model(**dict(zip(key_fields, key))) for key in deltas],
+        ignore_conflicts=True,
+    )
+    ids = {}
+    for row in model.objects.filter(
+        user_id__in={key[0] for key in deltas}, month__in={key[1] for key in deltas}
+    ).values('id', *key_fields):
+        key = tuple(row[field] for field in key_fields)
+        if key in deltas:
+            ids[key] = row['id']
+
+    model.objects.filter(id__in=list(ids.values())).update(
+        total=F('total') + Case(
+            *[When(id=ids[key], then=Value(total)) for key, (total, _) in deltas.items()],
+            output_field=DecimalField(max_digits=14, decimal_places=6),
+        ),
+        count=F('count') + Case(
+            *[When(id=ids[key], then=Value(count)) for key, (_, count) in deltas.items()],
+            output_field=IntegerField(),
+        ),
+    )
+
+
+def add_charges(charges):
+    """Add the charges (Charge instances, saved) to the monthly rollups"""
+    deltas = {}
+    for charge in charges:
+        key = (charge.user_id, month_of(charge.billing_date), charge.service_type, charge.currency)
+        total, count = deltas.get(key, (Decimal(0), 0))
+        deltas[key] = (total + Decimal(charge.price), count + 1)
+    add_to_rollups(MonthlyCharge, ('user_id', 'month', 'service_type', 'currency'), deltas)
+
+
+def add_payments(payments):
+    """Add the payments (UserPayment instances, saved) to the monthly rollups"""
+    deltas = {}
+    for payment in payments:
+        key = (payment.user_id, month_of(payment.created.date()), payment.currency)
+        total, count = deltas.get(key, (Decimal(0), 0))
+        deltas[key] = (total + Decimal(payment.amount), count + 1)
+    add_to_rollups(MonthlyPayment, ('user_id', 'month', 'currency'), deltas)
+
+
+def rebuild_month(model, key_fields, user_id, month, totals):
+    """
+    Set the rollup rows of the user's month to totals ({key values: (total, count)},
+    keyed by key_fields past user_id and month), as computed from the ledger.
+    The rows are locked first: an add_to_rollups() of the month waits for the
+    rebuild instead of being overwritten by it
+    """
+    with transaction.atomic():
+        rows = {
+            tuple(getattr(row, field) for field in key_fields[2:]): row
+            for row in model.objects.select_for_update().filter(user_id=user_id, month=month)
+        }
+        model.objects.filter(id__in=[row.id for key, row in rows.items() if key not in totals]).delete()
+        for key, (total, count) in totals.items():
+            row = rows.get(key)
+            if row is None:
+                model.objects.create(user_id=user_id, month=month, total=total, count=count, **dict(zip(key_fields[2:], key)))
+            elif row.total != total or row.count != count:
+                model.objects.filter(id=row.id).update(total=total, count=count)
+
+
+def rebuild_charges(user_id, month):
+    """Recompute the charge rollups of the user's month from the charges"""
+    charges = Charge.objects.filter(user_id=user_id, billing_date__gte=month, billing_date__lt=next_month(month))
+    totals = {
+        (row['service_type'], row['currency']): (row['total'], row['count'])
+        for row in charges.values('service_type', 'currency').annotate(total=Sum('price'), count=Count('id')).order_by()
+    }
+    rebuild_month(MonthlyCharge, ('user_id', 'month', 'service_type', 'currency'), user_id, month, totals)
+
+
+def rebuild_payments(user_id, month):
+    """Recompute the payment rollups of the user's month from the payments"""
+    payments = UserPayment.objects.filter(user_id=user_id, created__date__gte=month, created__date__lt=next_month(month))
+    totals = {
+        (row['currency'],): (row['total'], row['count'])
+        for row in payments.values('currency').annotate(total=Sum('amount'), count=Count('id')).order_by()
+    }
+    rebuild_month(MonthlyPayment, ('user_id', 'month', 'currency'), user_id, month, totals)
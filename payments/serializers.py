@@ -1,5 +1,5 @@
 from rest_framework import serializers
-from payments.models import InvoiceRequest
+from payments.models import InvoiceRequest, MonthlyCharge, MonthlyPayment
 
 
 class InvoiceRequestSerializer(serializers.ModelSerializer):
@@ -7,3 +7,18 @@ class InvoiceRequestSerializer(serializers.ModelSerializer):
     class Meta:
         model = InvoiceRequest
         exclude = ('user', )
+
+
+class MonthlyChargeSerializer(serializers.ModelSerializer):
+    service = serializers.CharField(source='get_service_type_display', read_only=True)
+
+    class Meta:
+        model = MonthlyCharge
+        fields = ('month', 'service_type', 'service', 'currency', 'total', 'count')
+
+
+class MonthlyPaymentSerializer(serializers.ModelSerializer):
+
+    class Meta:
+        model = MonthlyPayment
+        fields = ('month', 'currency', 'total', 'count')
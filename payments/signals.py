@@ -0,0 +1,48 @@
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.dispatch import receiver
+from payments.models import Charge, UserPayment
+from payments.rollups import add_charges, add_payments, rebuild_charges, rebuild_payments, month_of
+
+
+# The charges and payments saved one by one (the charge run adds its own, in bulk).
+# A creation is added to its month, an edit or a delete rebuilds the months it touches
+
+def charge_month(charge):
+    return charge.user_id, month_of(charge.billing_date)
+
+def payment_month(payment):
+    return payment.user_id, month_of(payment.created.date())
+
+@receiver(pre_save, sender=Charge)
+@receiver(pre_save, sender=UserPayment)
+def remember_rollup_month(sender, instance, **kwargs):
+    """The month the row was rolled up in, its user or date may change"""
+    old = sender.objects.filter(pk=instance.pk).first() if instance.pk else None
+    month = charge_month if sender is Charge else payment_month
+    instance._rollup_month = month(old) if old else None
+
+@receiver(post_save, sender=Charge)
+def charge_saved(sender, instance, created, **kwargs):
+    old_month = instance.__dict__.pop('_rollup_month', None)
+    if created:
+        add_charges([instance])
+        return
+    for user_id, month in {old_month, charge_month(instance)} - {None}:
+        rebuild_charges(user_id, month)
+
+@receiver(post_delete, sender=Charge)
+def charge_deleted(sender, instance, **kwargs):
+    rebuild_charges(*charge_month(instance))
+
+@receiver(post_save, sender=UserPayment)
+def payment_saved(sender, instance, created, **kwargs):
+    old_month = instance.__dict__.pop('_rollup_month', None)
+    if created:
+        add_payments([instance])
+        return
+    for user_id, month in {old_month, payment_month(instance)} - {None}:
+        rebuild_payments(user_id, month)
+
+@receiver(post_delete, sender=UserPayment)
+def payment_deleted(sender, instance, **kwargs):
+    rebuild_payments(*payment_month(instance))
@@ -0,0 +1,351 @@
+import calendar
+import contextlib
+import datetime
+import io
+import smtplib
+from decimal import Decimal
+from unittest import mock
+
+from django.conf import settings
+from django.core import mail
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TestCase
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from payments.billing import charge_lines, line
+from payments.mailer import Mailer, SenderPool
+from payments.models import (
+    Charge, ChargedServiceType, ChargeRun, ChargeShard, MonthlyCharge, MonthlyPayment, Notification,
+    NotificationSender, NotificationStatus, UserPayment,
+)
+from radio.models import SelfHostedRadio, RadioHostingStatus
+from users.models import User, Currency
+
+
+class ChargeLinesTest(TestCase):
+    """The set-based charge of a chunk: insert-ignore on the keys, one balance UPDATE, the batch read back"""
+
+    billing_date = datetime.date(2024, 3, 15)
+
+    def setUp(self):
+        self.alice = User.objects.create(email='alice@example.com', balance=Decimal('10'))
+        self.bob = User.objects.create(email='bob@example.com', balance=Decimal('5'), currency=Currency.RUB)
+        self.users = {user.id: user for user in (self.alice, self.bob)}
+        self.lines = [
+            line(self.alice.id, ChargedServiceType.RADIO_SELF_HOSTED, '10.0.0.1', Decimal('1.5')),
+            line(self.alice.id, ChargedServiceType.RADIO_HOSTED_STREAM, 'alice', Decimal('0.25')),
+            line(self.bob.id, ChargedServiceType.RADIO_HOSTED_STREAM, 'bob', Decimal('2')),
+        ]
+
+    def balance(self, user):
+        return User.objects.get(id=user.id).balance
+
+    def test_charges_the_lines_and_updates_every_balance(self):
+        charged = charge_lines(self.users, self.lines, self.billing_date)
+
+        self.assertEqual(charged, self.lines)
+        self.assertEqual(self.balance(self.alice), Decimal('8.25'))
+        self.assertEqual(self.balance(self.bob), Decimal('3'))
+        # The users of the chunk get their new balance for the notifications
+        self.assertEqual(self.users[self.alice.id].balance, Decimal('8.25'))
+        charges = Charge.objects.filter(user=self.bob)
+        self.assertEqual(
+            list(charges.values_list('price', 'currency', 'billing_date')),
+            [(Decimal('2'), Currency.RUB, self.billing_date)],
+        )
+
+    def test_charges_of_a_chunk_share_a_batch(self):
+        charge_lines(self.users, self.lines, self.billing_date)
+
+        batches = set(Charge.objects.values_list('batch', flat=True))
+        self.assertEqual(len(batches), 1)
+        self.assertIsNotNone(batches.pop())
+
+    def test_lines_already_charged_are_ignored(self):
+        charge_lines(self.users, self.lines, self.billing_date)
+        charged = charge_lines(self.users, self.lines, self.billing_date)
+
+        self.assertEqual(charged, [])
+        self.assertEqual(Charge.objects.count(), 3)
+        self.assertEqual(self.balance(self.alice), Decimal('8.25'))
+        self.assertEqual(self.balance(self.bob), Decimal('3'))
+
+    def test_only_the_inserted_lines_are_read_back(self):
+        # Charged by an overlapping run: the insert ignores it, the readback skips it
+        charge_lines(self.users, self.lines[2:], self.billing_date)
+        charged = charge_lines(self.users, self.lines, self.billing_date)
+
+        self.assertEqual(charged, self.lines[:2])
+        self.assertEqual(self.balance(self.alice), Decimal('8.25'))
+        self.assertEqual(self.balance(self.bob), Decimal('3'))
+        self.assertEqual(MonthlyCharge.objects.get(user=self.bob).count, 1)
+
+    def test_lines_sharing_a_key_are_charged_once(self):
+        disk = [
+            line(self.alice.id, ChargedServiceType.RADIO_HOSTED_DU, '2048.0', Decimal('0.1'), dedupe_by_description=False),
+            line(self.alice.id, ChargedServiceType.RADIO_HOSTED_DU, '4096.0', Decimal('0.2'), dedupe_by_description=False),
+        ]
+        charged = charge_lines(self.users, disk, self.billing_date)
+
+        self.assertEqual(charged, disk[:1])
+        self.assertEqual(self.balance(self.alice), Decimal('9.9'))
+
+    def test_another_billing_date_is_charged_again(self):
+        charge_lines(self.users, self.lines, self.billing_date)
+        charged = charge_lines(self.users, self.lines, self.billing_date + datetime.timedelta(days=1))
+
+        self.assertEqual(charged, self.lines)
+        self.assertEqual(self.balance(self.alice), Decimal('6.5'))
+
+
+class ChargeCommandTest(TestCase):
+    """The daily charge run: failed users, billing dates"""
+
+    def setUp(self):
+        self.users = [
+            User.objects.create(email=f'user{i}@example.com', balance=Decimal('100')) for i in range(4)
+        ]
+        # No post_save: the new radio emails are not the point here
+        SelfHostedRadio.objects.bulk_create([
+            SelfHostedRadio(user=user, ip=f'10.0.0.{i}', status=RadioHostingStatus.READY, custom_price=Decimal('31'))
+            for i, user in enumerate(self.users)
+        ])
+        # Past the free trial
+        SelfHostedRadio.objects.update(ts_created=timezone.now() - datetime.timedelta(days=30))
+        self.today = timezone.now().date()
+
+    def charge(self, **options):
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+            call_command('charge', **{'chunk_size': 3, **options})
+
+    def balances(self):
+        return [User.objects.get(id=user.id).balance for user in self.users]
+
+    def daily_price(self):
+        n_month_days = calendar.monthrange(self.today.year, self.today.month)[1]
+        return (Decimal('31') / n_month_days).quantize(Decimal('0.000001'))
+
+    def test_a_failing_user_does_not_stop_its_chunk(self):
+        failing = self.users[1]
+
+        def charge_lines_failing(users, lines, billing_date):
+            if failing.id in users:
+                raise RuntimeError('broken')
+            return charge_lines(users, lines, billing_date)
+
+        with mock.patch('payments.management.commands.charge.charge_lines', charge_lines_failing):
+            self.charge()
+
+        charged = Decimal('100') - self.daily_price()
+        self.assertEqual(self.balances(), [charged, Decimal('100'), charged, charged])
+        shard = ChargeShard.objects.get()
+        self.assertEqual(shard.failed_user_ids, [failing.id])
+        self.assertIsNotNone(shard.finished)
+        self.assertIn(str(failing.id), Notification.objects.get(key=f'summary:{self.today}').body)
+
+        self.charge(retry_failed=True)
+        self.assertEqual(self.balances(), [charged] * 4)
+        shard.refresh_from_db()
+        self.assertEqual(shard.failed_user_ids, [])
+        self.assertEqual(shard.charges, 4)
+
+    def test_retry_failed_needs_a_finished_run(self):
+        with self.assertRaises(CommandError):
+            self.charge(retry_failed=True)
+
+    def test_a_past_billing_date_needs_a_run_to_resume_or_backfill(self):
+        yesterday = (self.today - datetime.timedelta(days=1)).isoformat()
+        with self.assertRaises(CommandError):
+            self.charge(billing_date=yesterday)
+        self.assertFalse(ChargeRun.objects.exists())
+
+        self.charge(billing_date=yesterday, backfill=True)
+        self.assertEqual(Charge.objects.filter(billing_date=yesterday).count(), 4)
+        # The run exists now, resuming it needs no flag
+        self.charge(billing_date=yesterday)
+
+    def test_a_future_billing_date_is_refused(self):
+        with self.assertRaises(CommandError):
+            self.charge(billing_date=(self.today + datetime.timedelta(days=1)).isoformat(), backfill=True)
+        self.assertFalse(Charge.objects.exists())
+
+    def test_the_same_billing_date_charges_each_user_once(self):
+        self.charge()
+        charged = Decimal('100') - self.daily_price()
+        self.assertEqual(self.balances(), [charged] * 4)
+
+        # A finished run is not charged again, nor a run whose progress is lost
+        self.charge()
+        ChargeRun.objects.all().delete()
+        self.charge()
+        # Chunked differently, the keys still match
+        ChargeRun.objects.all().delete()
+        self.charge(chunk_size=1)
+
+        self.assertEqual(self.balances(), [charged] * 4)
+        for user in self.users:
+            self.assertEqual(Charge.objects.filter(user=user, billing_date=self.today).count(), 1)
+        self.assertEqual(MonthlyCharge.objects.get(user=self.users[0]).count, 1)
+
+
+class MailerTest(TestCase):
+    """The queued notifications are sent once each, failures are retried later then given up"""
+
+    def setUp(self):
+        self.notifications = Notification.objects.bulk_create([
+            Notification(
+                key=f'test:{i}',
+                sender=NotificationSender.STREAMING_CENTER if i % 2 else NotificationSender.RADIO_TOCHKA,
+                recipient=f'user{i}@example.com',
+                subject=f'Notification {i}',
+                body='Balance',
+            )
+            for i in range(6)
+        ])
+        self.mailer = Mailer(connections=2, rate=0, max_attempts=2, retry_delay=60)
+        self.addCleanup(self.mailer.close)
+
+    def send_due(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return self.mailer.send_batch(self.mailer.due_notifications(100))
+
+    def fail_for(self, recipient, error):
+        """Make the sends to the recipient raise error"""
+        send = SenderPool.send
+
+        def failing_send(pool, connection, message):
+            if recipient in message.to:
+                raise error
+            return send(pool, connection, message)
+
+        return mock.patch.object(SenderPool, 'send', failing_send)
+
+    def test_every_notification_is_sent_once(self):
+        self.assertEqual(self.send_due(), (6, 0))
+        self.assertEqual(self.send_due(), (0, 0))
+
+        self.assertEqual(sorted(message.to[0] for message in mail.outbox), [f'user{i}@example.com' for i in range(6)])
+        self.assertEqual(Notification.objects.filter(status=NotificationStatus.SENT, sent__isnull=False).count(), 6)
+        sc = next(message for message in mail.outbox if message.to == ['user1@example.com'])
+        self.assertEqual(sc.from_email, settings.SC_ADMIN_EMAIL)
+
+    def test_a_refused_recipient_is_retried_later_then_given_up(self):
+        refused = smtplib.SMTPRecipientsRefused({'user2@example.com': (550, b'No such user')})
+        with self.fail_for('user2@example.com', refused):
+            self.assertEqual(self.send_due(), (5, 1))
+            notification = Notification.objects.get(recipient='user2@example.com')
+            self.assertEqual(notification.status, NotificationStatus.PENDING)
+            self.assertEqual(notification.attempts, 1)
+            self.assertGreater(notification.next_attempt, timezone.now())
+            self.assertTrue(notification.error)
+            # Not due before its backoff
+            self.assertEqual(self.send_due(), (0, 0))
+
+            Notification.objects.filter(id=notification.id).update(next_attempt=timezone.now())
+            self.assertEqual(self.send_due(), (0, 1))
+        notification.refresh_from_db()
+        self.assertEqual(notification.status, NotificationStatus.FAILED)
+        self.assertEqual(notification.attempts, 2)
+        self.assertEqual(len(mail.outbox), 5)
+
+    def test_a_dropped_connection_is_reopened_and_the_message_sent_once(self):
+        drops = iter([smtplib.SMTPServerDisconnected('Connection unexpectedly closed')])
+        send = SenderPool.send
+
+        def dropping_send(pool, connection, message):
+            if message.to == ['user3@example.com']:
+                error = next(drops, None)
+                if error:
+                    raise error
+            return send(pool, connection, message)
+
+        with mock.patch.object(SenderPool, 'send', dropping_send):
+            self.assertEqual(self.send_due(), (6, 0))
+        self.assertEqual([message.to for message in mail.outbox].count(['user3@example.com']), 1)
+
+    def test_a_broken_template_is_given_up_at_once(self):
+        Notification.objects.filter(recipient='user4@example.com').update(template='email/missing.html')
+
+        self.assertEqual(self.send_due(), (5, 1))
+        notification = Notification.objects.get(recipient='user4@example.com')
+        self.assertEqual(notification.status, NotificationStatus.FAILED)
+        self.assertTrue(notification.error.startswith('Render'))
+
+
+class RollupsTest(TestCase):
+    """The monthly rollups follow the charges and payments through edits and deletes"""
+
+    def setUp(self):
+        self.user = User.objects.create(email='user@example.com', currency=Currency.USD)
+        self.month = timezone.now().date().replace(day=1)
+
+    def charge(self, price, billing_date=None, **fields):
+        return Charge.objects.create(**{
+            'user': self.user, 'service_type': ChargedServiceType.RADIO_HOSTED_STREAM, 'price': Decimal(price),
+            'currency': Currency.USD, 'billing_date': billing_date or self.month, **fields,
+        })
+
+    def rollups(self):
+        return sorted(MonthlyCharge.objects.filter(user=self.user).values_list('month', 'currency', 'total', 'count'))
+
+    def test_an_edited_charge_rebuilds_its_months(self):
+        charge = self.charge('3')
+        self.charge('2')
+        self.assertEqual(self.rollups(), [(self.month, Currency.USD, Decimal('5'), 2)])
+
+        charge.price = Decimal('1')
+        charge.save()
+        self.assertEqual(self.rollups(), [(self.month, Currency.USD, Decimal('3'), 2)])
+
+        previous = (self.month - datetime.timedelta(days=1)).replace(day=1)
+        charge.billing_date = previous
+        charge.save()
+        self.assertEqual(self.rollups(), [
+            (previous, Currency.USD, Decimal('1'), 1),
+            (self.month, Currency.USD, Decimal('2'), 1),
+        ])
+
+    def test_a_deleted_charge_leaves_its_month(self):
+        charge = self.charge('3')
+        charge.delete()
+        self.assertEqual(self.rollups(), [])
+
+    def test_payments_follow_edits_and_deletes(self):
+        payment = UserPayment.objects.create(user=self.user, amount=Decimal('10'), currency=Currency.USD)
+        UserPayment.objects.create(user=self.user, amount=Decimal('5'), currency=Currency.USD)
+
+        payment.amount = Decimal('20')
+        payment.save()
+        self.assertEqual(MonthlyPayment.objects.get(user=self.user).total, Decimal('25'))
+
+        payment.delete()
+        rollup = MonthlyPayment.objects.get(user=self.user)
+        self.assertEqual((rollup.total, rollup.count), (Decimal('5'), 1))
+
+    def test_month_total_is_in_the_user_currency(self):
+        self.charge('3')
+        self.charge('100', currency=Currency.RUB, description='before a currency change')
+        client = APIClient()
+        client.force_authenticate(self.user)
+
+        response = client.get('/api/v1/month_total_charge/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['month_hosted'], 3)
+        self.assertEqual(response.data['total'], 3)
+        self.assertEqual(response.data['currency'], '$')
+
+    def test_history_is_served_from_the_rollups(self):
+        self.charge('3')
+        client = APIClient()
+        client.force_authenticate(self.user)
+
+        response = client.get('/api/v1/charges/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['count'], 1)
+        self.assertEqual(response.data['charges'][0]['total'], '3.000000')
+
+        response = client.get('/api/v1/payments/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['payments'], [])
@@ -8,10 +8,14 @@ from rest_framework import (
 )
 from rest_framework.response import Response
 from rest_framework import generics
+from rest_framework.pagination import PageNumberPagination
+from django.db.models import Sum
+from django.utils import timezone
 
-from payments.models import InvoiceRequest
-from payments.serializers import InvoiceRequestSerializer
-from radiotochka.billing import CUSTOM_PAYMENT_OPTIONS, RTBilling
+from payments.models import InvoiceRequest, ChargedServiceType, MonthlyCharge, MonthlyPayment
+from payments.rollups import month_of
+from payments.serializers import InvoiceRequestSerializer, MonthlyChargeSerializer, MonthlyPaymentSerializer
+from radiotochka.billing import CUSTOM_PAYMENT_OPTIONS
 
 class InvoiceRequestViewSet(viewsets.ModelViewSet):
     permission_classes = [
@@ -39,42 +43,78 @@ class CustomPaymentMethodsView(generics.RetrieveAPIView):
 
         return Response(CUSTOM_PAYMENT_OPTIONS)
 
+class BillingHistoryPagination(PageNumberPagination):
+    """
+    A page of monthly rollups, a year by default. The rows are under `results_key`,
+    where the clients found the RTBilling history
+    """
+    page_size = 12
+    page_size_query_param = 'per_page'
+    max_page_size = 120
+    results_key = 'results'
+
+    def get_paginated_response(self, data):
+        return Response({
+            self.results_key: data,
+            'count': self.page.paginator.count,
+            'next': self.get_next_link(),
+            'previous': self.get_previous_link(),
+        })
+
+class PaymentsHistoryPagination(BillingHistoryPagination):
+    results_key = 'payments'
+
+class ChargesHistoryPagination(BillingHistoryPagination):
+    results_key = 'charges'
+
 class MonthTotalChargeView(generics.RetrieveAPIView):
     permission_classes = [
         permissions.IsAuthenticated
     ]
 
     def get(self, request, format=None):
-        billing_instance = RTBilling()
-        monthly = billing_instance.get_month_charge(self.request.user.email, self.request.user.id, True)
+        # A few rollup rows of the current month instead of its daily charges,
+        # in the user's currency: amounts of different currencies do not add up
+        currency = self.request.user.currency
+        totals = dict(
+            MonthlyCharge.objects.filter(
+                user=self.request.user, month=month_of(timezone.now().date()), currency=currency
+            )
+            .values_list('service_type')
+            .annotate(month_total=Sum('total'))
+        )
+        month_hosted = float(totals.get(ChargedServiceType.RADIO_HOSTED_STREAM, 0))
+        month_du = float(totals.get(ChargedServiceType.RADIO_HOSTED_DU, 0))
+        month_self_hosted = float(totals.get(ChargedServiceType.RADIO_SELF_HOSTED, 0))
         return Response({
-            "month_hosted": round(monthly[0], 2), 
-            "month_du": round(monthly[1], 2),
-            "month_self_hosted": round(monthly[2], 2), 
-            "total": round(monthly[0] + monthly[1] + monthly[2], 2),
+            "month_hosted": round(month_hosted, 2),
+            "month_du": round(month_du, 2),
+            "month_self_hosted": round(month_self_hosted, 2),
+            "total": round(month_hosted + month_du + month_self_hosted, 2),
+            "currency": self.request.user.get_currency_display(),
         })
 
-class UserPaymentsView(generics.RetrieveAPIView):
+class UserPaymentsView(generics.ListAPIView):
+    """Payments history by month, latest first, paginated"""
     permission_classes = [
         permissions.IsAuthenticated
     ]
+    serializer_class = MonthlyPaymentSerializer
+    pagination_class = PaymentsHistoryPagination
 
-    def get(self, request, format=None):
-        billing_instance = RTBilling()
-        return Response({
-            "payments": billing_instance.get_payment_history(self.request.user.id)
-        })
+    def get_queryset(self):
+        return MonthlyPayment.objects.filter(user=self.request.user).order_by('-month', 'currency')
 
-class UserChargesView(generics.RetrieveAPIView):
+class UserChargesView(generics.ListAPIView):
+    """Charges history by month and service, latest first, paginated"""
     permission_classes = [
         permissions.IsAuthenticated
     ]
+    serializer_class = MonthlyChargeSerializer
+    pagination_class = ChargesHistoryPagination
 
-    def get(self, request, format=None):
-        billing_instance = RTBilling()
-        return Response({
-            "charges": billing_instance.get_charge_history(self.request.user.id)
-        })
+    def get_queryset(self):
+        return MonthlyCharge.objects.filter(user=self.request.user).order_by('-month', 'service_type', 'currency')
 
 invoice_request_router = routers.SimpleRouter()
 invoice_request_router.register(
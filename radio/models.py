@@ -324,6 +324,9 @@ class HostedRadio(BaseRadio):
     )
 
     def get_disk_quota(self):
+        # Annotated by the billing run (payments/billing.py), saves a query per radio
+        if hasattr(self, 'disk_quota'):
+            return self.disk_quota or 0
         disk_quota = self.services.filter(service_type=ServiceType.DISK).last()
         if not disk_quota:
             return 0
@@ -339,6 +342,8 @@ class HostedRadio(BaseRadio):
         if self.custom_price is not None:
             return self.custom_price
 
+        if hasattr(self, 'services_price'):
+            return self.services_price or 0.
         return self.services.aggregate(Sum('price'))['price__sum'] or 0.
 
     class Meta(object):